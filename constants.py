@@ -1,11 +1,19 @@
 LINKING_PROPERTY = "Transaction/generated/LinkedTransactionId"
+COMMISSION_TXN_FILTER = "type eq 'Commission'"
 INPUT_TXN_FILTER = "type in 'Buy','Purchase','Sell','FwdFxSell', 'FwdFxBuy','FxBuy','FxSell','StockIn'"
 
 ENTITY_PROPERTY = "Portfolio/test/Entity"
 BROKER_PROPERTY = "Portfolio/test/Broker"
 COUNTRY_PROPERTY = "Instrument/test/Country"
+WATERMARK_PROPERTY = "Portfolio/generated/CommissionWatermark"
 PROPERTIES_REQUIRED = [
     ENTITY_PROPERTY,
     BROKER_PROPERTY,
-    COUNTRY_PROPERTY
-]
\ No newline at end of file
+    COUNTRY_PROPERTY,
+    WATERMARK_PROPERTY
+]
+PORTFOLIO_PROPERTIES = [
+    ENTITY_PROPERTY,
+    BROKER_PROPERTY,
+    WATERMARK_PROPERTY
+]
@@ -0,0 +1,65 @@
+import gzip
+import logging
+
+# Bodies smaller than this gain too little from compression to be worth the CPU
+_gzip_min_bytes = 1024
+
+
+def configure_api_client(api_client, pool_size=None, gzip_responses=True):
+    # Replaces the connection pool of a generated LUSID or Drive ApiClient with one holding pool_size connections,
+    # enough for every thread of the run to keep its own connection alive between calls rather than having the
+    # pool discard and reopen them. Responses are asked for gzipped, urllib3 decompresses them as they are read.
+    if api_client is None:
+        return
+    if pool_size:
+        api_client.configuration.connection_pool_maxsize = pool_size
+        api_client.rest_client = type(api_client.rest_client)(api_client.configuration)
+    if gzip_responses:
+        api_client.set_default_header("Accept-Encoding", "gzip")
+
+
+_unretried_api_classes = {}
+
+
+def build_api_without_sdk_retries(api_client, api_class):
+    # The SDK's ApiClientFactory.build swaps the __getattribute__ of the api class for one that wraps every method in
+    # lusidretry, which retries a 429 with a Retry-After header itself, up to three times and again in the
+    # *_with_http_info method each call goes through. A subclass with the plain attribute lookup makes one request
+    # per call, so that call_with_retry is the only retry policy and sees every throttle.
+    unretried_class = _unretried_api_classes.get(api_class)
+    if unretried_class is None:
+        unretried_class = _unretried_api_classes.setdefault(
+            api_class, type(api_class.__name__, (api_class,), {"__getattribute__": object.__getattribute__})
+        )
+    return unretried_class(api_client)
+
+
+def get_pool_manager(api_factory):
+    rest_client = getattr(getattr(api_factory, "api_client", None), "rest_client", None)
+    return getattr(rest_client, "pool_manager", None)
+
+
+def compress_request_bodies(pool_manager, min_bytes=_gzip_min_bytes, compress_level=1):
+    # Gzips the JSON bodies sent through the pool, such as the batches of commissions upserted. The lowest
+    # compression level already shrinks them around tenfold at a fraction of the CPU of the default level.
+    if pool_manager is None or getattr(pool_manager, "compressing", False):
+        return
+
+    pool_request = pool_manager.request
+
+    def compressing_request(method, url, *args, body=None, headers=None, **kwargs):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if body and len(body) >= min_bytes:
+            body = gzip.compress(body, compresslevel=compress_level)
+            headers = dict(headers or {}, **{"Content-Encoding": "gzip"})
+        return pool_request(method, url, *args, body=body, headers=headers, **kwargs)
+
+    pool_manager.request = compressing_request
+    pool_manager.compressing = True
+    logging.debug("Compressing request bodies with gzip")
+
+
+def get_access_token(api_factory):
+    configuration = getattr(getattr(api_factory, "api_client", None), "configuration", None)
+    return getattr(configuration, "access_token", None)
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from helpers.instrumentation import write_atomically
+from helpers.lusid_drive_util import get_default_cache_dir
+
+
+def get_checkpoint_dir(cache_dir=None):
+    return os.path.join(cache_dir or get_default_cache_dir(), "checkpoints")
+
+
+def get_portfolio_checkpoint_dir(scope, portfolio_code, cache_dir=None):
+    # Every checkpoint of a portfolio is kept in its own directory, so those left by windows which were never
+    # finished can be found and removed
+    digest = hashlib.sha1(f"{scope}\n{portfolio_code}".encode()).hexdigest()[:20]
+    return os.path.join(get_checkpoint_dir(cache_dir), digest)
+
+
+class WindowCheckpoint:
+    # Remembers the window a portfolio was being processed over, so that a resumed run finishes that window rather
+    # than one ending at the time it is restarted, or starting days_going_back before it. The watermark then moves to
+    # the end of the interrupted window and the next run picks up the rest.
+
+    def __init__(self, scope, portfolio_code, cache_dir=None):
+        self.directory = get_portfolio_checkpoint_dir(scope, portfolio_code, cache_dir)
+        self.path = os.path.join(self.directory, "window.json")
+        self.scope = scope
+        self.portfolio_code = portfolio_code
+
+    def get_interrupted_window(self):
+        # Returns the start and end dates of the window being processed when the last run stopped
+        try:
+            with open(self.path) as window_file:
+                window = json.load(window_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not window.get("start_date") or not window.get("end_date"):
+            return None
+        return window["start_date"], window["end_date"]
+
+    def start(self, start_date: str, end_date: str, resume=False):
+        # A window started afresh makes the journals of any earlier window unusable, so they are removed
+        if not resume:
+            self.complete()
+        os.makedirs(self.directory, exist_ok=True)
+        write_atomically(self.path, json.dumps({
+            "scope": self.scope, "portfolio_code": self.portfolio_code, "start_date": start_date,
+            "end_date": end_date,
+        }))
+
+    def complete(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class CheckpointJournal:
+    # Append-only journal of the pages of one portfolio window whose commissions have all been upserted. Each line
+    # records a committed page and the token of the page after it, so a resumed run starts fetching from there.
+    # The journal is removed once the whole window has been upserted without failures.
+
+    def __init__(self, scope, portfolio_code, start_date: str, end_date: str, cache_dir=None):
+        # The date ranges of a sharded window each have a journal of their own
+        digest = hashlib.sha1(f"{start_date}\n{end_date}".encode()).hexdigest()[:20]
+        self.path = os.path.join(get_portfolio_checkpoint_dir(scope, portfolio_code, cache_dir), f"{digest}.jsonl")
+        self.header = {"scope": scope, "portfolio_code": portfolio_code, "start_date": start_date,
+                       "end_date": end_date}
+        self.journal_file = None
+
+    def read_last_commit(self):
+        lines = []
+        try:
+            with open(self.path) as journal_file:
+                for line in journal_file:
+                    try:
+                        lines.append(json.loads(line))
+                    except ValueError:
+                        # A line cut short by the process dying ends the journal
+                        logging.warning(f"Ignoring the damaged end of the checkpoint journal at {self.path}")
+                        break
+        except FileNotFoundError:
+            return None
+
+        if not lines or lines[0] != self.header:
+            return None
+        commits = [line for line in lines[1:] if line.get("event") == "page_committed"]
+        return commits[-1] if commits else None
+
+    def open(self, resume=False):
+        # Returns the last committed page when resuming, or None when the window starts from the beginning
+        last_commit = self.read_last_commit() if resume else None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if last_commit:
+            self.journal_file = open(self.path, "a")
+        else:
+            self.journal_file = open(self.path, "w")
+            self.write(self.header)
+        return last_commit
+
+    def write(self, entry: dict):
+        self.journal_file.write(json.dumps(entry) + "\n")
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+
+    def commit_page(self, page_number, next_page, transactions, upserted_batches):
+        self.write({"event": "page_committed", "page_number": page_number, "next_page": next_page,
+                    "transactions": transactions, "upserted_batches": upserted_batches})
+
+    def close(self):
+        if self.journal_file:
+            self.journal_file.close()
+            self.journal_file = None
+
+    def complete(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def open_checkpoint_journal(scope, portfolio_code, start_date: str, end_date: str, resume=False) -> tuple:
+    # Checkpointing is best effort, a run carries on without it when the cache directory cannot be written to
+    journal = CheckpointJournal(scope, portfolio_code, start_date, end_date)
+    try:
+        return journal, journal.open(resume)
+    except OSError as e:
+        logging.warning(f"Not checkpointing '{scope}/{portfolio_code}', the journal could not be opened: {e}")
+        return None, None
+
+
+class PageCheckpointTracker:
+    # Works out which pages have had every commission computed from them upserted. Commissions are numbered in
+    # the order they are handed to the upsert and batched in that order, so the batches up to any batch hold the
+    # commissions up to its last. A page is committed once the batches before and including its last commission
+    # have all succeeded, batches completing out of order only commit pages once the gap before them is filled.
+
+    def __init__(self, journal, first_page_number=1):
+        self.journal = journal
+        self.page_number = first_page_number - 1
+        self.commissions = 0
+        self.pending_pages = []
+        self.succeeded_batches = {}
+        self.contiguous_batches = 0
+        self.upserted = 0
+
+    def track_pages(self, pages_with_next_page, compute_page):
+        # Yields the commissions of every page, noting where each page ends in the stream of commissions
+        for page, next_page in pages_with_next_page:
+            self.page_number += 1
+            for commission in compute_page(page):
+                self.commissions += 1
+                yield commission
+            self.pending_pages.append((self.page_number, self.commissions, next_page, len(page)))
+            self.commit_pages()
+
+    def batch_done(self, batch_result):
+        if not batch_result.succeeded:
+            return
+        # Batches vary in size when an adaptive batch controller is used, so each one's size is kept
+        self.succeeded_batches[batch_result.batch_number] = len(batch_result.transaction_ids)
+        while self.contiguous_batches + 1 in self.succeeded_batches:
+            self.contiguous_batches += 1
+            self.upserted += self.succeeded_batches.pop(self.contiguous_batches)
+        self.commit_pages()
+
+    def commit_pages(self):
+        while self.pending_pages and self.pending_pages[0][1] <= self.upserted:
+            page_number, _, next_page, transactions = self.pending_pages.pop(0)
+            if self.journal:
+                self.journal.commit_page(page_number, next_page, transactions, self.contiguous_batches)
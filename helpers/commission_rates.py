@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+from bisect import bisect_right
+
+WILDCARD = "*"
+RULE_DIMENSIONS = ("country", "broker", "entity", "transaction_type", "instrument")
+# When several rules match, the one matching on the most dimensions wins. Between rules matching on as many, the
+# one matching on the instrument wins, then on the transaction type, the country, the broker and the entity.
+_DIMENSION_PRIORITY = {"instrument": 16, "transaction_type": 8, "country": 4, "broker": 2, "entity": 1}
+_DIMENSION_BITS = tuple(_DIMENSION_PRIORITY[dimension] for dimension in RULE_DIMENSIONS)
+_RULE_FIELDS = set(RULE_DIMENSIONS) | {"rate", "tiers"}
+_max_resolved = 100000
+_unresolved = object()
+
+
+class TieredRate:
+    # Rates that step down (or up) with the notional of the transaction. Each tier applies from its breakpoint
+    # up to the next one, a notional below the first breakpoint takes the first tier's rate.
+    __slots__ = ("breakpoints", "rates")
+
+    def __init__(self, tiers: list):
+        tiers = sorted((float(tier["from"]), float(tier["rate"])) for tier in tiers)
+        if not tiers:
+            raise ValueError("A tiered commission rule needs at least one tier")
+        self.breakpoints = [breakpoint for breakpoint, _ in tiers]
+        self.rates = [rate for _, rate in tiers]
+
+    def rate_for(self, notional: float) -> float:
+        return self.rates[max(bisect_right(self.breakpoints, abs(notional)) - 1, 0)]
+
+
+class CompiledRules:
+    # Everything compiled from one version of the config, published by a reload as a whole so that lookups running
+    # on other threads never see the rules of one version with the masks or memoised rules of another
+    __slots__ = ("rules", "rule_masks", "used_dimensions", "by_transaction_type", "by_instrument", "resolved")
+
+    def __init__(self, rules: dict, rule_masks: list):
+        self.rules = rules
+        self.rule_masks = rule_masks
+        self.used_dimensions = 0
+        for mask in rule_masks:
+            self.used_dimensions |= mask
+        self.by_transaction_type = bool(self.used_dimensions & _DIMENSION_PRIORITY["transaction_type"])
+        self.by_instrument = bool(self.used_dimensions & _DIMENSION_PRIORITY["instrument"])
+        self.resolved = {}
+
+
+class CommissionRateTable:
+    # Compiles the commission config into an index of rules keyed on every dimension, with wildcards in the
+    # dimensions a rule does not match on, and only re-parses the config file when it changes on disk. A lookup
+    # probes the index once per combination of dimensions the rules use, most specific first, so its cost does
+    # not grow with the number of rules. Resolved rules are memoised per combination of values looked up.
+
+    def __init__(self, config_file_path):
+        self.config_file_path = config_file_path
+        self._compiled = CompiledRules({}, [])
+        self._file_signature = None
+        self.reload()
+
+    @property
+    def rules(self) -> dict:
+        return self._compiled.rules
+
+    @property
+    def rule_masks(self) -> list:
+        return self._compiled.rule_masks
+
+    @property
+    def used_dimensions(self) -> int:
+        return self._compiled.used_dimensions
+
+    def _get_file_signature(self):
+        stat_result = os.stat(self.config_file_path)
+        return stat_result.st_mtime_ns, stat_result.st_size
+
+    def reload(self):
+        file_signature = self._get_file_signature()
+
+        with open(self.config_file_path, 'r') as json_file_contents:
+            mapping = json.load(json_file_contents)
+
+        if len(mapping.keys()) == 0:
+            raise ValueError(f"The no mapping config found in the {self.config_file_path} path")
+
+        compiled = CompiledRules(*compile_rule_index(mapping))
+        self._compiled = compiled
+        self._file_signature = file_signature
+        logging.info(f"Loaded {len(compiled.rules)} commission rates from {self.config_file_path}")
+
+    def reload_if_changed(self) -> bool:
+        if self._get_file_signature() == self._file_signature:
+            return False
+
+        logging.info(f"The commission config at {self.config_file_path} has changed. Reloading.")
+        self.reload()
+        return True
+
+    def matches_on(self, dimension) -> bool:
+        return bool(self._compiled.used_dimensions & _DIMENSION_PRIORITY[dimension])
+
+    def find_schedule(self, country, broker, entity, transaction_type=WILDCARD, instrument=WILDCARD):
+        # Returns the rate or TieredRate of the most specific matching rule, or None when no rule matches. Values
+        # of dimensions no rule matches on are dropped so they do not multiply the memoised combinations. The
+        # compiled rules are read once so a reload part way through a lookup cannot mix two versions of them.
+        compiled = self._compiled
+        key = (country, broker, entity, transaction_type if compiled.by_transaction_type else WILDCARD,
+               instrument if compiled.by_instrument else WILDCARD)
+        schedule = compiled.resolved.get(key, _unresolved)
+        if schedule is _unresolved:
+            schedule = self._resolve(compiled, key)
+        return schedule
+
+    @staticmethod
+    def _resolve(compiled: CompiledRules, key):
+        schedule = None
+        for mask in compiled.rule_masks:
+            schedule = compiled.rules.get(tuple(
+                value if mask & bit else WILDCARD for value, bit in zip(key, _DIMENSION_BITS)
+            ))
+            if schedule is not None:
+                break
+
+        if len(compiled.resolved) >= _max_resolved:
+            compiled.resolved.clear()
+        compiled.resolved[key] = schedule
+        return schedule
+
+    def find_rate(self, country, broker, entity, transaction_type=WILDCARD, instrument=WILDCARD, notional=0.0):
+        schedule = self.find_schedule(country, broker, entity, transaction_type, instrument)
+        if isinstance(schedule, TieredRate):
+            return schedule.rate_for(notional)
+        return schedule
+
+    def get_rate(self, country, broker, entity, counts=None, transaction_type=WILDCARD, instrument=WILDCARD,
+                 notional=0.0):
+        rate = self.find_schedule(country, broker, entity, transaction_type, instrument)
+        if rate.__class__ is TieredRate:
+            return rate.rate_for(notional)
+        if rate is not None:
+            return rate
+
+        # Misses are counted per combination and reported once per portfolio rather than logged per transaction
+        if counts is not None:
+            counts[("mapping_miss", country, broker, entity)] += 1
+        # A transaction of 0 units will be created and the user will be warned that a mapping value has failed (TODO).
+        return 0
+
+
+def compile_rate_index(mapping: dict) -> dict:
+    rates = {}
+    for country, brokers in mapping.items():
+        for broker, entities in brokers.items():
+            for entity, rate in entities.items():
+                rates[(country, broker, entity)] = rate
+    return rates
+
+
+def compile_rule_index(mapping: dict) -> tuple:
+    # The config is either the nested country -> broker -> entity mapping of flat rates, a "rules" list, or both.
+    # A rule names the values it matches on, as one value or a list of them, and leaves out or sets to "*" the
+    # dimensions it applies to whatever their value. It has either a flat "rate" or "tiers" of
+    # {"from": notional, "rate": rate}.
+    legacy_mapping = {country: brokers for country, brokers in mapping.items() if country != "rules"}
+    rules = {
+        (country, broker, entity, WILDCARD, WILDCARD): rate
+        for (country, broker, entity), rate in compile_rate_index(legacy_mapping).items()
+    }
+
+    for rule in mapping.get("rules", []):
+        unknown_fields = set(rule) - _RULE_FIELDS
+        if unknown_fields or ("rate" in rule) == ("tiers" in rule):
+            raise ValueError(f"The commission rule {rule} must have one of 'rate' or 'tiers' and may only match on "
+                             f"{', '.join(RULE_DIMENSIONS)}")
+        schedule = TieredRate(rule["tiers"]) if "tiers" in rule else float(rule["rate"])
+
+        keys = [()]
+        for dimension in RULE_DIMENSIONS:
+            values = rule.get(dimension, WILDCARD)
+            values = values if isinstance(values, list) else [values]
+            keys = [key + (value,) for key in keys for value in values]
+        for key in keys:
+            if key in rules:
+                logging.warning(f"The commission rule for {'/'.join(key)} is defined more than once, using the last")
+            rules[key] = schedule
+
+    # Only the combinations of dimensions some rule matches on are probed, most specific first
+    masks = {
+        sum(bit for value, bit in zip(key, _DIMENSION_BITS) if value != WILDCARD) for key in rules
+    }
+    rule_masks = sorted(masks, key=lambda mask: (bin(mask).count("1"), mask), reverse=True)
+    return rules, rule_masks
+
+
+_rate_tables = {}
+
+
+def get_commission_rate_table(config_file_path=None) -> CommissionRateTable:
+    if config_file_path is None:
+        config_file_path = os.getenv("FBN_COMMISSIONS_CONFIG_PATH")
+    if not config_file_path:
+        raise FileNotFoundError(f"The file {config_file_path} does not exist")
+
+    rate_table = _rate_tables.get(config_file_path)
+    if rate_table is None:
+        rate_table = CommissionRateTable(config_file_path)
+        _rate_tables[config_file_path] = rate_table
+    else:
+        rate_table.reload_if_changed()
+
+    return rate_table
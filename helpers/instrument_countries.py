@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import lusid
+
+from helpers.instrumentation import run_metrics, write_atomically
+from helpers.utilities import call_with_retry
+
+_not_cached = object()
+
+
+class InstrumentCountryCache:
+    # Maps instrument LUIDs to their country property so transactions can be fetched without decorating every row
+    # with instrument properties. Unknown LUIDs are fetched in bulk from the InstrumentsApi a page at a time and
+    # the least recently used entries are evicted beyond max_size. Instruments without a country are cached as
+    # None so they are not asked for again.
+
+    def __init__(self, country_prop, max_size=100000, cache_path=None, ttl_seconds=86400, request_size=500):
+        self.country_prop = country_prop
+        self.max_size = max_size
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_seconds
+        self.request_size = request_size
+        self.countries = OrderedDict()
+        self.lock = threading.Lock()
+        if cache_path:
+            self.load()
+
+    def __getstate__(self):
+        # Sent to date range shards in other processes with what has been resolved so far, the lock is not
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.countries)
+
+    def get(self, instrument_uid):
+        with self.lock:
+            country = self.countries.get(instrument_uid, _not_cached)
+            if country is _not_cached:
+                return None
+            self.countries.move_to_end(instrument_uid)
+            return country
+
+    def put(self, instrument_uid, country):
+        with self.lock:
+            self.countries[instrument_uid] = country
+            self.countries.move_to_end(instrument_uid)
+            while len(self.countries) > self.max_size:
+                self.countries.popitem(last=False)
+
+    def prefetch(self, api_factory, instrument_uids) -> dict:
+        # Returns the country of every instrument asked for, fetching those not cached. Callers look countries up in
+        # the returned mapping rather than the cache, where they could have been evicted in the meantime by the size
+        # limit or by other portfolios sharing the cache.
+        page_countries = {}
+        missing = []
+        with self.lock:
+            for instrument_uid in dict.fromkeys(instrument_uids):
+                country = self.countries.get(instrument_uid, _not_cached)
+                if country is _not_cached:
+                    missing.append(instrument_uid)
+                else:
+                    self.countries.move_to_end(instrument_uid)
+                    page_countries[instrument_uid] = country
+        if not missing:
+            return page_countries
+
+        instruments_api = api_factory.build(lusid.api.InstrumentsApi)
+        for start in range(0, len(missing), self.request_size):
+            chunk = missing[start:start + self.request_size]
+            response, _ = call_with_retry(
+                instruments_api.get_instruments, identifier_type="LusidInstrumentId", request_body=chunk,
+                property_keys=[self.country_prop]
+            )
+            found = response.values or {}
+            for instrument_uid in chunk:
+                instrument = found.get(instrument_uid)
+                country = None
+                for model_property in (instrument.properties or []) if instrument else []:
+                    if model_property.key == self.country_prop:
+                        country = model_property.value.label_value
+                page_countries[instrument_uid] = country
+                self.put(instrument_uid, country)
+        run_metrics.increment("instruments_resolved", len(missing))
+        logging.debug(f"Resolved the country of {len(missing)} instruments")
+        return page_countries
+
+    def load(self):
+        try:
+            with open(self.cache_path) as cache_file:
+                cached = json.load(cache_file)
+        except (FileNotFoundError, ValueError):
+            return
+
+        if cached.get("country_property") != self.country_prop or \
+                time.time() - cached.get("saved_at", 0) > self.ttl_seconds:
+            logging.info(f"The instrument country cache at {self.cache_path} is stale. Ignoring it.")
+            return
+
+        for instrument_uid, country in cached["countries"].items():
+            self.put(instrument_uid, country)
+        logging.info(f"Loaded the country of {len(cached['countries'])} instruments from {self.cache_path}")
+
+    def save(self):
+        if not self.cache_path:
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        with self.lock:
+            cached = {"country_property": self.country_prop, "saved_at": time.time(), "countries": dict(self.countries)}
+        write_atomically(self.cache_path, json.dumps(cached))
+        logging.info(f"Saved the country of {len(cached['countries'])} instruments to {self.cache_path}")
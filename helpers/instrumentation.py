@@ -0,0 +1,316 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from helpers.api_clients import build_api_without_sdk_retries
+
+
+class StageStats:
+    __slots__ = ("count", "duration_seconds", "items")
+
+    def __init__(self):
+        self.count = 0
+        self.duration_seconds = 0.0
+        self.items = 0
+
+
+class ApiCallStats:
+    __slots__ = ("calls", "errors", "retries", "duration_seconds", "request_items", "response_items",
+                 "bytes_sent", "bytes_received")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = defaultdict(int)
+        self.retries = 0
+        self.duration_seconds = 0.0
+        self.request_items = 0
+        self.response_items = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+class RunMetrics:
+    # Collects per-stage timings, per-SDK-method call statistics and transaction counters for one run. Every
+    # method is safe to call from the worker threads used for portfolios, page prefetching and upserts.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current_call = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = datetime.now(timezone.utc)
+            self.start_time = time.perf_counter()
+            self.stages = defaultdict(StageStats)
+            self.api_calls = defaultdict(ApiCallStats)
+            self.counters = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name, items=0):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start_time, items)
+
+    def record_stage(self, name, duration_seconds, items=0):
+        with self.lock:
+            stats = self.stages[name]
+            stats.count += 1
+            stats.duration_seconds += duration_seconds
+            stats.items += items
+
+    def record_api_call(self, method, duration_seconds, request_items=0, response_items=0, error_status=None):
+        with self.lock:
+            stats = self.api_calls[method]
+            stats.calls += 1
+            stats.duration_seconds += duration_seconds
+            stats.request_items += request_items
+            stats.response_items += response_items
+            if error_status is not None:
+                stats.errors[str(error_status)] += 1
+
+    def record_retry(self, method):
+        with self.lock:
+            self.api_calls[method].retries += 1
+
+    def record_bytes(self, bytes_sent, bytes_received):
+        method = getattr(self.current_call, "method", None) or "unknown"
+        self.current_call.bytes_sent = self.get_thread_bytes_sent() + bytes_sent
+        with self.lock:
+            stats = self.api_calls[method]
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+
+    def get_thread_bytes_sent(self) -> int:
+        # Bytes sent on the wire by the calling thread, the difference before and after a call is what it sent
+        return getattr(self.current_call, "bytes_sent", 0)
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def to_report(self) -> dict:
+        with self.lock:
+            duration = time.perf_counter() - self.start_time
+            return {
+                "started_at": self.started_at.isoformat(),
+                "duration_seconds": round(duration, 3),
+                "counters": dict(self.counters),
+                "transactions_per_second": {
+                    counter: round(value / duration, 1) if duration else 0.0
+                    for counter, value in self.counters.items() if counter.startswith("transactions_")
+                },
+                "stages": {
+                    name: {"count": stats.count, "duration_seconds": round(stats.duration_seconds, 3),
+                           "items": stats.items}
+                    for name, stats in self.stages.items()
+                },
+                "api_calls": {
+                    method: {
+                        "calls": stats.calls, "errors": dict(stats.errors), "retries": stats.retries,
+                        "duration_seconds": round(stats.duration_seconds, 3),
+                        "mean_duration_seconds": round(stats.duration_seconds / stats.calls, 4) if stats.calls else 0,
+                        "request_items": stats.request_items, "response_items": stats.response_items,
+                        "bytes_sent": stats.bytes_sent, "bytes_received": stats.bytes_received,
+                    }
+                    for method, stats in self.api_calls.items()
+                },
+            }
+
+    def merge_report(self, report: dict):
+        # Folds in the report of a run made in another process, such as a date range shard
+        with self.lock:
+            for counter, value in report["counters"].items():
+                self.counters[counter] += value
+            for name, stage in report["stages"].items():
+                stats = self.stages[name]
+                stats.count += stage["count"]
+                stats.duration_seconds += stage["duration_seconds"]
+                stats.items += stage["items"]
+            for method, api_call in report["api_calls"].items():
+                stats = self.api_calls[method]
+                stats.calls += api_call["calls"]
+                stats.retries += api_call["retries"]
+                stats.duration_seconds += api_call["duration_seconds"]
+                stats.request_items += api_call["request_items"]
+                stats.response_items += api_call["response_items"]
+                stats.bytes_sent += api_call["bytes_sent"]
+                stats.bytes_received += api_call["bytes_received"]
+                for status, count in api_call["errors"].items():
+                    stats.errors[status] += count
+
+    def to_exposition(self, openmetrics=False) -> str:
+        # Prometheus text format for the node exporter textfile collector, or OpenMetrics. The two only differ in
+        # how counter families are named and in the closing EOF marker.
+        report = self.to_report()
+        api_calls = report["api_calls"]
+        families = [
+            ("commissions_run_duration_seconds", "gauge", [({}, report["duration_seconds"])]),
+            ("commissions_run_start_timestamp_seconds", "gauge", [({}, self.started_at.timestamp())]),
+            ("commissions_run_events", "counter", [
+                ({"event": counter}, value) for counter, value in report["counters"].items()
+            ]),
+            ("commissions_stage_duration_seconds", "counter", [
+                ({"stage": name}, stats["duration_seconds"]) for name, stats in report["stages"].items()
+            ]),
+            ("commissions_stage_items", "counter", [
+                ({"stage": name}, stats["items"]) for name, stats in report["stages"].items()
+            ]),
+            ("commissions_api_calls", "counter", [
+                ({"method": method, "outcome": "success"}, stats["calls"] - sum(stats["errors"].values()))
+                for method, stats in api_calls.items()
+            ] + [
+                ({"method": method, "outcome": status}, count)
+                for method, stats in api_calls.items() for status, count in stats["errors"].items()
+            ]),
+        ]
+        for family, field in (("commissions_api_call_duration_seconds", "duration_seconds"),
+                              ("commissions_api_retries", "retries"),
+                              ("commissions_api_bytes_sent", "bytes_sent"),
+                              ("commissions_api_bytes_received", "bytes_received")):
+            families.append((family, "counter", [
+                ({"method": method}, stats[field]) for method, stats in api_calls.items()
+            ]))
+
+        lines = []
+        for family, metric_type, samples in families:
+            sample_name = f"{family}_total" if metric_type == "counter" else family
+            lines.append(f"# TYPE {family if openmetrics else sample_name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+                lines.append(f"{sample_name}{{{label_text}}} {value}" if label_text else f"{sample_name} {value}")
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, report_path):
+        write_atomically(report_path, json.dumps(self.to_report(), indent=2))
+        logging.info(f"Written the run metrics report to {report_path}")
+
+    def write_prometheus_textfile(self, textfile_path, openmetrics=False):
+        # The node exporter textfile collector may read at any time, so the file is replaced in one step
+        write_atomically(textfile_path, self.to_exposition(openmetrics))
+        logging.info(f"Written the run metrics to {textfile_path}")
+
+
+def write_atomically(path, contents: str):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, "w") as temp_file:
+        temp_file.write(contents)
+    os.replace(temp_path, path)
+
+
+run_metrics = RunMetrics()
+
+_request_item_params = ("transaction_request", "request_body", "transaction_ids", "property_keys")
+
+
+class InstrumentedApi:
+    # Proxies a generated SDK api object, timing every public method call and recording it on the run metrics
+
+    def __init__(self, api, metrics: RunMetrics = run_metrics):
+        self._api = api
+        self._metrics = metrics
+        self._api_name = type(api).__name__
+
+    def __getattr__(self, name):
+        attribute = getattr(self._api, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        method = f"{self._api_name}.{name}"
+
+        def instrumented_call(*args, **kwargs):
+            request_items = sum(
+                len(kwargs[param]) for param in _request_item_params if isinstance(kwargs.get(param), (list, dict))
+            )
+            self._metrics.current_call.method = method
+            start_time = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception as e:
+                self._metrics.record_api_call(
+                    method, time.perf_counter() - start_time, request_items, error_status=getattr(e, "status", "error")
+                )
+                raise
+            finally:
+                self._metrics.current_call.method = None
+
+            values = getattr(result, "values", None)
+            response_items = len(values) if isinstance(values, list) else 0
+            self._metrics.record_api_call(method, time.perf_counter() - start_time, request_items, response_items)
+            return result
+
+        instrumented_call.__name__ = name
+        instrumented_call.metric_name = method
+        return instrumented_call
+
+
+def get_body_bytes(body) -> int:
+    # The JSON bodies of the SDK are sent as str, encoded to UTF-8 on the wire
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return len(body) if isinstance(body, bytes) else 0
+
+
+def get_response_bytes(response) -> int:
+    # urllib3 counts the bytes read off the wire before it decompresses a gzipped response. The response has been
+    # read in full unless it was requested without preloading its content, when only its Content-Length is known.
+    wire_bytes = response.tell() if hasattr(response, "tell") else 0
+    if not wire_bytes:
+        headers = getattr(response, "headers", None) or {}
+        wire_bytes = int(headers.get("Content-Length") or 0)
+    return wire_bytes
+
+
+class InstrumentedApiClientFactory:
+    # Wraps an ApiClientFactory so every api it builds is instrumented. Where the factory exposes the generated
+    # client's connection pool, the bytes sent and received on the wire are recorded as well. Without sdk_retries
+    # the apis are built straight from that client, leaving out the retries the SDK's factory wraps them in.
+
+    def __init__(self, api_factory, metrics: RunMetrics = run_metrics, sdk_retries=True):
+        self.api_factory = api_factory
+        self.metrics = metrics
+        self.sdk_retries = sdk_retries
+        self.apis = {}
+        self._instrument_pool_manager()
+
+    def _instrument_pool_manager(self):
+        rest_client = getattr(getattr(self.api_factory, "api_client", None), "rest_client", None)
+        pool_manager = getattr(rest_client, "pool_manager", None)
+        if pool_manager is None or getattr(pool_manager, "instrumented", False):
+            return
+
+        pool_request = pool_manager.request
+        metrics = self.metrics
+
+        def instrumented_request(method, url, *args, **kwargs):
+            response = pool_request(method, url, *args, **kwargs)
+            metrics.record_bytes(get_body_bytes(kwargs.get("body")), get_response_bytes(response))
+            return response
+
+        pool_manager.request = instrumented_request
+        pool_manager.instrumented = True
+
+    def build(self, api_class):
+        # Apis share the factory's client, so one of each is built and reused by every caller and thread
+        api = self.apis.get(api_class)
+        if api is None:
+            api_client = getattr(self.api_factory, "api_client", None)
+            if self.sdk_retries or api_client is None:
+                api = self.api_factory.build(api_class)
+            else:
+                api = build_api_without_sdk_retries(api_client, api_class)
+            api = self.apis.setdefault(api_class, InstrumentedApi(api, self.metrics))
+        return api
+
+    def __getattr__(self, name):
+        return getattr(self.api_factory, name)
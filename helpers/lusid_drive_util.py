@@ -1,29 +1,158 @@
+import fcntl
+import hashlib
 import json
+import logging
 import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
 
 import lusid_drive
 
-drive_api_factory = lusid_drive.utilities.ApiClientFactory(
-    app_name="get_files_from_drive",
-    api_secrets_filename=os.getenv("FBN_SECRETS_PATH")
-)
+from helpers.api_clients import configure_api_client
+from helpers.instrumentation import InstrumentedApi
 
-file_api = drive_api_factory.build(lusid_drive.FilesApi)
-folder_api = drive_api_factory.build(lusid_drive.FoldersApi)
-search_api = drive_api_factory.build(lusid_drive.SearchApi)
 
+_drive_client_options = {}
+_drive_apis = {}
 
-def get_file_from_drive(directory_path, input_file_name):
+
+def configure_drive_client(token=None, pool_size=None):
+    # Drive is called with the refreshing token of the LUSID client when there is one, so the process holds a single
+    # token that is refreshed in one place. Takes effect for the Drive client built next.
+    _drive_client_options.update(token=token, pool_size=pool_size)
+    get_drive_api_factory.cache_clear()
+    _drive_apis.clear()
+
+
+@lru_cache(maxsize=None)
+def get_drive_api_factory():
+    # Built on first use so that importing this module does not create a Drive client
+    token = _drive_client_options.get("token")
+    api_factory = lusid_drive.utilities.ApiClientFactory(
+        app_name="get_files_from_drive",
+        api_secrets_filename=os.getenv("FBN_SECRETS_PATH"),
+        tcp_keep_alive=True,
+        **({"token": token} if token is not None else {})
+    )
+    configure_api_client(api_factory.api_client, _drive_client_options.get("pool_size"))
+    return api_factory
+
+
+def get_drive_api(api_class):
+    if api_class not in _drive_apis:
+        _drive_apis[api_class] = InstrumentedApi(get_drive_api_factory().build(api_class))
+    return _drive_apis[api_class]
+
+
+def find_file_in_drive(directory_path, input_file_name):
     if not directory_path.startswith("/"):
         directory_path = "/" + directory_path
     search_body = lusid_drive.SearchBody(directory_path, input_file_name)
-    response = search_api.search(search_body)
+    response = get_drive_api(lusid_drive.SearchApi).search(search_body)
     if len(response.values) == 0:
         raise FileNotFoundError(f"The file with name {input_file_name} in the directory {directory_path} "
                                 f"has not been found in Lusid Drive")
-    file_id = response.values[0].id
 
-    return file_api.download_file(file_id)
+    return response.values[0]
+
+
+def get_file_from_drive(directory_path, input_file_name):
+    file_id = find_file_in_drive(directory_path, input_file_name).id
+
+    return get_drive_api(lusid_drive.FilesApi).download_file(file_id)
+
+
+def get_default_cache_dir():
+    return os.getenv(
+        "FBN_COMMISSIONS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "commissions-booking-script")
+    )
+
+
+@contextmanager
+def cache_lock(cache_dir):
+    # Serialises refreshes between processes on the same node sharing the cache directory
+    with open(os.path.join(cache_dir, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_cache_index(cache_dir) -> dict:
+    try:
+        with open(os.path.join(cache_dir, "index.json")) as index_file:
+            return json.load(index_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_cache_index(cache_dir, index: dict):
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as index_file:
+        json.dump(index, index_file, indent=2)
+    os.replace(temp_path, os.path.join(cache_dir, "index.json"))
+
+
+def get_cached_file_from_drive(directory_path, input_file_name, cache_dir=None, ttl_seconds=3600, offline=False):
+    # Files are stored under their Drive id and version, within the TTL the cached copy is used without calling
+    # Drive, after it the file is only downloaded again if Drive reports a different id or version
+    cache_dir = cache_dir or get_default_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_key = f"{directory_path.strip('/')}/{input_file_name}"
+
+    with cache_lock(cache_dir):
+        index = read_cache_index(cache_dir)
+        entry = index.get(cache_key)
+        if entry and not os.path.exists(entry["path"]):
+            entry = None
+
+        if offline:
+            if not entry:
+                raise FileNotFoundError(f"There is no cached copy of {cache_key} in {cache_dir} to use offline")
+            logging.info(f"Offline mode, using the cached copy of {cache_key} from {entry['fetched_at']}")
+            return entry["path"]
+
+        if entry and time.time() - entry["checked_at"] < ttl_seconds:
+            logging.info(f"Using the cached copy of {cache_key}")
+            return entry["path"]
+
+        storage_object = find_file_in_drive(directory_path, input_file_name)
+        version = str(storage_object.updated_on.isoformat()) if storage_object.updated_on else ""
+        if entry and entry["file_id"] == storage_object.id and entry["version"] == version:
+            logging.info(f"The cached copy of {cache_key} is up to date with Drive")
+        else:
+            downloaded_path = get_drive_api(lusid_drive.FilesApi).download_file(storage_object.id)
+            version_hash = hashlib.sha256(version.encode()).hexdigest()[:16]
+            file_extension = os.path.splitext(input_file_name)[1]
+            cached_path = os.path.join(cache_dir, f"{storage_object.id}-{version_hash}{file_extension}")
+            shutil.move(downloaded_path, cached_path)
+            logging.info(f"Downloaded {cache_key} version '{version}' from Drive")
+
+            entry = {"file_id": storage_object.id, "version": version, "path": cached_path,
+                     "fetched_at": datetime.now(timezone.utc).isoformat()}
+
+        entry["checked_at"] = time.time()
+        replaced_entry = index.get(cache_key)
+        index[cache_key] = entry
+        write_cache_index(cache_dir, index)
+        # The copy of the version replaced is removed once the index no longer points at it, still under the lock
+        if replaced_entry and replaced_entry["path"] not in {cached["path"] for cached in index.values()}:
+            remove_cached_file(replaced_entry["path"])
+        return entry["path"]
+
+
+def remove_cached_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    else:
+        logging.info(f"Removed the replaced cached copy {path}")
 
 
 def main():
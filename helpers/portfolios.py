@@ -0,0 +1,150 @@
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import lusid
+from lusid import models
+
+from helpers.utilities import call_with_retry
+
+
+def parse_portfolio_id(portfolio_id: str) -> tuple:
+    split_id = portfolio_id.split("/")
+    if len(split_id) != 2 or not all(split_id):
+        raise ValueError(f"Invalid Value: {portfolio_id}. The portfolio must be given as 'scope/code'!")
+
+    return split_id[0], split_id[1]
+
+
+class IndexedPortfolio:
+    # The parts of a portfolio the script reads, with the properties keyed by property key whichever endpoint
+    # returned them
+    __slots__ = ("scope", "code", "created", "properties")
+
+    def __init__(self, scope, code, created, properties: dict):
+        self.scope = scope
+        self.code = code
+        self.created = created
+        self.properties = properties
+
+
+class PortfolioIndex:
+    # Portfolios resolved in bulk with the property keys the run needs, keyed by (scope, code), so that a run over
+    # many portfolios needs a handful of paged listing calls rather than a get_portfolio call for each one
+
+    def __init__(self, property_keys: list):
+        self.property_keys = property_keys
+        self.portfolios = {}
+
+    def add(self, portfolio):
+        properties = portfolio.properties or {}
+        if isinstance(properties, list):
+            properties = {model_property.key: model_property for model_property in properties}
+        properties = {key: value for key, value in properties.items() if key in self.property_keys}
+        self.portfolios[(portfolio.id.scope, portfolio.id.code)] = IndexedPortfolio(
+            portfolio.id.scope, portfolio.id.code, portfolio.created, properties
+        )
+
+    def get(self, scope, portfolio_code):
+        return self.portfolios.get((scope, portfolio_code))
+
+    def ids(self) -> list:
+        return list(self.portfolios)
+
+    def __len__(self):
+        return len(self.portfolios)
+
+    def add_scope(self, api_factory, scope, page_size=1000, portfolio_filter=None) -> list:
+        portfolios_api = api_factory.build(lusid.api.PortfoliosApi)
+
+        portfolio_ids = []
+        page = None
+        while True:
+            kwargs = {"page": page} if page else {}
+            if portfolio_filter:
+                kwargs["filter"] = portfolio_filter
+            response, _ = call_with_retry(
+                portfolios_api.list_portfolios_for_scope, scope=scope, limit=page_size,
+                property_keys=self.property_keys, **kwargs
+            )
+            for portfolio in response.values:
+                self.add(portfolio)
+                portfolio_ids.append((portfolio.id.scope, portfolio.id.code))
+
+            page = response.next_page
+            if not page:
+                logging.info(f"Indexed {len(portfolio_ids)} portfolios in scope '{scope}'"
+                             + (" matching the requested codes" if portfolio_filter else ""))
+                return portfolio_ids
+
+    def add_group(self, api_factory, group_scope, group_code) -> list:
+        # The expansion already includes the portfolios of every sub group, they are walked in case a portfolio
+        # only appears under a sub group
+        response, _ = call_with_retry(
+            api_factory.build(lusid.api.PortfolioGroupsApi).get_portfolio_group_expansion,
+            scope=group_scope, code=group_code, property_filter=self.property_keys
+        )
+
+        portfolio_ids = []
+        groups = [response]
+        while groups:
+            group = groups.pop()
+            for portfolio in group.values or []:
+                self.add(portfolio)
+                portfolio_ids.append((portfolio.id.scope, portfolio.id.code))
+            groups.extend(group.sub_groups or [])
+
+        portfolio_ids = list(dict.fromkeys(portfolio_ids))
+        logging.info(f"Indexed {len(portfolio_ids)} portfolios in portfolio group '{group_scope}/{group_code}'")
+        return portfolio_ids
+
+
+def index_requested_portfolios(api_factory, portfolio_index: PortfolioIndex, portfolio_ids: list,
+                               min_portfolios_per_scope=5, codes_per_listing=100):
+    # The listing is filtered on the requested codes so that a large scope is never listed whole for a few of its
+    # portfolios. A scope with only a few requested portfolios, and any code a filter cannot quote, is left to
+    # get_portfolio calls.
+    scope_codes = defaultdict(list)
+    for scope, code in portfolio_ids:
+        if portfolio_index.get(scope, code) is None and "'" not in code:
+            scope_codes[scope].append(code)
+    for scope, codes in scope_codes.items():
+        if len(codes) < min_portfolios_per_scope:
+            continue
+        for i in range(0, len(codes), codes_per_listing):
+            portfolio_filter = "id.code in " + ", ".join(f"'{code}'" for code in codes[i:i + codes_per_listing])
+            portfolio_index.add_scope(api_factory, scope, portfolio_filter=portfolio_filter)
+
+
+def get_watermark(portfolio, watermark_property):
+    watermark = (portfolio.properties or {}).get(watermark_property)
+    if not watermark:
+        return None
+
+    # Watermarks stored without an offset, before they were kept in UTC, were set in local time
+    return datetime.fromisoformat(watermark.value.label_value).astimezone(timezone.utc)
+
+
+def set_watermark(api_factory, scope, portfolio_code, watermark_property, watermark: datetime, portfolio=None):
+    # The portfolio held in memory, if given, is moved on too so a long running service need not fetch it again
+    watermark = watermark.astimezone(timezone.utc)
+    watermark_value = models.ModelProperty(
+        key=watermark_property, value=models.PropertyValue(label_value=watermark.isoformat())
+    )
+    call_with_retry(
+        api_factory.build(lusid.api.PortfoliosApi).upsert_portfolio_properties,
+        scope=scope, code=portfolio_code, request_body={watermark_property: watermark_value}
+    )
+    if portfolio is not None:
+        portfolio.properties = {**(portfolio.properties or {}), watermark_property: watermark_value}
+    logging.info(f"Moved the commission watermark for '{scope}/{portfolio_code}' to {watermark.isoformat()}")
+
+
+def has_commands_since(api_factory, scope, portfolio_code, from_as_at: datetime, own_commands=0) -> bool:
+    # Every change to a portfolio, upserted transactions included, is recorded as a command stamped with its asAt.
+    # The commands the script made itself since from_as_at are passed in, any beyond those were made by others.
+    response, _ = call_with_retry(
+        api_factory.build(lusid.api.PortfoliosApi).get_portfolio_commands, scope=scope, code=portfolio_code,
+        from_as_at=from_as_at, limit=own_commands + 1
+    )
+    return len(response.values or []) > own_commands
@@ -0,0 +1,116 @@
+import json
+import logging
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from helpers.instrumentation import run_metrics
+
+
+class CommissionService:
+    # Calls poll_once every poll_interval seconds until stopped. Whatever poll_once closes over, the api factory, the
+    # compiled commission config and the portfolio index, stays warm between polls. A poll in progress is always
+    # finished before the service stops, so no upsert is cut off half way.
+
+    def __init__(self, poll_once, poll_interval=30.0):
+        self.poll_once = poll_once
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+        self.started_at = time.time()
+        self.polls = 0
+        self.polling = False
+        self.last_poll_finished_at = None
+        self.last_poll_duration_seconds = None
+        self.last_poll_error = None
+        self.last_summaries = []
+
+    def stop(self):
+        if not self.stopping.is_set():
+            logging.info("Stopping after the poll in progress")
+        self.stopping.set()
+
+    def install_signal_handlers(self):
+        # Signal handlers can only be installed from the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signal_number, lambda *_: self.stop())
+
+    def run(self):
+        logging.info(f"Polling for new transactions every {self.poll_interval}s")
+        while not self.stopping.is_set():
+            start_time = time.perf_counter()
+            self.polling = True
+            try:
+                self.last_summaries = self.poll_once()
+                self.last_poll_error = None
+            except Exception as e:
+                # A poll failing, for example while LUSID is unavailable, is retried at the next interval
+                logging.exception("Failed to poll for new transactions")
+                self.last_poll_error = str(e)
+            finally:
+                self.polling = False
+            duration = time.perf_counter() - start_time
+            self.polls += 1
+            self.last_poll_finished_at = time.time()
+            self.last_poll_duration_seconds = round(duration, 3)
+            run_metrics.increment("service_polls")
+            run_metrics.record_stage("poll", duration)
+
+            self.stopping.wait(max(self.poll_interval - duration, 0))
+        logging.info(f"Stopped after {self.polls} polls")
+
+    def get_health(self) -> tuple:
+        # The service is live while it is polling or polled recently. It is degraded rather than down when the last
+        # poll failed or left portfolios failed, restarting it would not help with either.
+        last_activity = self.last_poll_finished_at or self.started_at
+        live = not self.stopping.is_set() and (
+            self.polling or time.time() - last_activity <= 3 * self.poll_interval + 60
+        )
+        failed_portfolios = [
+            f"{summary['scope']}/{summary['portfolio_code']}"
+            for summary in self.last_summaries or [] if summary["status"] == "failed"
+        ]
+        if not live:
+            status = "stopping" if self.stopping.is_set() else "stalled"
+        else:
+            status = "degraded" if self.last_poll_error or failed_portfolios else "ok"
+        return live, {
+            "status": status, "polls": self.polls, "polling": self.polling,
+            "last_poll_finished_at": self.last_poll_finished_at,
+            "last_poll_duration_seconds": self.last_poll_duration_seconds, "last_poll_error": self.last_poll_error,
+            "failed_portfolios": failed_portfolios,
+        }
+
+
+def start_health_server(service: CommissionService, port, host="0.0.0.0") -> ThreadingHTTPServer:
+    # Serves /healthz for liveness probes and /metrics for Prometheus to scrape, from a background thread
+
+    class HealthRequestHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == "/healthz":
+                live, health = service.get_health()
+                self.respond(200 if live else 503, "application/json", json.dumps(health))
+            elif self.path == "/metrics":
+                self.respond(200, "text/plain; version=0.0.4", run_metrics.to_exposition())
+            else:
+                self.respond(404, "text/plain", "Not found\n")
+
+        def respond(self, status, content_type, body: str):
+            encoded = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+
+        def log_message(self, format, *args):
+            logging.debug(f"Health server: {format % args}")
+
+    server = ThreadingHTTPServer((host, port), HealthRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="health-server", daemon=True).start()
+    logging.info(f"Serving /healthz and /metrics on port {server.server_address[1]}")
+    return server
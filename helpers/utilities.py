@@ -1,13 +1,20 @@
-import json
 import logging
 import os
+import random
 import sys
+import threading
+import time
+import weakref
 
 import lusid
 import lusid.models as models
+import urllib3
 from lusid import ApiException
 from lusidtools.cocoon.transaction_type_upload import create_transaction_type_configuration
 
+from helpers.commission_rates import get_commission_rate_table
+from helpers.instrumentation import run_metrics
+
 
 def check_or_create_property(api_factory, property_key):
     split_prop = property_key.split("/")
@@ -27,15 +34,45 @@ def check_or_create_property(api_factory, property_key):
     )
 
     try:
-        api_factory.build(lusid.api.PropertyDefinitionsApi).create_property_definition(
+        call_with_retry(
+            api_factory.build(lusid.api.PropertyDefinitionsApi).create_property_definition,
             create_property_definition_request=prop_def_req
         )
     except ApiException:
         logging.info(f"Property definition {domain}/{scope}/{code} already exists.")
 
 
+# Held weakly so that a factory garbage collected after its run is forgotten rather than its id, which a new factory
+# may be given, being taken as already checked
+_ready_environments = weakref.WeakSet()
+_environment_lock = threading.Lock()
+
+
+def ensure_environment_ready(api_factory, property_keys: list):
+    # Checks the property definitions and commission transaction type exist once per api factory, creating only
+    # the ones which are missing
+    with _environment_lock:
+        if api_factory in _ready_environments:
+            return
+
+        existing_definitions, _ = call_with_retry(
+            api_factory.build(lusid.api.PropertyDefinitionsApi).get_multiple_property_definitions,
+            property_keys=property_keys
+        )
+        existing_keys = {definition.key for definition in existing_definitions.values}
+        for property_key in property_keys:
+            if property_key not in existing_keys:
+                logging.info(f"Creating missing property definition {property_key}")
+                check_or_create_property(api_factory, property_key)
+
+        create_commission_txn_type(api_factory)
+        _ready_environments.add(api_factory)
+
+
 def create_commission_txn_type(api_factory):
-    create_transaction_type_configuration(
+    # Lists the transaction types before creating any that are missing, so is safe to call again
+    call_with_retry(
+        create_transaction_type_configuration,
         api_factory,
         alias=models.TransactionConfigurationTypeAlias(
             type="Commission",
@@ -56,37 +93,92 @@ def create_commission_txn_type(api_factory):
     )
 
 
-def get_commission_rate_from_lookup(country, broker, entity):
-    config_file_path = os.getenv("FBN_COMMISSIONS_CONFIG_PATH")
-    if not config_file_path:
-        raise FileNotFoundError(f"The file {config_file_path} does not exist")
+def get_commission_rate_from_lookup(country, broker, entity, transaction_type="*", instrument="*", notional=0.0):
+    return get_commission_rate_table().get_rate(
+        country, broker, entity, transaction_type=transaction_type, instrument=instrument, notional=notional
+    )
 
-    with open(config_file_path, 'r') as json_file_contents:
-        mapping = json_file_contents.read()
-        mapping = json.loads(mapping)
 
-    if len(mapping.keys()) == 0:
-        raise ValueError(f"The no mapping config found in the {config_file_path} path")
+def is_retryable_error(error) -> bool:
+    # Throttling and server side errors are worth retrying, client errors will fail again
+    if isinstance(error, ApiException):
+        return error.status is None or error.status == 429 or error.status >= 500
+    return isinstance(error, (ConnectionError, TimeoutError, urllib3.exceptions.HTTPError))
 
+
+def get_retry_after_seconds(error):
+    headers = getattr(error, "headers", None)
+    if not headers:
+        return None
     try:
-        mapping[country][broker][entity]
-    except KeyError:
-        logging.info(f"The mapping file contents are: \n {mapping}\n")
-        logging.info("One of the following values does not match the mapping config")
-        logging.info(f"Country: {country}")
-        logging.info(f"Broker: {broker}")
-        logging.info(f"Entity: {entity}")
-        # A transaction of 0 units will be created and the user will be warned that a mapping value has failed (TODO).
-        return 0
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
 
-    return mapping[country][broker][entity]
+def call_with_retry(func, *args, max_attempts=5, base_delay=1.0, max_delay=30.0, on_retry=None, **kwargs):
+    # Returns the result of the call along with the number of attempts it took. on_retry is called with each error
+    # that is retried.
+    attempt = 1
+    while True:
+        try:
+            return func(*args, **kwargs), attempt
+        except Exception as e:
+            if attempt >= max_attempts or not is_retryable_error(e):
+                e.attempts = attempt
+                raise
 
+            delay = get_retry_after_seconds(e)
+            if delay is None:
+                delay = min(max_delay, base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            run_metrics.record_retry(getattr(func, "metric_name", getattr(func, "__name__", "unknown")))
+            if on_retry:
+                on_retry(e)
+            logging.warning(f"Attempt {attempt} of {max_attempts} failed with '{getattr(e, 'status', e)}'. "
+                            f"Retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+class TransactionLogSampler:
+    # Per-transaction detail is only logged at DEBUG, and then only for one in every `sample_every` transactions
+
+    def __init__(self, sample_every=1):
+        self.sample_every = sample_every
+
+    def get_sample_every(self) -> int:
+        # Checked once per page or portfolio so the hot loop only pays for an integer comparison
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return 0
+        return max(self.sample_every, 1)
+
+
+transaction_log_sampler = TransactionLogSampler()
+
+
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+
+def setup_logging(level=None, log_format='%(levelname)s %(asctime)s - %(message)s', sample_every=None):
+    # Safe to call more than once, the handler added by a previous call is reconfigured rather than duplicated
+    if level is None:
+        level = os.getenv("FBN_LOG_LEVEL", "INFO")
+    if isinstance(level, str):
+        if level.upper() not in LOG_LEVELS:
+            raise ValueError(f"Invalid logging level {level}, expected one of {', '.join(LOG_LEVELS)}")
+        level = logging.getLevelName(level.upper())
+    if sample_every is not None:
+        transaction_log_sampler.sample_every = sample_every
 
-def setup_logging():
     root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    stdout_handler.setLevel(logging.INFO)
-    logging_formatter = logging.Formatter('%(levelname)s %(asctime)s - %(message)s')
+    root_logger.setLevel(level)
+    stdout_handler = next(
+        (handler for handler in root_logger.handlers if getattr(handler, "is_commissions_handler", False)), None
+    )
+    if stdout_handler is None:
+        stdout_handler = logging.StreamHandler(sys.stdout)
+        stdout_handler.is_commissions_handler = True
+        root_logger.addHandler(stdout_handler)
+    stdout_handler.setLevel(level)
+    logging_formatter = logging.Formatter(log_format)
     stdout_handler.setFormatter(logging_formatter)
-    root_logger.addHandler(stdout_handler)
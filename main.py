@@ -1,105 +1,796 @@
 import argparse
+import asyncio
+import json
 import logging
 import os
 import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
 
 import lusid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
-from helpers.lusid_drive_util import get_file_from_drive
-from helpers.utilities import check_or_create_property, create_commission_txn_type, setup_logging
-from transaction_helpers.transaction_processing import get_transaction_requests_from_input_transactions
-from transaction_helpers.transaction_retrieval import get_input_transactions
+from helpers.api_clients import compress_request_bodies, configure_api_client, get_access_token, get_pool_manager
+from helpers.checkpoints import PageCheckpointTracker, WindowCheckpoint, open_checkpoint_journal
+from helpers.commission_rates import get_commission_rate_table
+from helpers.instrument_countries import InstrumentCountryCache
+from helpers.instrumentation import InstrumentedApiClientFactory, run_metrics
+from helpers.lusid_drive_util import configure_drive_client, get_cached_file_from_drive, get_default_cache_dir
+from helpers.portfolios import (
+    PortfolioIndex, get_watermark, has_commands_since, index_requested_portfolios, parse_portfolio_id,
+    set_watermark
+)
+from helpers.service import CommissionService, start_health_server
+from helpers.utilities import LOG_LEVELS, call_with_retry, ensure_environment_ready, setup_logging
+from transaction_helpers.async_pipeline import run_commission_pipeline
+from transaction_helpers.batch_controller import AdaptiveBatchController
+from transaction_helpers.columnar_processing import get_commission_batch, iter_transaction_requests_from_batch
+from transaction_helpers.sharding import run_sharded, shutdown_shard_executor
+from transaction_helpers.transaction_cancellation import (
+    cancel_transactions, drop_live_inputs, find_orphaned_commissions
+)
+from transaction_helpers.transaction_processing import (
+    get_commission_fingerprints, iter_transaction_requests_from_input_transactions, log_counts, summarise_counts
+)
+from transaction_helpers.transaction_retrieval import get_transaction_record_pages
+from transaction_helpers.transaction_snapshots import (
+    iter_commission_snapshot_pages, iter_transaction_snapshot_pages, read_snapshot_header, write_commission_snapshot,
+    write_transaction_snapshot
+)
 from transaction_helpers.transaction_upsertion import upsert_transactions
 import constants as const
 
 setup_logging()
 
 
+def compute_page_commissions(page, entity, broker, existing_commissions, counts, columnar=False,
+                             instrument_countries=None):
+    if columnar:
+        batch = get_commission_batch(
+            page, const.COUNTRY_PROPERTY, entity, broker, get_commission_rate_table(), counts, instrument_countries
+        )
+        return iter_transaction_requests_from_batch(batch, existing_commissions, counts)
+    return iter_transaction_requests_from_input_transactions(
+        page, const.COUNTRY_PROPERTY, entity, broker, existing_commissions, counts, instrument_countries
+    )
+
+
 def check_or_create_commission_transactions(scope, portfolio_code, end_date: str, start_date: str, api_factory,
-                                            entity, broker):
+                                            entity, broker, counts=None, columnar=False, use_async=False,
+                                            instrument_countries=None, shards=1, shard_processes=None,
+                                            resume=False, **upsert_kwargs):
     logging.info(f"Beginning to process portfolio with scope '{scope}' and portfolio code '{portfolio_code}'")
     logging.info(f"The 'to' date is '{end_date}' and 'from' date is '{start_date}'")
     logging.info(f"The broker is '{broker}' and entity is '{entity}'")
 
-    input_transactions = get_input_transactions(
-        api_factory, scope, portfolio_code, end_date, start_date, const.INPUT_TXN_FILTER, [const.COUNTRY_PROPERTY]
-    )
+    if counts is None:
+        counts = Counter()
 
-    transaction_requests = get_transaction_requests_from_input_transactions(input_transactions, const.COUNTRY_PROPERTY, entity, broker)
+    if shards > 1:
+        build_api_factory = partial(create_api_factory, *getattr(api_factory, "client_options", ()))
+        report, shard_counts = run_sharded(
+            check_or_create_commission_transactions, build_api_factory, scope, portfolio_code, end_date, start_date,
+            entity, broker, shards, shard_processes, columnar=columnar, use_async=use_async,
+            instrument_countries=instrument_countries, resume=resume, **upsert_kwargs
+        )
+        counts.update(shard_counts)
+        log_counts(scope, portfolio_code, counts)
+        logging.info(f"Upserted {report.upserted_count} transactions for '{scope}/{portfolio_code}' from "
+                     f"{shards} date ranges in {report.duration_seconds:.2f}s "
+                     f"({report.transactions_per_second:.0f} txn/s), {len(report.failed_transaction_ids)} failed")
+        return report
 
-    response = upsert_transactions(api_factory, scope, portfolio_code, transaction_requests)
+    with run_metrics.stage("existing_commissions"):
+        existing_commission_pages = get_transaction_record_pages(
+            api_factory, scope, portfolio_code, end_date, start_date, const.COMMISSION_TXN_FILTER,
+            linking_prop=const.LINKING_PROPERTY
+        )
+        existing_commissions = get_commission_fingerprints(chain.from_iterable(existing_commission_pages))
+    logging.info(f"Found {len(existing_commissions)} commission transactions already booked")
 
-    # Handle failed transaction upserts here
-    logging.info(f"Upserted transactions.")
-    logging.info("Transaction updated/created")
+    if use_async:
+        report = asyncio.run(run_commission_pipeline(
+            api_factory, scope, portfolio_code, end_date, start_date, const.INPUT_TXN_FILTER, const.COUNTRY_PROPERTY,
+            entity, broker, existing_commissions, counts, columnar, instrument_countries=instrument_countries,
+            **upsert_kwargs
+        ))
+    else:
+        # Pages whose commissions have all been upserted are journaled, so a resumed run fetches from the page after
+        # the last one committed
+        journal, last_commit = open_checkpoint_journal(scope, portfolio_code, start_date, end_date, resume)
+        start_page = last_commit["next_page"] if last_commit else None
+        if last_commit:
+            logging.info(f"Resuming '{scope}/{portfolio_code}' after page {last_commit['page_number']}")
 
+        def compute_page(page):
+            page_countries = None
+            if instrument_countries is not None:
+                page_countries = instrument_countries.prefetch(
+                    api_factory, [record.instrument_uid for record in page]
+                )
+            # Timed apart from the fetch of the page and its countries, which the upserts wait on too
+            with run_metrics.stage("compute_requests", len(page)):
+                return list(compute_page_commissions(
+                    page, entity, broker, existing_commissions, counts, columnar, page_countries
+                ))
 
-def main(argv):
-    ap = argparse.ArgumentParser(description="Get arguments from command line")
-    ap.add_argument('-s', '--scope', help='Scope of the data being uploaded', required=True)
-    ap.add_argument('-c', '--portfolio-code', required=True)
-    ap.add_argument('-dt', '--datetime-iso', help="must be in iso format",
-                    default=str(datetime.today().astimezone().isoformat()))
-    ap.add_argument('-d', '--days-going-back')
+        try:
+            if last_commit and not start_page:
+                # Every page of the window was committed before the previous run stopped
+                input_transaction_pages = iter(())
+            else:
+                # Transactions only need decorating with the country when it is not resolved through the instrument
+                # cache
+                input_transaction_pages = get_transaction_record_pages(
+                    api_factory, scope, portfolio_code, end_date, start_date, const.INPUT_TXN_FILTER,
+                    country_prop=None if instrument_countries is not None else const.COUNTRY_PROPERTY,
+                    start_page=start_page, with_next_page=True
+                )
+            tracker = PageCheckpointTracker(journal, last_commit["page_number"] + 1 if last_commit else 1)
+            transaction_requests = tracker.track_pages(input_transaction_pages, compute_page)
 
-    args = vars(ap.parse_args(args=argv[1:]))
-    scope = args["scope"]
-    portfolio_code = args["portfolio_code"]
-    datetime_iso = args["datetime_iso"]
-    days_going_back = args["days_going_back"]
+            report = upsert_transactions(
+                api_factory, scope, portfolio_code, transaction_requests, on_batch_done=tracker.batch_done,
+                **upsert_kwargs
+            )
+        finally:
+            if journal:
+                journal.close()
+        if journal and not report.failed_transaction_ids:
+            journal.complete()
+    run_metrics.increment("transactions_unchanged", counts["unchanged"])
+    run_metrics.increment("transactions_missing_country", counts["missing_country"])
+    log_counts(scope, portfolio_code, counts)
 
-    api_factory = lusid.utilities.ApiClientFactory(
+    if report.failed_transaction_ids:
+        logging.error(f"Failed to upsert {len(report.failed_transaction_ids)} commission transactions: "
+                      f"{report.failed_transaction_ids}")
+    logging.info("Transaction updated/created")
+    return report
+
+
+def create_api_factory(pool_size=None, gzip_requests=False):
+    # One client per process, every api built from it shares its connection pool and refreshing token
+    lusid_api_factory = lusid.utilities.ApiClientFactory(
         app_name="commissions-script",
-        api_secrets_filename=os.getenv("FBN_SECRETS_PATH")
+        api_secrets_filename=os.getenv("FBN_SECRETS_PATH"),
+        tcp_keep_alive=True
     )
-    create_commission_txn_type(api_factory)
+    configure_api_client(getattr(lusid_api_factory, "api_client", None), pool_size)
+    # Calls are retried by call_with_retry alone. The SDK's retries on a 429 would hide the throttling from the
+    # adaptive batching and multiply the attempts.
+    api_factory = InstrumentedApiClientFactory(lusid_api_factory, sdk_retries=False)
+    # Compression wraps the instrumented pool so the bytes recorded as sent are those on the wire
+    if gzip_requests:
+        compress_request_bodies(get_pool_manager(api_factory))
+    # Kept so that date range shards build their clients in other processes the same way
+    api_factory.client_options = (pool_size, gzip_requests)
+    return api_factory
+
+
+def get_portfolio_window(portfolio, datetime_iso, days_going_back) -> tuple:
+    # A date given without an offset is taken as local time. The window is kept in UTC, as is the watermark it is
+    # compared with.
+    end_date = datetime.fromisoformat(datetime_iso) if datetime_iso else datetime.today()
+    end_date = end_date.astimezone(timezone.utc)
+    end_date_formatted = str(end_date.isoformat())
+
+    start_date = portfolio.created
+    if days_going_back:
+        start_date = end_date + timedelta(days=-int(days_going_back))
+    start_date_formatted = str(start_date.astimezone(timezone.utc).isoformat())
+
+    return end_date_formatted, start_date_formatted
+
+
+def get_portfolio(api_factory, scope, portfolio_code, portfolio_index=None):
+    # Get portfolio property values, from the bulk index where the portfolio was resolved up front
+    portfolio = portfolio_index.get(scope, portfolio_code) if portfolio_index else None
+    if portfolio is None:
+        portfolio, _ = call_with_retry(
+            api_factory.build(lusid.api.PortfoliosApi).get_portfolio, scope=scope, code=portfolio_code,
+            property_keys=const.PORTFOLIO_PROPERTIES
+        )
+        if portfolio_index is not None:
+            portfolio_index.add(portfolio)
+            portfolio = portfolio_index.get(scope, portfolio_code)
+    return portfolio
+
+
+def process_portfolio(api_factory, scope, portfolio_code, datetime_iso, days_going_back, full_rebuild=False,
+                      portfolio_index=None, resume=False, watermark_lookback_days=0, **processing_kwargs) -> dict:
+    summary = {"scope": scope, "portfolio_code": portfolio_code}
+    start_time = time.perf_counter()
+    try:
+        portfolio = get_portfolio(api_factory, scope, portfolio_code, portfolio_index)
+        entity_prop_value = portfolio.properties[const.ENTITY_PROPERTY].value.label_value
+        broker_prop_value = portfolio.properties[const.BROKER_PROPERTY].value.label_value
+
+        end_date_formatted, start_date_formatted = get_portfolio_window(portfolio, datetime_iso, days_going_back)
+
+        # Only process transactions from where the last successful run finished unless a full rebuild is requested
+        watermark = get_watermark(portfolio, const.WATERMARK_PROPERTY)
+        end_date = datetime.fromisoformat(end_date_formatted)
+        if watermark and not full_rebuild:
+            if watermark >= end_date:
+                logging.info(f"Portfolio '{scope}/{portfolio_code}' is already processed up to {watermark.isoformat()}")
+                summary["status"] = "up-to-date"
+                summary["duration_seconds"] = round(time.perf_counter() - start_time, 3)
+                return summary
+            # Transactions booked since the watermark was set may be dated shortly before it
+            watermark_start_date = watermark - timedelta(days=watermark_lookback_days)
+            if watermark_start_date > datetime.fromisoformat(start_date_formatted):
+                start_date_formatted = str(watermark_start_date.isoformat())
+
+        # A resumed run finishes the window the interrupted run was working on
+        window_checkpoint = WindowCheckpoint(scope, portfolio_code)
+        interrupted_window = window_checkpoint.get_interrupted_window() if resume else None
+        if interrupted_window:
+            start_date_formatted, end_date_formatted = interrupted_window
+            logging.info(f"Resuming the interrupted window of '{scope}/{portfolio_code}' from {start_date_formatted} "
+                         f"to {end_date_formatted}")
+            end_date = datetime.fromisoformat(end_date_formatted)
+        try:
+            window_checkpoint.start(start_date_formatted, end_date_formatted, resume=bool(interrupted_window))
+        except OSError as e:
+            logging.warning(f"Not checkpointing the window of '{scope}/{portfolio_code}': {e}")
+        summary["from_date"] = start_date_formatted
+        summary["to_date"] = end_date_formatted
+
+        counts = Counter()
+        report = check_or_create_commission_transactions(
+            scope, portfolio_code, end_date_formatted, start_date_formatted, api_factory, entity_prop_value,
+            broker_prop_value, counts, resume=resume, **processing_kwargs
+        )
+        summary["counts"] = summarise_counts(counts)
+        summary["upsert"] = report.to_dict()
+        summary["status"] = "failed" if report.failed_transaction_ids else "succeeded"
+
+        # A failed run leaves the watermark in place so the next run picks the failed transactions up again, as do
+        # transactions skipped for a missing country or booked at a rate of 0 for a missing commission rate, once the
+        # country or the rate has been set
+        unresolved = counts["missing_country"] + sum(
+            value for key, value in counts.items() if isinstance(key, tuple) and key[0] == "mapping_miss"
+        )
+        if unresolved and not report.failed_transaction_ids:
+            logging.warning(f"Leaving the commission watermark of '{scope}/{portfolio_code}' in place, {unresolved} "
+                            f"transactions have no country or commission rate")
+            summary["watermark_held"] = unresolved
+        if not report.failed_transaction_ids and not unresolved and (not watermark or end_date > watermark):
+            set_watermark(api_factory, scope, portfolio_code, const.WATERMARK_PROPERTY, end_date, portfolio)
+            summary["watermark_moved"] = True
+        if not report.failed_transaction_ids:
+            window_checkpoint.complete()
+    except Exception as e:
+        logging.exception(f"Failed to process portfolio with scope '{scope}' and portfolio code '{portfolio_code}'")
+        summary["status"] = "failed"
+        summary["error"] = str(e)
+
+    duration = time.perf_counter() - start_time
+    run_metrics.record_stage("process_portfolio", duration)
+    run_metrics.increment(f"portfolios_{summary['status']}")
+    summary["duration_seconds"] = round(duration, 3)
+    return summary
+
+
+def process_portfolios(api_factory, portfolio_ids: list, datetime_iso, days_going_back, max_workers=4,
+                       full_rebuild=False, portfolio_index=None, **processing_kwargs) -> list:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                process_portfolio, api_factory, scope, portfolio_code, datetime_iso, days_going_back, full_rebuild,
+                portfolio_index, **processing_kwargs
+            )
+            for scope, portfolio_code in portfolio_ids
+        ]
+        summaries = [future.result() for future in futures]
+
+    failed = [summary for summary in summaries if summary["status"] == "failed"]
+    logging.info(f"Processed {len(summaries)} portfolios, {len(failed)} failed")
+    return summaries
+
+
+def cancel_orphaned_commissions(api_factory, scope, portfolio_code, datetime_iso, days_going_back, dry_run=False,
+                                portfolio_index=None, max_in_flight=4) -> dict:
+    # Cancels the commissions booked for input transactions which have since been cancelled or no longer match
+    # the input filter, over the portfolio's whole window whatever the watermark. Only the commissions' ids are held
+    # in memory, the input transactions are fetched without properties and streamed past them.
+    summary = {"scope": scope, "portfolio_code": portfolio_code, "dry_run": dry_run}
+    start_time = time.perf_counter()
+    try:
+        portfolio = get_portfolio(api_factory, scope, portfolio_code, portfolio_index)
+        end_date, start_date = get_portfolio_window(portfolio, datetime_iso, days_going_back)
+        summary.update(from_date=start_date, to_date=end_date)
+        with run_metrics.stage("find_orphaned_commissions"):
+            orphaned = find_orphaned_commissions(
+                get_transaction_record_pages(
+                    api_factory, scope, portfolio_code, end_date, start_date, const.COMMISSION_TXN_FILTER,
+                    linking_prop=const.LINKING_PROPERTY
+                ),
+                get_transaction_record_pages(
+                    api_factory, scope, portfolio_code, end_date, start_date, const.INPUT_TXN_FILTER
+                )
+            )
+            if orphaned:
+                orphaned = drop_live_inputs(api_factory, scope, portfolio_code, orphaned, const.INPUT_TXN_FILTER)
+        summary["orphaned"] = len(orphaned)
+        logging.info(f"Found {len(orphaned)} orphaned commissions in '{scope}/{portfolio_code}'")
+
+        if dry_run:
+            summary["orphaned_commissions"] = orphaned
+            summary["status"] = "dry-run"
+        else:
+            batch_results = cancel_transactions(api_factory, scope, portfolio_code, list(orphaned), max_in_flight)
+            failed_ids = [
+                transaction_id for result in batch_results if not result.succeeded
+                for transaction_id in result.transaction_ids
+            ]
+            summary.update(cancelled=len(orphaned) - len(failed_ids), failed_transaction_ids=failed_ids,
+                           status="failed" if failed_ids else "succeeded")
+    except Exception as e:
+        logging.exception(f"Failed to cancel the orphaned commissions of '{scope}/{portfolio_code}'")
+        summary["status"] = "failed"
+        summary["error"] = str(e)
+
+    summary["duration_seconds"] = round(time.perf_counter() - start_time, 3)
+    return summary
+
+
+def get_snapshot_path(snapshot_dir, scope, portfolio_code):
+    return os.path.join(snapshot_dir, scope, f"{portfolio_code}.ndjson.gz")
+
+
+def export_portfolio_snapshot(api_factory, scope, portfolio_code, datetime_iso, days_going_back, snapshot_dir,
+                              portfolio_index=None, instrument_countries=None) -> dict:
+    # Writes the input transactions of the portfolio's whole window to a snapshot, with the country of each one
+    # resolved so commissions can be computed from it without LUSID. Nothing is booked and the watermark is left
+    # where it is.
+    summary = {"scope": scope, "portfolio_code": portfolio_code}
+    start_time = time.perf_counter()
+    try:
+        portfolio = get_portfolio(api_factory, scope, portfolio_code, portfolio_index)
+        end_date, start_date = get_portfolio_window(portfolio, datetime_iso, days_going_back)
+        pages = get_transaction_record_pages(
+            api_factory, scope, portfolio_code, end_date, start_date, const.INPUT_TXN_FILTER,
+            country_prop=None if instrument_countries is not None else const.COUNTRY_PROPERTY
+        )
+
+        def with_countries(page):
+            if instrument_countries is not None:
+                page_countries = instrument_countries.prefetch(
+                    api_factory, [record.instrument_uid for record in page]
+                )
+                for record in page:
+                    record.country = page_countries.get(record.instrument_uid)
+            return page
+
+        snapshot_path = get_snapshot_path(snapshot_dir, scope, portfolio_code)
+        header = {
+            "scope": scope, "portfolio_code": portfolio_code, "from_date": start_date, "to_date": end_date,
+            "entity": portfolio.properties[const.ENTITY_PROPERTY].value.label_value,
+            "broker": portfolio.properties[const.BROKER_PROPERTY].value.label_value,
+        }
+        transactions = write_transaction_snapshot(
+            snapshot_path, header, chain.from_iterable(with_countries(page) for page in pages)
+        )
+        logging.info(f"Written {transactions} transactions of '{scope}/{portfolio_code}' to {snapshot_path}")
+        summary.update(from_date=start_date, to_date=end_date, snapshot_path=snapshot_path, transactions=transactions,
+                       status="exported")
+    except Exception as e:
+        logging.exception(f"Failed to export portfolio with scope '{scope}' and portfolio code '{portfolio_code}'")
+        summary["status"] = "failed"
+        summary["error"] = str(e)
+
+    summary["duration_seconds"] = round(time.perf_counter() - start_time, 3)
+    return summary
+
+
+def compute_from_snapshot(snapshot_path, commissions_path=None, api_factory=None, columnar=False,
+                          **upsert_kwargs) -> dict:
+    # Computes the commissions of a transaction snapshot with the loaded commission config, and either writes them
+    # to a commission snapshot to be upserted later or upserts them straight away. Every commission is upserted,
+    # as booked commissions are not fetched to compare against.
+    header = read_snapshot_header(snapshot_path, "transactions")
+    scope, portfolio_code = header["scope"], header["portfolio_code"]
+    summary = {"scope": scope, "portfolio_code": portfolio_code, "from_date": header["from_date"],
+               "to_date": header["to_date"], "snapshot_path": snapshot_path}
+    counts = Counter()
+    commissions = chain.from_iterable(
+        compute_page_commissions(page, header["entity"], header["broker"], None, counts, columnar)
+        for page in iter_transaction_snapshot_pages(snapshot_path)
+    )
+
+    if commissions_path:
+        written = write_commission_snapshot(commissions_path, header, commissions)
+        logging.info(f"Written {written} commissions of '{scope}/{portfolio_code}' to {commissions_path}")
+        summary.update(commissions_path=commissions_path, status="computed")
+    else:
+        report = upsert_transactions(api_factory, scope, portfolio_code, commissions, **upsert_kwargs)
+        summary["upsert"] = report.to_dict()
+        summary["status"] = "failed" if report.failed_transaction_ids else "succeeded"
+    log_counts(scope, portfolio_code, counts)
+    summary["counts"] = summarise_counts(counts)
+    return summary
+
 
+def upsert_commission_snapshot(api_factory, commissions_path, **upsert_kwargs) -> dict:
+    header = read_snapshot_header(commissions_path, "commissions")
+    scope, portfolio_code = header["scope"], header["portfolio_code"]
+    report = upsert_transactions(
+        api_factory, scope, portfolio_code, chain.from_iterable(iter_commission_snapshot_pages(commissions_path)),
+        **upsert_kwargs
+    )
+    return {
+        "scope": scope, "portfolio_code": portfolio_code, "commissions_path": commissions_path,
+        "upsert": report.to_dict(), "status": "failed" if report.failed_transaction_ids else "succeeded",
+    }
+
+
+def write_summary(summaries: list, summary_path):
+    with open(summary_path, "w") as summary_file:
+        json.dump(summaries, summary_file, indent=2)
+    logging.info(f"Written the run summary to {summary_path}")
+
+
+def setup_environment(api_factory):
     # TODO: These properties need to come from a global config file
     type_property = "Transaction/generated/Type"
     linked_id_property = "Transaction/generated/LinkedTransactionId"
-    check_or_create_property(api_factory, type_property)
-    check_or_create_property(api_factory, linked_id_property)
+    ensure_environment_ready(api_factory, [type_property, linked_id_property] + const.PROPERTIES_REQUIRED)
+
 
-    # Cache config file:
+def load_commission_config(cache_ttl_seconds=3600, offline=False, config_file=None):
+    # Cache config file, unless a local one is given to try out rate changes with:
     config_name = "commission-config.json"
     config_path = "CommissionConfig"
-    config_file = get_file_from_drive(config_path, config_name)
+    if not config_file:
+        config_file = get_cached_file_from_drive(
+            config_path, config_name, ttl_seconds=cache_ttl_seconds, offline=offline
+        )
     os.environ["FBN_COMMISSIONS_CONFIG_PATH"] = config_file
+    get_commission_rate_table(config_file)
+
+
+def resolve_portfolios(api_factory, portfolio_index, scope, portfolio_code, portfolios: list, all_in_scope,
+                       portfolio_groups: list) -> list:
+    with run_metrics.stage("resolve_portfolios"):
+        portfolio_ids = [parse_portfolio_id(portfolio_id) for portfolio_id in portfolios]
+        if portfolio_code:
+            portfolio_ids.append((scope, portfolio_code))
+        if all_in_scope:
+            portfolio_ids.extend(portfolio_index.add_scope(api_factory, scope))
+        for portfolio_group in portfolio_groups:
+            portfolio_ids.extend(portfolio_index.add_group(api_factory, *parse_portfolio_id(portfolio_group)))
+        # Preserve the order given while dropping portfolios selected more than once
+        portfolio_ids = list(dict.fromkeys(portfolio_ids))
+        index_requested_portfolios(api_factory, portfolio_index, portfolio_ids)
+    return portfolio_ids
+
+
+def count_own_commands(summary: dict) -> int:
+    # Each upserted batch and the move of the watermark are recorded as one portfolio command each
+    upsert = summary.get("upsert") or {}
+    return upsert.get("batches", 0) - len(upsert.get("failed_batches", [])) + bool(summary.get("watermark_moved"))
+
+
+def run_service(api_factory, resolve, days_going_back, max_workers=4, poll_interval=30.0, health_port=None,
+                portfolio_refresh_interval=3600.0, config_cache_ttl=3600, offline=False, watermark_lookback_days=1,
+                config_file=None, **processing_kwargs):
+    # Polls the portfolios for new transactions until stopped, reusing the api factory, the compiled commission
+    # config and the resolved portfolios between polls. A portfolio is only processed again once someone else has
+    # changed it since the asAt of its last poll, which takes one get_portfolio_commands call to find out. The
+    # portfolios are resolved again every portfolio_refresh_interval seconds to pick up new portfolios and changed
+    # broker or entity properties.
+    portfolio_ids, portfolio_index = resolve()
+    resolved_at = time.monotonic()
+    last_polls = {}
+
+    def is_changed(portfolio_id):
+        if portfolio_id not in last_polls:
+            return True
+        as_at, own_commands = last_polls[portfolio_id]
+        return has_commands_since(api_factory, *portfolio_id, as_at, own_commands)
 
-    # Set up portfolio properties
-    entity_prop = const.ENTITY_PROPERTY
-    broker_prop = const.BROKER_PROPERTY
-    country_prop = const.COUNTRY_PROPERTY
-    check_or_create_property(api_factory, entity_prop)
-    check_or_create_property(api_factory, broker_prop)
-    check_or_create_property(api_factory, country_prop)
-
-    # Get portfolio property values
-    get_portfolio = api_factory.build(lusid.api.PortfoliosApi).get_portfolio(
-        scope=scope, code=portfolio_code, property_keys=[entity_prop, broker_prop]
+    def poll_once():
+        nonlocal portfolio_ids, portfolio_index, resolved_at
+        if time.monotonic() - resolved_at >= portfolio_refresh_interval:
+            portfolio_ids, portfolio_index = resolve()
+            resolved_at = time.monotonic()
+        # Drive is only checked for a new config once the cached one is older than config_cache_ttl
+        load_commission_config(config_cache_ttl, offline, config_file)
+
+        # Set back a little so a clock running ahead of LUSID's cannot hide a change, at worst a portfolio is
+        # processed once more than it needed to be
+        as_at = datetime.now(timezone.utc) - timedelta(seconds=5)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            changed = list(executor.map(is_changed, portfolio_ids))
+        changed_ids = [portfolio_id for portfolio_id, is_new in zip(portfolio_ids, changed) if is_new]
+        logging.info(f"{len(changed_ids)} of {len(portfolio_ids)} portfolios have changed since the last poll")
+
+        summaries = process_portfolios(
+            api_factory, changed_ids, None, days_going_back, max_workers, False, portfolio_index,
+            watermark_lookback_days=watermark_lookback_days, **processing_kwargs
+        )
+        for summary in summaries:
+            # A failed portfolio is processed again at the next poll whether or not it has changed
+            if summary["status"] != "failed":
+                last_polls[(summary["scope"], summary["portfolio_code"])] = (as_at, count_own_commands(summary))
+        return summaries
+
+    service = CommissionService(poll_once, poll_interval)
+    health_server = start_health_server(service, health_port) if health_port is not None else None
+    service.install_signal_handlers()
+    try:
+        service.run()
+    finally:
+        if health_server:
+            health_server.shutdown()
+            health_server.server_close()
+    return service.last_summaries
+
+
+def create_run_api_factory(args):
+    api_factory = create_api_factory(args["connection_pool_size"], args["gzip_requests"])
+    configure_drive_client(get_access_token(api_factory))
+    return api_factory
+
+
+def create_batch_controller(args):
+    if not args["adaptive_batching"]:
+        return None
+    return AdaptiveBatchController(
+        args["batch_size"], args["max_in_flight"], args["min_batch_size"], args["max_batch_size"],
+        args["max_in_flight_limit"], args["target_batch_seconds"]
     )
-    entity_prop_value = get_portfolio.properties[entity_prop].value.label_value
-    broker_prop_value = get_portfolio.properties[broker_prop].value.label_value
 
-    # Process dates
-    end_date = datetime.today().astimezone()
-    end_date_formatted = str(end_date.isoformat())
-    if datetime_iso:
-        end_date_formatted = datetime_iso
 
-    start_date = get_portfolio.created
-    if days_going_back:
-        start_date = datetime.fromisoformat(end_date_formatted) + timedelta(days=-int(days_going_back))
-    start_date_formatted = str(start_date.isoformat())
+def process_files(args, batch_controller=None) -> dict:
+    # Works from local files, LUSID is only contacted to upsert
+    upsert_kwargs = dict(
+        batch_size=args["batch_size"], max_in_flight=args["max_in_flight"], batch_controller=batch_controller
+    )
+    api_factory = None
+    if args["upsert_commissions"] or not args["commissions_out"]:
+        api_factory = create_run_api_factory(args)
+        with run_metrics.stage("setup_environment"):
+            setup_environment(api_factory)
+
+    if args["upsert_commissions"]:
+        return upsert_commission_snapshot(api_factory, args["upsert_commissions"], **upsert_kwargs)
+
+    with run_metrics.stage("load_commission_config"):
+        load_commission_config(args["config_cache_ttl"], args["offline"], args["config_file"])
+    return compute_from_snapshot(
+        args["from_snapshot"], args["commissions_out"], api_factory, args["columnar"], **upsert_kwargs
+    )
+
+
+def log_batch_controller(batch_controller):
+    # The settings the run settled on are a starting point for the --batch-size and --max-in-flight of the next
+    if batch_controller:
+        logging.info(f"Adaptive batching finished with batches of {batch_controller.batch_size} and "
+                     f"{batch_controller.max_in_flight} in flight")
+
+
+def write_outputs(summaries: list, args):
+    if args["summary_path"]:
+        write_summary(summaries, args["summary_path"])
+    if args["metrics_report"]:
+        run_metrics.write_report(args["metrics_report"])
+    if args["prometheus_textfile"]:
+        run_metrics.write_prometheus_textfile(args["prometheus_textfile"], args["openmetrics"])
+
+
+def positive_int(value) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
 
-    # Loop over portfolios if you wish here. Ideally asynchronously to maximise performance:
-    check_or_create_commission_transactions(
-        scope, portfolio_code, end_date_formatted, start_date_formatted, api_factory, entity_prop_value,
-        broker_prop_value
+
+def main(argv):
+    ap = argparse.ArgumentParser(description="Get arguments from command line")
+    ap.add_argument('-s', '--scope', help='Scope of the data being uploaded')
+    ap.add_argument('-c', '--portfolio-code')
+    ap.add_argument('-p', '--portfolios', nargs='+', default=[],
+                    help="portfolios to process in the form 'scope/code'")
+    ap.add_argument('-a', '--all-in-scope', action='store_true',
+                    help="process every portfolio in the scope given by --scope")
+    ap.add_argument('-g', '--portfolio-groups', nargs='+', default=[],
+                    help="process every portfolio in these portfolio groups, in the form 'scope/code'")
+    ap.add_argument('-w', '--max-workers', type=positive_int, default=4,
+                    help="number of portfolios processed concurrently")
+    ap.add_argument('-b', '--batch-size', type=positive_int, default=5000,
+                    help="number of commission transactions per upsert request")
+    ap.add_argument('-f', '--max-in-flight', type=positive_int, default=4,
+                    help="number of upsert requests in flight at once per portfolio")
+    ap.add_argument('--adaptive-batching', action='store_true',
+                    help="adjust the batch size and upserts in flight from the latency and throttling of each batch, "
+                         "starting from --batch-size and --max-in-flight")
+    ap.add_argument('--min-batch-size', type=positive_int, default=500,
+                    help="smallest batch size, and the step batches grow by, with --adaptive-batching")
+    ap.add_argument('--max-batch-size', type=positive_int, default=20000,
+                    help="largest batch size with --adaptive-batching")
+    ap.add_argument('--max-in-flight-limit', type=int,
+                    help="most upserts in flight per portfolio with --adaptive-batching, defaults to twice "
+                         "--max-in-flight")
+    ap.add_argument('--target-batch-seconds', type=float, default=10.0,
+                    help="batches taking longer than this are halved with --adaptive-batching")
+    ap.add_argument('--connection-pool-size', type=int,
+                    help="connections kept open to LUSID, defaults to enough for every portfolio worker and upsert")
+    ap.add_argument('--gzip-requests', action='store_true',
+                    help="gzip the bodies of requests to LUSID, such as the batches of commissions upserted")
+    ap.add_argument('--columnar', action='store_true',
+                    help="compute commissions a page at a time with vectorised NumPy arithmetic")
+    ap.add_argument('--config-cache-ttl', type=int, default=3600,
+                    help="seconds a cached commission config is used before checking Drive for a new version")
+    ap.add_argument('--offline', action='store_true',
+                    help="use the last cached commission config without contacting Drive")
+    ap.add_argument('--config-file', help="local commission config to use instead of the one on Drive")
+    ap.add_argument('--export-snapshot', metavar='DIR',
+                    help="write the input transactions of each portfolio to a snapshot in DIR instead of booking them")
+    ap.add_argument('--from-snapshot', metavar='FILE',
+                    help="compute the commissions of a transaction snapshot instead of fetching from LUSID")
+    ap.add_argument('--commissions-out', metavar='FILE',
+                    help="write the commissions computed --from-snapshot to FILE instead of upserting them")
+    ap.add_argument('--upsert-commissions', metavar='FILE',
+                    help="upsert the commissions written to FILE by --commissions-out")
+    ap.add_argument('--cancel-orphaned-commissions', action='store_true',
+                    help="cancel the commissions whose input transaction is no longer live in the window instead of "
+                         "booking commissions")
+    ap.add_argument('--dry-run', action='store_true',
+                    help="with --cancel-orphaned-commissions, report the orphaned commissions without cancelling them")
+    ap.add_argument('--async-pipeline', action='store_true',
+                    help="overlap fetching, computing and upserting with an asyncio pipeline")
+    ap.add_argument('--resume', action='store_true',
+                    help="continue an interrupted run from the last page whose commissions were all upserted")
+    ap.add_argument('--shards', type=int, default=1,
+                    help="split each portfolio's window into this many date ranges processed in worker processes")
+    ap.add_argument('--shard-processes', type=int,
+                    help="number of worker processes shared by the shards of every portfolio, defaults to one per CPU")
+    ap.add_argument('--no-country-cache', action='store_true',
+                    help="read the country from properties decorated onto each transaction instead of resolving it "
+                         "per instrument")
+    ap.add_argument('--country-cache-size', type=int, default=100000,
+                    help="number of instrument countries held in memory")
+    ap.add_argument('--persist-country-cache', action='store_true',
+                    help="keep the instrument countries on disk between runs")
+    ap.add_argument('--summary-path', help="file to write the per-portfolio result summary to")
+    ap.add_argument('--metrics-report', help="file to write the JSON run metrics report to")
+    ap.add_argument('--prometheus-textfile', help="file to write the run metrics to for the node exporter")
+    ap.add_argument('--openmetrics', action='store_true',
+                    help="write --prometheus-textfile in OpenMetrics format")
+    ap.add_argument('-dt', '--datetime-iso', help="must be in iso format, defaults to the time now")
+    ap.add_argument('-d', '--days-going-back')
+    ap.add_argument('-r', '--full-rebuild', action='store_true',
+                    help="ignore the stored watermark and process the whole window")
+    ap.add_argument('--serve', action='store_true',
+                    help="keep running, polling the portfolios for new transactions until stopped")
+    ap.add_argument('--poll-interval', type=float, default=30.0,
+                    help="seconds between polls for --serve")
+    ap.add_argument('--health-port', type=int,
+                    help="port to serve /healthz and /metrics on for --serve")
+    ap.add_argument('--portfolio-refresh-interval', type=float, default=3600.0,
+                    help="seconds between resolving the portfolios to process again for --serve")
+    ap.add_argument('--watermark-lookback-days', type=float, default=1.0,
+                    help="days before the watermark a run looks for transactions booked since the last one")
+    ap.add_argument('--log-level', type=str.upper, choices=LOG_LEVELS,
+                    help="logging level, defaults to FBN_LOG_LEVEL or INFO")
+    ap.add_argument('--log-sample-every', type=int, default=1,
+                    help="at DEBUG, log the detail of only one in every N transactions")
+
+    args = vars(ap.parse_args(args=argv[1:]))
+    setup_logging(args["log_level"], sample_every=args["log_sample_every"])
+    scope = args["scope"]
+    portfolio_code = args["portfolio_code"]
+    datetime_iso = args["datetime_iso"]
+    days_going_back = args["days_going_back"]
+
+    if args["all_in_scope"] and not scope:
+        ap.error("--all-in-scope requires --scope")
+    if portfolio_code and not scope:
+        ap.error("--portfolio-code requires --scope")
+    from_files = args["from_snapshot"] or args["upsert_commissions"]
+    if not (portfolio_code or args["portfolios"] or args["all_in_scope"] or args["portfolio_groups"] or from_files):
+        ap.error("one of --portfolio-code, --portfolios, --all-in-scope or --portfolio-groups is required")
+    if args["commissions_out"] and not args["from_snapshot"]:
+        ap.error("--commissions-out requires --from-snapshot")
+    if args["from_snapshot"] and args["upsert_commissions"]:
+        ap.error("--from-snapshot and --upsert-commissions cannot be used together")
+    if args["dry_run"] and not args["cancel_orphaned_commissions"]:
+        ap.error("--dry-run requires --cancel-orphaned-commissions")
+    if args["resume"] and args["async_pipeline"]:
+        ap.error("--resume cannot be used with --async-pipeline, whose pages are not journaled")
+    if args["serve"] and (args["datetime_iso"] or args["full_rebuild"]):
+        ap.error("--serve always processes up to the time of each poll and cannot be used with --datetime-iso or "
+                 "--full-rebuild")
+
+    batch_controller = create_batch_controller(args)
+    # Each portfolio worker has its upserts in flight, a page being fetched and an instrument lookup at once
+    if not args["connection_pool_size"]:
+        max_in_flight = batch_controller.max_in_flight_limit if batch_controller else args["max_in_flight"]
+        args["connection_pool_size"] = max(args["max_workers"] * (max_in_flight + 2), 10)
+
+    run_metrics.reset()
+    if from_files:
+        summaries = [process_files(args, batch_controller)]
+        log_batch_controller(batch_controller)
+        write_outputs(summaries, args)
+        return summaries
+
+    api_factory = create_run_api_factory(args)
+    with run_metrics.stage("setup_environment"):
+        setup_environment(api_factory)
+    with run_metrics.stage("load_commission_config"):
+        load_commission_config(args["config_cache_ttl"], args["offline"], args["config_file"])
+
+    instrument_countries = None
+    if not args["no_country_cache"]:
+        instrument_countries = InstrumentCountryCache(
+            const.COUNTRY_PROPERTY, args["country_cache_size"],
+            os.path.join(get_default_cache_dir(), "instrument-countries.json") if args["persist_country_cache"] else None
+        )
+
+    def resolve():
+        portfolio_index = PortfolioIndex(const.PORTFOLIO_PROPERTIES)
+        portfolio_ids = resolve_portfolios(
+            api_factory, portfolio_index, scope, portfolio_code, args["portfolios"], args["all_in_scope"],
+            args["portfolio_groups"]
+        )
+        return portfolio_ids, portfolio_index
+
+    processing_kwargs = dict(
+        columnar=args["columnar"], use_async=args["async_pipeline"], batch_size=args["batch_size"],
+        max_in_flight=args["max_in_flight"], instrument_countries=instrument_countries, shards=args["shards"],
+        shard_processes=args["shard_processes"], resume=args["resume"], batch_controller=batch_controller
     )
+    if args["export_snapshot"]:
+        datetime_iso = datetime_iso or str(datetime.today().astimezone().isoformat())
+        portfolio_ids, portfolio_index = resolve()
+        summaries = [
+            export_portfolio_snapshot(
+                api_factory, portfolio_scope, code, datetime_iso, days_going_back, args["export_snapshot"],
+                portfolio_index, instrument_countries
+            )
+            for portfolio_scope, code in portfolio_ids
+        ]
+    elif args["cancel_orphaned_commissions"]:
+        datetime_iso = datetime_iso or str(datetime.today().astimezone().isoformat())
+        portfolio_ids, portfolio_index = resolve()
+        with ThreadPoolExecutor(max_workers=args["max_workers"]) as executor:
+            summaries = list(executor.map(
+                lambda portfolio_id: cancel_orphaned_commissions(
+                    api_factory, *portfolio_id, datetime_iso, days_going_back, args["dry_run"], portfolio_index,
+                    args["max_in_flight"]
+                ),
+                portfolio_ids
+            ))
+    elif args["serve"]:
+        summaries = run_service(
+            api_factory, resolve, days_going_back, args["max_workers"], args["poll_interval"], args["health_port"],
+            args["portfolio_refresh_interval"], args["config_cache_ttl"], args["offline"],
+            args["watermark_lookback_days"], args["config_file"], **processing_kwargs
+        )
+    else:
+        # A single run processes every portfolio up to the same time
+        datetime_iso = datetime_iso or str(datetime.today().astimezone().isoformat())
+        portfolio_ids, portfolio_index = resolve()
+        summaries = process_portfolios(
+            api_factory, portfolio_ids, datetime_iso, days_going_back, args["max_workers"], args["full_rebuild"],
+            portfolio_index, watermark_lookback_days=args["watermark_lookback_days"], **processing_kwargs
+        )
+    shutdown_shard_executor()
+    if instrument_countries is not None:
+        instrument_countries.save()
+    log_batch_controller(batch_controller)
+    write_outputs(summaries, args)
+
+    return summaries
 
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
@@ -0,0 +1,454 @@
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import lusid
+from lusid import ApiException
+
+import constants as const
+
+
+class FakeHttpResponse:
+    # Enough of a urllib3 response for lusid.ApiException to report a status and headers
+
+    def __init__(self, status, reason, headers=None):
+        self.status = status
+        self.reason = reason
+        self.data = b""
+        self._headers = headers or {}
+
+    def getheaders(self):
+        return self._headers
+
+
+class FakeLusid:
+    # An in-process stand-in for the LUSID and LUSID Drive endpoints used by the script. Every call sleeps for
+    # `latency` seconds and a `throttle_rate` share of calls are rejected with a 429, pages are capped at
+    # `max_page_size` whatever limit the caller asks for.
+
+    def __init__(self, latency=0.0, max_page_size=5000, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.call_counts = Counter()
+        self.throttled_calls = 0
+        self.transactions_sent = 0
+        self.transactions_received = 0
+
+        self.property_definitions = set()
+        self.transaction_types = set()
+        self.portfolios = {}
+        self.portfolio_groups = {}
+        self.transactions = {}
+        self.commands = {}
+        self.instrument_countries = {}
+        self.drive_files = {}
+
+    def call(self, name):
+        with self.lock:
+            self.call_counts[name] += 1
+            throttled = self.throttle_rate and self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttled_calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise ApiException(http_resp=FakeHttpResponse(429, "Too Many Requests", {"Retry-After": "0"}))
+
+    def add_portfolio(self, scope, code, created, entity, broker):
+        self.portfolios[(scope, code)] = {
+            "created": created,
+            "properties": {const.ENTITY_PROPERTY: entity, const.BROKER_PROPERTY: broker},
+        }
+        self.transactions[(scope, code)] = {}
+        self.commands[(scope, code)] = []
+
+    def add_portfolio_group(self, scope, code, portfolio_ids: list, sub_groups=()):
+        self.portfolio_groups[(scope, code)] = {"portfolios": list(portfolio_ids), "sub_groups": list(sub_groups)}
+
+    def add_drive_file(self, directory_path, name, contents: str):
+        self.drive_files[(directory_path, name)] = {
+            "id": f"file-{len(self.drive_files)}", "contents": contents, "updated_on": datetime.now(timezone.utc)
+        }
+
+    def record_command(self, scope, code, description):
+        # Every change to a portfolio is recorded with the time it was made, as LUSID's portfolio commands are
+        self.commands[(scope, code)].append((datetime.now(timezone.utc), description))
+
+    def add_synthetic_transactions(self, scope, code, count, countries, start_date, instruments=100):
+        # Transactions are stored as compact tuples and only turned into objects a page at a time when fetched
+        for i in range(instruments):
+            self.instrument_countries[f"LUID_{i:08d}"] = countries[i % len(countries)]
+
+        portfolio_transactions = self.transactions[(scope, code)]
+        for i in range(count):
+            transaction_date = start_date + timedelta(minutes=i)
+            portfolio_transactions[f"txn-{i:08d}"] = (
+                "Buy" if i % 2 else "Sell", f"LUID_{i % instruments:08d}", transaction_date,
+                transaction_date + timedelta(days=2), float(i % 1000 + 1), float(i % 1000 + 1) * 1.5, "GBP", None
+            )
+        self.record_command(scope, code, "UpsertTransactions")
+
+    def commission_transactions(self, scope, code) -> dict:
+        return {
+            transaction_id: transaction for transaction_id, transaction in self.transactions[(scope, code)].items()
+            if transaction[0] == "Commission"
+        }
+
+    def build_factory(self):
+        return FakeApiClientFactory(self)
+
+
+def get_request_fields(request) -> tuple:
+    # Requests arrive either as SDK models or as the JSON bodies the script serializes its commissions to
+    if isinstance(request, dict):
+        return (
+            request["transactionId"], request["type"], request["transactionDate"], request["settlementDate"],
+            request["units"], request["totalConsideration"]["amount"], request["transactionCurrency"],
+            request["properties"][const.LINKING_PROPERTY]["value"]["labelValue"],
+        )
+    return (
+        request.transaction_id, request.type, request.transaction_date, request.settlement_date,
+        request.units, request.total_consideration.amount, request.transaction_currency,
+        request.properties[const.LINKING_PROPERTY].value.label_value,
+    )
+
+
+def parse_date(date):
+    return date if isinstance(date, datetime) else datetime.fromisoformat(date)
+
+
+def parse_transaction_filter(txn_filter) -> tuple:
+    # Returns the types and the transaction ids the filter matches on, None where it does not filter on them
+    if not txn_filter:
+        return None, None
+    match = re.match(r"type\s+(in|eq)\s+(.*?)(?:\s+and\s+transactionId\s+in\s+(.*))?$", txn_filter)
+    types = set(re.findall(r"'([^']*)'", match.group(2)))
+    transaction_ids = set(re.findall(r"'([^']*)'", match.group(3))) if match.group(3) else None
+    return types, transaction_ids
+
+
+def parse_code_filter(portfolio_filter) -> set:
+    if not portfolio_filter:
+        return None
+    match = re.match(r"id\.code\s+in\s+(.*)", portfolio_filter)
+    return set(re.findall(r"'([^']*)'", match.group(1)))
+
+
+def label_property(key, value):
+    return SimpleNamespace(key=key, value=SimpleNamespace(label_value=value))
+
+
+class FakeTransactionPortfoliosApi:
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def get_transactions(self, scope, code, from_transaction_date=None, to_transaction_date=None, filter=None,
+                         property_keys=None, limit=None, page=None, _preload_content=True, **kwargs):
+        self.fake.call("get_transactions")
+        types, transaction_ids = parse_transaction_filter(filter)
+        from_date = parse_date(from_transaction_date) if from_transaction_date else None
+        to_date = parse_date(to_transaction_date) if to_transaction_date else None
+
+        with self.fake.lock:
+            matching = sorted(
+                (transaction_id, transaction)
+                for transaction_id, transaction in self.fake.transactions[(scope, code)].items()
+                if (types is None or transaction[0] in types)
+                and (transaction_ids is None or transaction_id in transaction_ids)
+                and (from_date is None or transaction[2] >= from_date)
+                and (to_date is None or transaction[2] <= to_date)
+            )
+
+        offset = int(page) if page else 0
+        page_size = min(limit or self.fake.max_page_size, self.fake.max_page_size)
+        next_page = str(offset + page_size) if offset + page_size < len(matching) else None
+        with self.fake.lock:
+            self.fake.transactions_sent += len(matching[offset:offset + page_size])
+
+        # Without _preload_content the generated client returns the raw response rather than models
+        if not _preload_content:
+            values = [
+                self.to_transaction_json(transaction_id, transaction, property_keys or [])
+                for transaction_id, transaction in matching[offset:offset + page_size]
+            ]
+            return SimpleNamespace(status=200, data=json.dumps({"values": values, "nextPage": next_page}).encode())
+
+        values = [
+            self.to_transaction(transaction_id, transaction, property_keys or [])
+            for transaction_id, transaction in matching[offset:offset + page_size]
+        ]
+        return SimpleNamespace(values=values, next_page=next_page)
+
+    def to_transaction_json(self, transaction_id, transaction, property_keys) -> dict:
+        txn_type, instrument_uid, transaction_date, settlement_date, units, amount, currency, linked_id = transaction
+        properties = {}
+        if const.COUNTRY_PROPERTY in property_keys and instrument_uid in self.fake.instrument_countries:
+            properties[const.COUNTRY_PROPERTY] = {
+                "key": const.COUNTRY_PROPERTY, "value": {"labelValue": self.fake.instrument_countries[instrument_uid]}
+            }
+        if const.LINKING_PROPERTY in property_keys and linked_id:
+            properties[const.LINKING_PROPERTY] = {"key": const.LINKING_PROPERTY, "value": {"labelValue": linked_id}}
+
+        return {
+            "transactionId": transaction_id, "type": txn_type, "instrumentUid": instrument_uid,
+            "transactionDate": transaction_date.isoformat(), "settlementDate": settlement_date.isoformat(),
+            "units": units, "totalConsideration": {"amount": amount, "currency": currency},
+            "transactionCurrency": currency, "properties": properties,
+        }
+
+    def to_transaction(self, transaction_id, transaction, property_keys):
+        txn_type, instrument_uid, transaction_date, settlement_date, units, amount, currency, linked_id = transaction
+        properties = {}
+        if const.COUNTRY_PROPERTY in property_keys and instrument_uid in self.fake.instrument_countries:
+            properties[const.COUNTRY_PROPERTY] = label_property(
+                const.COUNTRY_PROPERTY, self.fake.instrument_countries[instrument_uid]
+            )
+        if const.LINKING_PROPERTY in property_keys and linked_id:
+            properties[const.LINKING_PROPERTY] = label_property(const.LINKING_PROPERTY, linked_id)
+
+        return SimpleNamespace(
+            transaction_id=transaction_id, type=txn_type, instrument_uid=instrument_uid,
+            transaction_date=transaction_date, settlement_date=settlement_date, units=units,
+            total_consideration=SimpleNamespace(amount=amount, currency=currency), transaction_currency=currency,
+            properties=properties
+        )
+
+    def upsert_transactions(self, scope, code, transaction_request, **kwargs):
+        self.fake.call("upsert_transactions")
+        with self.fake.lock:
+            portfolio_transactions = self.fake.transactions[(scope, code)]
+            for request in transaction_request:
+                transaction_id, txn_type, transaction_date, settlement_date, units, amount, currency, linked_id = \
+                    get_request_fields(request)
+                portfolio_transactions[transaction_id] = (
+                    txn_type, f"CCY_{currency}", parse_date(transaction_date), parse_date(settlement_date), units,
+                    amount, currency, linked_id
+                )
+            self.fake.transactions_received += len(transaction_request)
+            self.fake.record_command(scope, code, "UpsertTransactions")
+        return SimpleNamespace(version=None)
+
+    def cancel_transactions(self, scope, code, transaction_ids, **kwargs):
+        self.fake.call("cancel_transactions")
+        with self.fake.lock:
+            portfolio_transactions = self.fake.transactions[(scope, code)]
+            for transaction_id in transaction_ids:
+                portfolio_transactions.pop(transaction_id, None)
+            self.fake.record_command(scope, code, "CancelTransactions")
+        return SimpleNamespace(version=None)
+
+
+class FakeInstrumentsApi:
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def get_instruments(self, identifier_type, request_body, property_keys=None, **kwargs):
+        self.fake.call("get_instruments")
+        values = {}
+        for instrument_uid in request_body:
+            properties = []
+            if const.COUNTRY_PROPERTY in (property_keys or []) and instrument_uid in self.fake.instrument_countries:
+                properties.append(label_property(const.COUNTRY_PROPERTY, self.fake.instrument_countries[instrument_uid]))
+            values[instrument_uid] = SimpleNamespace(lusid_instrument_id=instrument_uid, properties=properties)
+        return SimpleNamespace(values=values, failed={})
+
+
+class FakePortfoliosApi:
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def get_portfolio(self, scope, code, property_keys=None, **kwargs):
+        self.fake.call("get_portfolio")
+        portfolio = self.fake.portfolios.get((scope, code))
+        if portfolio is None:
+            raise ApiException(http_resp=FakeHttpResponse(404, "Not Found"))
+        return self.to_portfolio(scope, code, portfolio, property_keys or [])
+
+    def to_portfolio(self, scope, code, portfolio, property_keys):
+        return SimpleNamespace(
+            id=SimpleNamespace(scope=scope, code=code), created=portfolio["created"],
+            properties={
+                key: label_property(key, value) for key, value in portfolio["properties"].items()
+                if key in property_keys
+            }
+        )
+
+    def list_portfolios_for_scope(self, scope, limit=None, page=None, property_keys=None, filter=None, **kwargs):
+        self.fake.call("list_portfolios_for_scope")
+        codes = parse_code_filter(filter)
+        portfolios = sorted(
+            (key, portfolio) for key, portfolio in self.fake.portfolios.items()
+            if key[0] == scope and (codes is None or key[1] in codes)
+        )
+        offset = int(page) if page else 0
+        page_size = limit or 100
+        values = [
+            self.to_portfolio(portfolio_scope, code, portfolio, property_keys or [])
+            for (portfolio_scope, code), portfolio in portfolios[offset:offset + page_size]
+        ]
+        next_page = str(offset + page_size) if offset + page_size < len(portfolios) else None
+        return SimpleNamespace(values=values, next_page=next_page)
+
+    def upsert_portfolio_properties(self, scope, code, request_body, **kwargs):
+        self.fake.call("upsert_portfolio_properties")
+        with self.fake.lock:
+            for key, model_property in request_body.items():
+                self.fake.portfolios[(scope, code)]["properties"][key] = model_property.value.label_value
+            self.fake.record_command(scope, code, "UpsertPortfolioProperties")
+
+    def get_portfolio_commands(self, scope, code, from_as_at=None, limit=None, **kwargs):
+        self.fake.call("get_portfolio_commands")
+        with self.fake.lock:
+            values = [
+                SimpleNamespace(description=description, processed_time=processed_time)
+                for processed_time, description in self.fake.commands[(scope, code)]
+                if from_as_at is None or processed_time >= from_as_at
+            ]
+        return SimpleNamespace(values=values[:limit] if limit else values, next_page=None)
+
+
+class FakePortfolioGroupsApi:
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def get_portfolio_group_expansion(self, scope, code, property_filter=None, **kwargs):
+        self.fake.call("get_portfolio_group_expansion")
+        return self.expand(scope, code, property_filter or [])
+
+    def expand(self, scope, code, property_keys):
+        group = self.fake.portfolio_groups[(scope, code)]
+        return SimpleNamespace(
+            id=SimpleNamespace(scope=scope, code=code),
+            values=[
+                SimpleNamespace(
+                    id=SimpleNamespace(scope=portfolio_scope, code=portfolio_code),
+                    created=self.fake.portfolios[(portfolio_scope, portfolio_code)]["created"],
+                    properties=[
+                        label_property(key, value)
+                        for key, value in self.fake.portfolios[(portfolio_scope, portfolio_code)]["properties"].items()
+                        if key in property_keys
+                    ]
+                )
+                for portfolio_scope, portfolio_code in group["portfolios"]
+            ],
+            sub_groups=[self.expand(*sub_group, property_keys) for sub_group in group["sub_groups"]]
+        )
+
+
+class FakePropertyDefinitionsApi:
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def get_multiple_property_definitions(self, property_keys, **kwargs):
+        self.fake.call("get_multiple_property_definitions")
+        return SimpleNamespace(values=[
+            SimpleNamespace(key=key) for key in property_keys if key in self.fake.property_definitions
+        ])
+
+    def create_property_definition(self, create_property_definition_request, **kwargs):
+        self.fake.call("create_property_definition")
+        request = create_property_definition_request
+        key = f"{request.domain}/{request.scope}/{request.code}"
+        if key in self.fake.property_definitions:
+            raise ApiException(http_resp=FakeHttpResponse(400, "Bad Request"))
+        self.fake.property_definitions.add(key)
+
+
+class FakeSystemConfigurationApi:
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def list_configuration_transaction_types(self, **kwargs):
+        self.fake.call("list_configuration_transaction_types")
+        return SimpleNamespace(transaction_configs=[SimpleNamespace(aliases=[
+            SimpleNamespace(type=txn_type, transaction_group=group) for txn_type, group in self.fake.transaction_types
+        ])])
+
+    def create_configuration_transaction_type(self, transaction_configuration_data_request, **kwargs):
+        self.fake.call("create_configuration_transaction_type")
+        for alias in transaction_configuration_data_request.aliases:
+            self.fake.transaction_types.add((alias.type, alias.transaction_group))
+
+
+class FakeDriveSearchApi:
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def search(self, search_body, **kwargs):
+        self.fake.call("drive_search")
+        drive_file = self.fake.drive_files.get((search_body.with_path, search_body.name))
+        values = [SimpleNamespace(id=drive_file["id"], updated_on=drive_file["updated_on"])] if drive_file else []
+        return SimpleNamespace(values=values)
+
+
+class FakeDriveFilesApi:
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def download_file(self, id, **kwargs):
+        self.fake.call("drive_download_file")
+        drive_file = next(drive_file for drive_file in self.fake.drive_files.values() if drive_file["id"] == id)
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as downloaded_file:
+            downloaded_file.write(drive_file["contents"])
+        return path
+
+
+class FakeApiClientFactory:
+    apis = {
+        "TransactionPortfoliosApi": FakeTransactionPortfoliosApi,
+        "PortfoliosApi": FakePortfoliosApi,
+        "InstrumentsApi": FakeInstrumentsApi,
+        "PortfolioGroupsApi": FakePortfolioGroupsApi,
+        "PropertyDefinitionsApi": FakePropertyDefinitionsApi,
+        "SystemConfigurationApi": FakeSystemConfigurationApi,
+        "SearchApi": FakeDriveSearchApi,
+        "FilesApi": FakeDriveFilesApi,
+    }
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def build(self, api_class):
+        return self.apis[api_class.__name__](self.fake)
+
+
+class patch_lusid:
+    # Routes the LUSID and Drive clients created by main through the fake for the duration of the block
+
+    def __init__(self, fake: FakeLusid):
+        self.fake = fake
+        self.factory = fake.build_factory()
+
+    def __enter__(self):
+        import helpers.lusid_drive_util as drive_util
+
+        self.original_api_client_factory = lusid.utilities.ApiClientFactory
+        self.original_get_drive_api = drive_util.get_drive_api
+        lusid.utilities.ApiClientFactory = lambda *args, **kwargs: self.factory
+        drive_util.get_drive_api = self.factory.build
+        return self.factory
+
+    def __exit__(self, *exc_info):
+        import helpers.lusid_drive_util as drive_util
+
+        lusid.utilities.ApiClientFactory = self.original_api_client_factory
+        drive_util.get_drive_api = self.original_get_drive_api
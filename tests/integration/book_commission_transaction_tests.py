@@ -6,12 +6,13 @@ import unittest
 import lusid
 from datetime import datetime
 
-from main import get_input_transactions, check_or_create_commission_transactions
+from main import check_or_create_commission_transactions
 from tests.integration.setup.setup_instruments import setup_instruments
 from tests.integration.setup.setup_portfolio import setup_portfolio
 from tests.integration.setup.setup_properties import property_def
 from tests.integration.setup.setup_transaction import setup_transaction
 from helpers.utilities import create_commission_txn_type, check_or_create_property, get_commission_rate_from_lookup
+from transaction_helpers.transaction_retrieval import get_input_transactions
 
 api_factory = lusid.utilities.ApiClientFactory(
     app_name="commissions-tests-script",
@@ -0,0 +1,92 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from helpers.commission_rates import get_commission_rate_table
+from transaction_helpers.columnar_processing import get_commission_batch, iter_transaction_requests_from_pages
+from transaction_helpers.transaction_processing import get_transaction_requests_from_input_transactions
+from transaction_helpers.transaction_records import TransactionRecord
+
+country_prop = "Instrument/test/Country"
+countries = ["UK", "US", "DE", "FR", "JP"]
+broker = "UBS"
+entity = "entity1"
+
+
+def create_input_transactions(count):
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    return [
+        TransactionRecord(
+            transaction_id=f"txn-{i}",
+            instrument_uid=f"LUID_{i % 100:08d}",
+            transaction_date=(start + timedelta(minutes=i)).isoformat(),
+            settlement_date=(start + timedelta(days=2, minutes=i)).isoformat(),
+            currency="GBP",
+            units=float(i % 1000 + 1),
+            amount=float(i % 1000 + 1) * 1.5,
+            country=countries[i % len(countries)],
+        )
+        for i in range(count)
+    ]
+
+
+def paginate(transactions, page_size):
+    return [transactions[i:i + page_size] for i in range(0, len(transactions), page_size)]
+
+
+def time_call(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description="Benchmark the per-transaction and columnar commission calculation")
+    ap.add_argument('--sizes', nargs='+', type=int, default=[100000, 1000000])
+    ap.add_argument('--page-size', type=int, default=5000)
+    ap.add_argument('--max-loop-size', type=int, default=100000,
+                    help="skip the per-transaction loop above this many transactions")
+    args = ap.parse_args(argv[1:])
+
+    logging.disable(logging.INFO)
+    mapping = {country: {broker: {entity: 0.001 * (i + 1)}} for i, country in enumerate(countries)}
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as config_file:
+        json.dump(mapping, config_file)
+    os.environ["FBN_COMMISSIONS_CONFIG_PATH"] = config_file.name
+    rate_table = get_commission_rate_table()
+
+    try:
+        for size in args.sizes:
+            input_transactions = create_input_transactions(size)
+            pages = paginate(input_transactions, args.page_size)
+
+            compute_time, _ = time_call(lambda: [
+                get_commission_batch(page, country_prop, entity, broker, rate_table) for page in pages
+            ])
+            columnar_time, columnar_requests = time_call(lambda: sum(1 for _ in iter_transaction_requests_from_pages(
+                pages, country_prop, entity, broker, rate_table
+            )))
+
+            print(f"{size} transactions")
+            if size <= args.max_loop_size:
+                loop_time, loop_requests = time_call(lambda: len(get_transaction_requests_from_input_transactions(
+                    input_transactions, country_prop, entity, broker
+                )))
+                print(f"  per-transaction loop:             {loop_time:8.2f}s ({loop_requests} requests)")
+            else:
+                print("  per-transaction loop:             skipped")
+            print(f"  columnar, commission columns only: {compute_time:8.2f}s")
+            print(f"  columnar, materialising requests:  {columnar_time:8.2f}s ({columnar_requests} requests)")
+    finally:
+        os.remove(config_file.name)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
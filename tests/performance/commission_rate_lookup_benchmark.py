@@ -0,0 +1,71 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from helpers.commission_rates import CommissionRateTable
+
+countries = [f"C{i}" for i in range(50)]
+brokers = [f"B{i}" for i in range(10)]
+entities = [f"E{i}" for i in range(10)]
+
+
+def reread_config_lookup(config_file_path, country, broker, entity):
+    # The lookup as it was before the rate table: parse the config for every transaction
+    with open(config_file_path, 'r') as json_file_contents:
+        mapping = json.loads(json_file_contents.read())
+    try:
+        return mapping[country][broker][entity]
+    except KeyError:
+        return 0
+
+
+def main():
+    logging.disable(logging.INFO)
+    mapping = {c: {b: {e: 0.001 for e in entities} for b in brokers} for c in countries}
+    lookups = [(countries[i % len(countries)], brokers[i % len(brokers)], entities[i % len(entities)])
+               for i in range(10000)]
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as config_file:
+        json.dump(mapping, config_file)
+
+    try:
+        reread_lookups = 1000
+        reread_time = timeit.timeit(
+            lambda: [reread_config_lookup(config_file.name, *key) for key in lookups[:reread_lookups]], number=1
+        )
+
+        rate_table = CommissionRateTable(config_file.name)
+        table_time = timeit.timeit(lambda: [rate_table.get_rate(*key) for key in lookups], number=10)
+        table_lookups = 10 * len(lookups)
+
+        # The same rates with tiered, per transaction type and per instrument rules layered over them
+        mapping["rules"] = [
+            {"country": country, "transaction_type": ["Sell", "FxSell"],
+             "tiers": [{"from": 10 ** tier, "rate": 0.001 / (tier + 1)} for tier in range(8)]}
+            for country in countries
+        ] + [{"instrument": f"LUID_{i:08d}", "rate": 0.0005} for i in range(1000)]
+        with open(config_file.name, "w") as rules_file:
+            json.dump(mapping, rules_file)
+        rule_lookups = [key + ("Sell" if i % 2 else "Buy", f"LUID_{i % 2000:08d}", float(i * 997 % 10 ** 8))
+                        for i, key in enumerate(lookups)]
+        rules_table = CommissionRateTable(config_file.name)
+        rules_time = timeit.timeit(
+            lambda: [rules_table.get_rate(*key[:3], None, *key[3:]) for key in rule_lookups], number=10
+        )
+
+        print(f"Config with {len(countries) * len(brokers) * len(entities)} rates")
+        print(f"Re-read config per lookup: {reread_time / reread_lookups * 1e6:10.2f} us/transaction")
+        print(f"Compiled rate table:       {table_time / table_lookups * 1e6:10.2f} us/transaction")
+        print(f"With {len(mapping['rules'])} tiered and wildcard rules: "
+              f"{rules_time / table_lookups * 1e6:6.2f} us/transaction")
+    finally:
+        os.remove(config_file.name)
+
+
+if __name__ == '__main__':
+    main()
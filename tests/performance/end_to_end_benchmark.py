@@ -0,0 +1,86 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import main as commissions_main
+from tests.fakes.fake_lusid import FakeLusid, patch_lusid
+
+scope = "benchmark"
+portfolio_code = "benchmark-portfolio"
+countries = ["UK", "US"]
+config = {country: {"UBS": {"entity1": 0.001 * (i + 1)}} for i, country in enumerate(countries)}
+
+
+def run_one(size, latency, page_size, throttle_rate, main_args) -> dict:
+    logging.disable(logging.INFO)
+    fake = FakeLusid(latency=latency, max_page_size=page_size, throttle_rate=throttle_rate)
+    fake.add_portfolio(scope, portfolio_code, datetime(2000, 1, 1, tzinfo=timezone.utc), "entity1", "UBS")
+    fake.add_synthetic_transactions(scope, portfolio_code, size, countries, datetime(2001, 1, 1, tzinfo=timezone.utc))
+    fake.add_drive_file("/CommissionConfig", "commission-config.json", json.dumps(config))
+    os.environ["FBN_COMMISSIONS_CACHE_DIR"] = tempfile.mkdtemp()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with patch_lusid(fake):
+        start = time.perf_counter()
+        summaries = commissions_main.main(
+            ["main.py", "-s", scope, "-c", portfolio_code, "-dt", "2100-01-01T00:00:00+00:00"] + main_args
+        )
+        duration = time.perf_counter() - start
+
+    return {
+        "transactions": size,
+        "status": summaries[0]["status"],
+        "duration_seconds": round(duration, 2),
+        "transactions_per_second": round(size / duration, 1),
+        "commissions_booked": len(fake.commission_transactions(scope, portfolio_code)),
+        "peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "rss_before_run_mib": round(rss_before / 1024, 1),
+        "api_calls": dict(fake.call_counts),
+        "throttled_calls": fake.throttled_calls,
+    }
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description="Run main.main end to end against the in-process LUSID fake")
+    ap.add_argument('--sizes', nargs='+', type=int, default=[1000, 100000, 1000000])
+    ap.add_argument('--latency', type=float, default=0.05, help="seconds added to every fake API call")
+    ap.add_argument('--page-size', type=int, default=5000, help="largest page the fake returns")
+    ap.add_argument('--throttle-rate', type=float, default=0.0, help="share of fake API calls answered with a 429")
+    ap.add_argument('--output', help="file to write the results to as JSON")
+    ap.add_argument('--run-one', type=int, help=argparse.SUPPRESS)
+    args, main_args = ap.parse_known_args(argv[1:])
+
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, args.latency, args.page_size, args.throttle_rate, main_args)))
+        return
+
+    # Each size runs in its own process so that its peak RSS is not inflated by the previous run
+    results = []
+    for size in args.sizes:
+        output = subprocess.run(
+            [sys.executable, __file__, "--run-one", str(size), "--latency", str(args.latency),
+             "--page-size", str(args.page_size), "--throttle-rate", str(args.throttle_rate)] + main_args,
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f"{size:>9} transactions: {result['duration_seconds']:>8.2f}s "
+              f"{result['transactions_per_second']:>9.1f} txn/s {result['peak_rss_mib']:>8.1f} MiB peak RSS "
+              f"{sum(result['api_calls'].values()):>5} API calls ({result['throttled_calls']} throttled)")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
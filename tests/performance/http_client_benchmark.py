@@ -0,0 +1,155 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from lusid.configuration import Configuration
+from lusid.rest import RESTClientObject
+
+from helpers.api_clients import compress_request_bodies
+
+
+class SimulatedLusid(ThreadingHTTPServer):
+    # Answers every request after a fixed latency plus the time its bytes take to cross a link of the given bandwidth
+    # shared by all connections. Opening a connection costs two round trips, as the TCP and TLS handshakes would, and
+    # the connections opened are counted so that the churn of an undersized pool shows up.
+    daemon_threads = True
+
+    def __init__(self, latency, bandwidth, page):
+        super().__init__(("127.0.0.1", 0), SimulatedLusidHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.page = page
+        self.gzipped_page = gzip.compress(page, compresslevel=1)
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.link = threading.Lock()
+
+
+class SimulatedLusidHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(2 * self.server.latency)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        wire_bytes = len(body)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        json.loads(body)
+        self.respond(b'{"values": {}}', wire_bytes)
+
+    def do_GET(self):
+        page = self.server.gzipped_page if "gzip" in self.headers.get("Accept-Encoding", "") else self.server.page
+        self.respond(page, 0, "gzip" if page is self.server.gzipped_page else None)
+
+    def respond(self, body, request_bytes, content_encoding=None):
+        with self.server.link:
+            time.sleep((request_bytes + len(body)) / self.server.bandwidth)
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if content_encoding:
+            self.send_header("Content-Encoding", content_encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_batch(size):
+    return {
+        f"txn-{i}-commission": {
+            "transactionId": f"txn-{i}-commission", "type": "Commission", "instrumentIdentifiers": {
+                "Instrument/default/LusidInstrumentId": f"LUID_{i % 100:08d}"
+            }, "transactionDate": "2020-01-01T00:00:00+00:00", "settlementDate": "2020-01-03T00:00:00+00:00",
+            "units": float(i % 1000 + 1), "transactionPrice": {"price": 1.0, "type": "Price"},
+            "totalConsideration": {"amount": float(i % 1000 + 1) * 0.0015, "currency": "GBP"},
+            "properties": {"Transaction/default/LinkedTransactionId": {
+                "key": "Transaction/default/LinkedTransactionId", "value": {"labelValue": f"txn-{i}"}
+            }}
+        }
+        for i in range(size)
+    }
+
+
+def run_scenario(server, threads, requests_per_thread, batch, pool_size, gzip_requests, gzip_responses):
+    configuration = Configuration(host=f"http://127.0.0.1:{server.server_address[1]}")
+    configuration.connection_pool_maxsize = pool_size
+    rest_client = RESTClientObject(configuration)
+    if gzip_requests:
+        compress_request_bodies(rest_client.pool_manager)
+    headers = {"Content-Type": "application/json", "Accept-Encoding": "gzip" if gzip_responses else "identity"}
+    server.connections = 0
+    latencies = []
+
+    def call(method):
+        start = time.perf_counter()
+        if method == "POST":
+            rest_client.request("POST", f"{configuration.host}/transactions", headers=headers, body=batch)
+        else:
+            json.loads(rest_client.request("GET", f"{configuration.host}/transactions", headers=headers).data)
+        latencies.append(time.perf_counter() - start)
+
+    # Requests go out in bursts, as the upserts of a page do, with the pool left idle in between
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        for _ in range(requests_per_thread):
+            list(executor.map(call, ["POST", "GET"] * (threads // 2)))
+    duration = time.perf_counter() - start
+    rest_client.pool_manager.clear()
+    return duration, statistics.median(latencies), sorted(latencies)[int(len(latencies) * 0.95)], server.connections
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description="Benchmark the LUSID HTTP client pool and gzip against a simulated server")
+    ap.add_argument('--threads', type=int, default=24, help="portfolio workers times requests in flight")
+    ap.add_argument('--requests-per-thread', type=int, default=10)
+    ap.add_argument('--batch-size', type=int, default=1000)
+    ap.add_argument('--latency', type=float, default=0.05, help="seconds added to every request")
+    ap.add_argument('--bandwidth', type=float, default=20, help="MiB per second between the script and LUSID")
+    args = ap.parse_args(argv[1:])
+
+    logging.disable(logging.WARNING)
+    batch = create_batch(args.batch_size)
+    page = json.dumps({"values": list(batch.values())}).encode()
+    server = SimulatedLusid(args.latency, args.bandwidth * 2 ** 20, page)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"{len(json.dumps(batch)) / 2 ** 20:.1f}MiB batches and pages, {args.threads} threads")
+
+    default_pool_size = Configuration().connection_pool_maxsize
+    scenarios = [
+        ("default pool", default_pool_size, False, False),
+        ("sized pool", args.threads, False, False),
+        ("sized pool, gzip responses", args.threads, False, True),
+        ("sized pool, gzip both ways", args.threads, True, True),
+    ]
+    try:
+        print(f"{'scenario':<28} {'pool':>5} {'time':>8} {'p50':>8} {'p95':>8} {'connections':>12}")
+        for name, pool_size, gzip_requests, gzip_responses in scenarios:
+            duration, p50, p95, connections = run_scenario(
+                server, args.threads, args.requests_per_thread, batch, pool_size, gzip_requests, gzip_responses
+            )
+            print(f"{name:<28} {pool_size:>5} {duration:>7.2f}s {p50 * 1000:>6.0f}ms {p95 * 1000:>6.0f}ms "
+                  f"{connections:>12}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
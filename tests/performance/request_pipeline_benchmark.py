@@ -0,0 +1,67 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from commission_computation_benchmark import broker, countries, country_prop, create_input_transactions, entity
+from transaction_helpers.transaction_processing import iter_transaction_requests_from_input_transactions
+from transaction_helpers.transaction_upsertion import chunk_transactions
+
+
+def concatenate_requests(input_transactions):
+    # The request building as it was before the generator pipeline: the accumulated list is copied per transaction
+    transaction_requests = []
+    for transaction_request in iter_transaction_requests_from_input_transactions(
+            input_transactions, country_prop, entity, broker
+    ):
+        transaction_requests = transaction_requests + [transaction_request]
+    return sum(1 for _ in chunk_transactions(transaction_requests, 5000))
+
+
+def stream_requests(input_transactions):
+    return sum(1 for _ in chunk_transactions(iter_transaction_requests_from_input_transactions(
+        input_transactions, country_prop, entity, broker
+    ), 5000))
+
+
+def measure(func, input_transactions):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(input_transactions)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak / 2 ** 20
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description="Benchmark building and batching commission requests")
+    ap.add_argument('--sizes', nargs='+', type=int, default=[10000, 20000, 40000, 80000])
+    args = ap.parse_args(argv[1:])
+
+    logging.disable(logging.INFO)
+    mapping = {country: {broker: {entity: 0.001}} for country in countries}
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as config_file:
+        json.dump(mapping, config_file)
+    os.environ["FBN_COMMISSIONS_CONFIG_PATH"] = config_file.name
+
+    try:
+        print(f"{'transactions':>12} {'concat time':>12} {'concat peak':>12} {'stream time':>12} {'stream peak':>12}")
+        for size in args.sizes:
+            input_transactions = create_input_transactions(size)
+            concat_time, concat_peak = measure(concatenate_requests, input_transactions)
+            stream_time, stream_peak = measure(stream_requests, input_transactions)
+            print(f"{size:>12} {concat_time:>11.2f}s {concat_peak:>9.1f}MiB {stream_time:>11.2f}s "
+                  f"{stream_peak:>9.1f}MiB")
+    finally:
+        os.remove(config_file.name)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from lusid.api_client import ApiClient
+
+import constants as const
+from transaction_helpers.transaction_records import CommissionRecord, parse_transaction_page, to_request_bodies
+from transaction_helpers.transaction_upsertion import create_properties_request, create_upsert_transaction_request
+
+rate = 0.001
+
+
+class RawResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+def create_page_body(page_size, offset=0) -> bytes:
+    # A get_transactions response body shaped like LUSID's, decorated with the country property
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    country_property = {"key": const.COUNTRY_PROPERTY, "value": {"labelValue": "UK"}}
+    values = [
+        {
+            "transactionId": f"txn-{i:08d}", "type": "Buy", "instrumentIdentifiers": {},
+            "instrumentUid": f"LUID_{i % 100:08d}", "transactionDate": (start + timedelta(minutes=i)).isoformat(),
+            "settlementDate": (start + timedelta(days=2, minutes=i)).isoformat(), "units": float(i % 1000 + 1),
+            "totalConsideration": {"amount": float(i % 1000 + 1) * 1.5, "currency": "GBP"},
+            "transactionCurrency": "GBP", "properties": {const.COUNTRY_PROPERTY: country_property},
+        }
+        for i in range(offset, offset + page_size)
+    ]
+    return json.dumps({"values": values, "nextPage": None}).encode()
+
+
+def parse_models(api_client, body) -> list:
+    return api_client.deserialize(RawResponse(body), "ResourceListOfTransaction").values
+
+
+def build_models(transactions) -> list:
+    return [
+        create_upsert_transaction_request(
+            transaction, rate, "Commission", "Instrument/default/Currency",
+            create_properties_request(transaction, "Commission")
+        )[0]
+        for transaction in transactions
+    ]
+
+
+def parse_records(api_client, body) -> list:
+    return parse_transaction_page(body, const.COUNTRY_PROPERTY)[0]
+
+
+def build_records(records) -> list:
+    return to_request_bodies([
+        CommissionRecord(record.transaction_id, record.transaction_date, record.settlement_date, record.currency,
+                         record.units * rate, record.amount * rate)
+        for record in records
+    ])
+
+
+variants = {"models": (parse_models, build_models), "records": (parse_records, build_records)}
+
+
+def run_one(variant, transactions, page_size, batch_size, max_in_flight, prefetch_pages) -> dict:
+    # Streams the transactions through the stages of a run, holding at once what the script holds: the page being
+    # computed with the pages prefetched behind it, and max_in_flight batches of requests serialized for upsert
+    parse, build = variants[variant]
+    api_client = ApiClient()
+    pages = deque(maxlen=prefetch_pages + 1)
+    in_flight = deque(maxlen=max_in_flight)
+    batch = []
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    for offset in range(0, transactions, page_size):
+        pages.append(parse(api_client, create_page_body(min(page_size, transactions - offset), offset)))
+        for request in build(pages[-1]):
+            batch.append(request)
+            if len(batch) == batch_size:
+                in_flight.append((batch, json.dumps(api_client.sanitize_for_serialization(batch))))
+                batch = []
+    if batch:
+        in_flight.append((batch, json.dumps(api_client.sanitize_for_serialization(batch))))
+    duration = time.perf_counter() - start
+
+    return {
+        "variant": variant,
+        "transactions": transactions,
+        "duration_seconds": round(duration, 2),
+        "peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "rss_before_run_mib": round(rss_before / 1024, 1),
+    }
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description="Compare the peak RSS of SDK models and the compact records over a run")
+    ap.add_argument('--transactions', type=int, default=1000000)
+    ap.add_argument('--page-size', type=int, default=5000)
+    ap.add_argument('--batch-size', type=int, default=5000)
+    ap.add_argument('--max-in-flight', type=int, default=4)
+    ap.add_argument('--prefetch-pages', type=int, default=2)
+    ap.add_argument('--run-one', choices=list(variants), help=argparse.SUPPRESS)
+    args = ap.parse_args(argv[1:])
+
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, args.transactions, args.page_size, args.batch_size,
+                                 args.max_in_flight, args.prefetch_pages)))
+        return
+
+    # Each variant runs in its own process so that its peak RSS is not inflated by the other
+    print(f"{args.transactions} transactions in pages of {args.page_size}, {args.max_in_flight} batches of "
+          f"{args.batch_size} in flight")
+    for variant in variants:
+        output = subprocess.run(
+            [sys.executable, __file__, "--run-one", variant, "--transactions", str(args.transactions),
+             "--page-size", str(args.page_size), "--batch-size", str(args.batch_size),
+             "--max-in-flight", str(args.max_in_flight), "--prefetch-pages", str(args.prefetch_pages)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"  {variant:<8} {result['duration_seconds']:>8.2f}s {result['peak_rss_mib']:>8.1f} MiB peak RSS "
+              f"({result['rss_before_run_mib']:.1f} MiB before the run)")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,979 @@
+import gzip
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import lusid
+import urllib3
+from lusid import ApiException
+
+import main
+import constants as const
+from helpers.api_clients import compress_request_bodies, configure_api_client, get_pool_manager
+from helpers.commission_rates import get_commission_rate_table
+from helpers.instrumentation import InstrumentedApiClientFactory, run_metrics
+from helpers.lusid_drive_util import cache_lock, get_cached_file_from_drive
+from helpers.portfolios import PortfolioIndex, index_requested_portfolios
+from tests.fakes.fake_lusid import FakeHttpResponse, FakeLusid, FakeTransactionPortfoliosApi, patch_lusid
+from transaction_helpers.batch_controller import AdaptiveBatchController
+from transaction_helpers.sharding import split_date_range
+from transaction_helpers.transaction_records import CommissionRecord
+from transaction_helpers.transaction_upsertion import BatchResult, upsert_transactions
+
+portfolio_scope = "commissions-unit-test"
+portfolio_code = "commissions-unit-test"
+portfolio_created_date = datetime(2000, 1, 5, tzinfo=timezone.utc)
+portfolio_broker = "UBS"
+portfolio_entity = "entity1"
+transactions_start_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+date_to_iso_str = "2100-01-01T00:00:00+00:00"
+
+commissions_config_path = os.path.join(
+    os.path.dirname(__file__), "..", "integration", "setup", "commissions-config.json"
+)
+with open(commissions_config_path, 'r') as config:
+    commissions_rate_config = json.load(config)
+
+
+class BookCommissionTransactionTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        os.environ["FBN_COMMISSIONS_CACHE_DIR"] = tempfile.mkdtemp()
+        self.fake = FakeLusid()
+        self.fake.add_portfolio(
+            portfolio_scope, portfolio_code, portfolio_created_date, portfolio_entity, portfolio_broker
+        )
+        self.fake.add_drive_file("/CommissionConfig", "commission-config.json", json.dumps(commissions_rate_config))
+
+    def run_script(self, *args):
+        with patch_lusid(self.fake):
+            return main.main(
+                ["main.py", "-s", portfolio_scope, "-c", portfolio_code, "-dt", date_to_iso_str] + list(args)
+            )
+
+    def assert_commissions_booked(self, transaction_count):
+        commissions = self.fake.commission_transactions(portfolio_scope, portfolio_code)
+        self.assertEqual(len(commissions), transaction_count)
+
+        input_transactions = self.fake.transactions[(portfolio_scope, portfolio_code)]
+        for commission_id, commission in commissions.items():
+            linked_id = commission[7]
+            self.assertEqual(commission_id, linked_id + "_commission")
+            input_transaction = input_transactions[linked_id]
+            country = self.fake.instrument_countries[input_transaction[1]]
+            rate = commissions_rate_config[country][portfolio_broker][portfolio_entity]
+            self.assertEqual(commission[2], input_transaction[2])
+            self.assertEqual(commission[3], input_transaction[3])
+            self.assertAlmostEqual(commission[4], input_transaction[4] * rate)
+            self.assertAlmostEqual(commission[5], input_transaction[5] * rate)
+
+    def test_commission_transactions_are_created_when_running_script(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 25, ["UK", "US"], transactions_start_date
+        )
+
+        summaries = self.run_script()
+
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assert_commissions_booked(25)
+
+    def test_all_batches_are_upserted_when_there_is_more_than_one_batch(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 23, ["UK", "US"], transactions_start_date
+        )
+
+        summaries = self.run_script("-b", "5", "-f", "2")
+
+        self.assertEqual(summaries[0]["upsert"]["batches"], 5)
+        self.assert_commissions_booked(23)
+
+    def test_unchanged_commissions_are_skipped_when_running_script_twice(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 10, ["UK", "US"], transactions_start_date
+        )
+
+        self.run_script()
+        summaries = self.run_script("--full-rebuild")
+
+        self.assertEqual(summaries[0]["counts"]["unchanged"], 10)
+        self.assertEqual(summaries[0]["upsert"]["upserted"], 0)
+        self.assert_commissions_booked(10)
+
+    def test_watermark_limits_the_next_run_to_new_transactions(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 10, ["UK", "US"], transactions_start_date
+        )
+
+        self.run_script("-dt", "2020-01-01T00:04:30+00:00")
+        self.assertEqual(
+            self.fake.portfolios[(portfolio_scope, portfolio_code)]["properties"][const.WATERMARK_PROPERTY],
+            "2020-01-01T00:04:30+00:00"
+        )
+        summaries = self.run_script("--watermark-lookback-days", "0")
+
+        self.assertEqual(summaries[0]["from_date"], "2020-01-01T00:04:30+00:00")
+        self.assertEqual(summaries[0]["upsert"]["upserted"], 5)
+        self.assert_commissions_booked(10)
+
+    def test_transactions_booked_late_within_the_lookback_are_picked_up(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 10, ["UK", "US"], transactions_start_date
+        )
+        self.run_script("-dt", "2020-01-01T00:10:00+00:00")
+        # Booked after the run, dated before the watermark it moved to
+        input_transactions = self.fake.transactions[(portfolio_scope, portfolio_code)]
+        input_transactions["txn-late"] = input_transactions["txn-00000005"]
+
+        summaries = self.run_script()
+
+        self.assertEqual(summaries[0]["from_date"], "2019-12-31T00:10:00+00:00")
+        self.assertEqual(summaries[0]["upsert"]["upserted"], 1)
+        self.assert_commissions_booked(11)
+
+    def test_dates_without_an_offset_are_taken_as_local_time(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 10, ["UK", "US"], transactions_start_date
+        )
+        properties = self.fake.portfolios[(portfolio_scope, portfolio_code)]["properties"]
+
+        first = self.run_script("-dt", "2020-01-01T00:04:30")
+        watermark = datetime(2020, 1, 1, 0, 4, 30).astimezone(timezone.utc)
+        self.assertEqual(properties[const.WATERMARK_PROPERTY], watermark.isoformat())
+        # A watermark stored without an offset by an earlier version is compared with the window all the same
+        properties[const.WATERMARK_PROPERTY] = "2020-01-01T00:04:30"
+        second = self.run_script("-dt", "2100-01-01T00:00:00")
+
+        self.assertEqual([first[0]["status"], second[0]["status"]], ["succeeded", "succeeded"])
+        self.assertEqual(second[0]["from_date"], (watermark - timedelta(days=1)).isoformat())
+        self.assertEqual(
+            properties[const.WATERMARK_PROPERTY], datetime(2100, 1, 1).astimezone(timezone.utc).isoformat()
+        )
+        self.assert_commissions_booked(10)
+
+    def test_throttled_calls_are_retried(self):
+        self.fake.throttle_rate = 0.3
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 40, ["UK", "US"], transactions_start_date
+        )
+
+        summaries = self.run_script("-b", "5")
+
+        self.assertGreater(self.fake.throttled_calls, 0)
+        # Each throttled call is retried once, by call_with_retry alone
+        self.assertEqual(sum(stats.retries for stats in run_metrics.api_calls.values()), self.fake.throttled_calls)
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assert_commissions_booked(40)
+
+    def test_waiting_on_pages_is_timed_as_fetching_not_computing(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 40, ["UK", "US"], transactions_start_date
+        )
+        self.fake.max_page_size = 10
+        self.fake.latency = 0.05
+
+        self.run_script()
+
+        stages = run_metrics.to_report()["stages"]
+        # Four pages of input transactions and one of the commissions already booked
+        self.assertEqual((stages["fetch_page"]["count"], stages["fetch_page"]["items"]), (5, 40))
+        self.assertGreaterEqual(stages["fetch_page"]["duration_seconds"], 0.25)
+        self.assertEqual((stages["compute_requests"]["count"], stages["compute_requests"]["items"]), (4, 40))
+        self.assertLess(stages["compute_requests"]["duration_seconds"], 0.05)
+
+    def test_adaptive_batching_grows_batches_until_they_are_slow(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 200, ["UK", "US"], transactions_start_date
+        )
+        upsert_transactions = FakeTransactionPortfoliosApi.upsert_transactions
+        upserts = []
+
+        def upsert_slowly_when_large(api, scope, code, transaction_request, **kwargs):
+            upserts.append(len(transaction_request))
+            if len(transaction_request) >= 20:
+                time.sleep(0.1)
+            return upsert_transactions(api, scope, code, transaction_request, **kwargs)
+
+        with mock.patch.object(FakeTransactionPortfoliosApi, "upsert_transactions", upsert_slowly_when_large), \
+                self.assertLogs(level="INFO") as logs:
+            summaries = self.run_script(
+                "--adaptive-batching", "-b", "5", "-f", "1", "--max-in-flight-limit", "1", "--min-batch-size", "5",
+                "--target-batch-seconds", "0.05"
+            )
+
+        # Batches grow by the minimum size while they are quick and are halved once one takes over the target. The
+        # next batch can be taken while the one before is in flight, so a size may be sent twice.
+        first_slow_batch = upserts.index(20)
+        self.assertEqual(upserts[:first_slow_batch], sorted(upserts[:first_slow_batch]))
+        self.assertEqual(max(upserts), 20)
+        self.assertIn(10, upserts[first_slow_batch + 1:])
+        self.assertTrue(any(
+            "Lowering upserts to batches of 10 with 1 in flight, from 20 with 1" in line for line in logs.output
+        ))
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assert_commissions_booked(200)
+
+    def test_batches_between_comfortable_and_slow_start_a_round_over(self):
+        batch_controller = AdaptiveBatchController(batch_size=10, max_in_flight=2, min_batch_size=5,
+                                                   target_batch_seconds=10.0)
+        batch_controller.changed_at -= 60
+        transaction_ids = [f"txn-{i}" for i in range(10)]
+
+        for duration_seconds in [1.0, 7.0, 1.0]:
+            batch_controller.batch_done(BatchResult(1, transaction_ids, 1, duration_seconds))
+        self.assertEqual((batch_controller.batch_size, batch_controller.max_in_flight), (10, 2))
+        batch_controller.batch_done(BatchResult(1, transaction_ids, 1, 1.0))
+
+        self.assertEqual((batch_controller.batch_size, batch_controller.max_in_flight), (15, 3))
+
+    def test_columnar_and_async_pipelines_book_the_same_commissions(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 30, ["UK", "US"], transactions_start_date
+        )
+        self.fake.max_page_size = 7
+
+        summaries = self.run_script("--columnar", "--async-pipeline", "-b", "4")
+
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assert_commissions_booked(30)
+
+    def test_portfolios_in_a_scope_are_resolved_in_one_listing(self):
+        for i in range(3):
+            self.fake.add_portfolio(
+                portfolio_scope, f"{portfolio_code}-{i}", portfolio_created_date, portfolio_entity, portfolio_broker
+            )
+            self.fake.add_synthetic_transactions(
+                portfolio_scope, f"{portfolio_code}-{i}", 5, ["UK", "US"], transactions_start_date
+            )
+
+        with patch_lusid(self.fake):
+            summaries = main.main(["main.py", "-s", portfolio_scope, "-a", "-dt", date_to_iso_str])
+
+        self.assertEqual([summary["status"] for summary in summaries], ["succeeded"] * 4)
+        self.assertEqual(self.fake.call_counts["list_portfolios_for_scope"], 1)
+        self.assertEqual(self.fake.call_counts["get_portfolio"], 0)
+
+    def test_requested_portfolios_are_resolved_in_a_listing_filtered_on_their_codes(self):
+        for i in range(8):
+            self.fake.add_portfolio(
+                portfolio_scope, f"{portfolio_code}-{i}", portfolio_created_date, portfolio_entity, portfolio_broker
+            )
+        requested = [(portfolio_scope, f"{portfolio_code}-{i}") for i in range(5)]
+        portfolio_index = PortfolioIndex([])
+
+        index_requested_portfolios(self.fake.build_factory(), portfolio_index, requested)
+        # Too few requested portfolios in the scope to be worth a listing
+        index_requested_portfolios(self.fake.build_factory(), PortfolioIndex([]), requested[:4])
+
+        self.assertEqual(sorted(portfolio_index.ids()), requested)
+        self.assertEqual(self.fake.call_counts["list_portfolios_for_scope"], 1)
+
+    def test_portfolio_groups_are_expanded_including_sub_groups(self):
+        self.fake.add_portfolio("other-scope", "other", portfolio_created_date, portfolio_entity, portfolio_broker)
+        self.fake.add_synthetic_transactions("other-scope", "other", 5, ["UK", "US"], transactions_start_date)
+        self.fake.add_synthetic_transactions(portfolio_scope, portfolio_code, 5, ["UK", "US"], transactions_start_date)
+        self.fake.add_portfolio_group("groups", "child", [("other-scope", "other")])
+        self.fake.add_portfolio_group("groups", "parent", [(portfolio_scope, portfolio_code)], [("groups", "child")])
+
+        with patch_lusid(self.fake):
+            summaries = main.main(["main.py", "-g", "groups/parent", "-dt", date_to_iso_str])
+
+        self.assertEqual(
+            sorted((summary["scope"], summary["status"]) for summary in summaries),
+            [("commissions-unit-test", "succeeded"), ("other-scope", "succeeded")]
+        )
+        self.assertEqual(self.fake.call_counts["get_portfolio"], 0)
+        self.assertEqual(len(self.fake.commission_transactions("other-scope", "other")), 5)
+
+    def test_instrument_countries_are_resolved_once_per_instrument(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 250, ["UK", "US"], transactions_start_date, instruments=100
+        )
+        self.fake.max_page_size = 50
+
+        self.run_script()
+
+        self.assertEqual(self.fake.call_counts["get_instruments"], 2)
+        self.assert_commissions_booked(250)
+
+    def test_countries_evicted_from_a_small_cache_are_not_skipped(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 250, ["UK", "US"], transactions_start_date, instruments=100
+        )
+
+        summaries = self.run_script("--country-cache-size", "10")
+
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assertEqual(summaries[0]["counts"].get("missing_country", 0), 0)
+        self.assert_commissions_booked(250)
+
+    def test_country_can_still_be_read_from_the_transactions(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 20, ["UK", "US"], transactions_start_date
+        )
+
+        summaries = self.run_script("--no-country-cache", "--columnar")
+
+        self.assertEqual(self.fake.call_counts["get_instruments"], 0)
+        self.assertEqual(summaries[0]["counts"]["created"], 20)
+        self.assert_commissions_booked(20)
+
+    def test_sharded_run_books_each_date_range_once(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 60, ["UK", "US"], transactions_start_date
+        )
+
+        self.fake.portfolios[(portfolio_scope, portfolio_code)]["created"] = transactions_start_date
+
+        # Shards run on threads here so that they share the in-process fake
+        with mock.patch("transaction_helpers.sharding.create_shard_executor", ThreadPoolExecutor):
+            summaries = self.run_script("--shards", "4", "-b", "7", "-dt", "2020-01-01T00:59:59+00:00")
+
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assertEqual(summaries[0]["counts"]["created"], 60)
+        self.assertEqual(summaries[0]["upsert"]["upserted"], 60)
+        # 15 transactions in each of the four date ranges, upserted in batches of at most 7
+        self.assertEqual(summaries[0]["upsert"]["batches"], 12)
+        self.assert_commissions_booked(60)
+
+    def test_portfolios_processed_at_once_share_one_pool_of_shard_processes(self):
+        for i in range(3):
+            self.fake.add_portfolio(
+                portfolio_scope, f"{portfolio_code}-{i}", transactions_start_date, portfolio_entity, portfolio_broker
+            )
+            self.fake.add_synthetic_transactions(
+                portfolio_scope, f"{portfolio_code}-{i}", 20, ["UK", "US"], transactions_start_date
+            )
+        executors = []
+
+        def create_shard_executor(max_workers):
+            executors.append(ThreadPoolExecutor(max_workers))
+            return executors[-1]
+
+        with mock.patch("transaction_helpers.sharding.create_shard_executor", create_shard_executor), \
+                patch_lusid(self.fake):
+            summaries = main.main([
+                "main.py", "-p", *(f"{portfolio_scope}/{portfolio_code}-{i}" for i in range(3)), "-w", "3",
+                "--shards", "4", "--shard-processes", "2", "-dt", "2020-01-01T00:59:59+00:00"
+            ])
+
+        self.assertEqual([summary["status"] for summary in summaries], ["succeeded"] * 3)
+        self.assertEqual(len(executors), 1)
+        self.assertEqual(executors[0]._max_workers, 2)
+        # Shut down once the run is over, the next run starts a pool of its own
+        self.assertTrue(executors[0]._shutdown)
+
+    def test_date_ranges_are_contiguous_without_overlapping(self):
+        date_ranges = split_date_range("2020-01-01T00:00:00+00:00", "2020-01-04T00:00:00+00:00", 3)
+
+        self.assertEqual(date_ranges, [
+            ("2020-01-01T00:00:00+00:00", "2020-01-01T23:59:59.999999+00:00"),
+            ("2020-01-02T00:00:00+00:00", "2020-01-02T23:59:59.999999+00:00"),
+            ("2020-01-03T00:00:00+00:00", "2020-01-04T00:00:00+00:00"),
+        ])
+
+    def test_resumed_run_continues_after_the_last_committed_page(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 30, ["UK", "US"], transactions_start_date
+        )
+        self.fake.max_page_size = 10
+        upsert_transactions = FakeTransactionPortfoliosApi.upsert_transactions
+        upserts = []
+
+        def upsert_until_rejected(api, scope, code, transaction_request, **kwargs):
+            upserts.append(len(transaction_request))
+            if len(upserts) > 3:
+                raise ApiException(http_resp=FakeHttpResponse(400, "Bad Request"))
+            return upsert_transactions(api, scope, code, transaction_request, **kwargs)
+
+        with mock.patch.object(FakeTransactionPortfoliosApi, "upsert_transactions", upsert_until_rejected):
+            summaries = self.run_script("-b", "5", "-f", "1")
+        self.assertEqual(summaries[0]["status"], "failed")
+
+        self.fake.call_counts.clear()
+        summaries = self.run_script("-b", "5", "--resume", "-dt", "2100-06-01T00:00:00+00:00")
+
+        # Page 1 was committed, page 2 was only partly upserted so the run resumes from page 2
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assertEqual(summaries[0]["to_date"], date_to_iso_str)
+        self.assertEqual(summaries[0]["counts"]["created"] + summaries[0]["counts"]["unchanged"], 20)
+        self.assertEqual(summaries[0]["counts"]["unchanged"], 5)
+        self.assert_commissions_booked(30)
+        self.assertEqual(os.listdir(os.path.join(os.environ["FBN_COMMISSIONS_CACHE_DIR"], "checkpoints")), [])
+
+    def test_resumed_run_keeps_a_window_relative_to_the_time_of_the_run(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 30, ["UK", "US"], datetime.now(timezone.utc) - timedelta(days=1)
+        )
+        self.fake.max_page_size = 10
+        upsert_transactions = FakeTransactionPortfoliosApi.upsert_transactions
+        upserts = []
+
+        def upsert_until_rejected(api, scope, code, transaction_request, **kwargs):
+            upserts.append(len(transaction_request))
+            if len(upserts) > 3:
+                raise ApiException(http_resp=FakeHttpResponse(400, "Bad Request"))
+            return upsert_transactions(api, scope, code, transaction_request, **kwargs)
+
+        arguments = ["main.py", "-s", portfolio_scope, "-c", portfolio_code, "-b", "5", "-f", "1", "-d", "5"]
+        with patch_lusid(self.fake):
+            with mock.patch.object(FakeTransactionPortfoliosApi, "upsert_transactions", upsert_until_rejected):
+                interrupted = main.main(arguments)
+            self.fake.call_counts.clear()
+            summaries = main.main(arguments + ["--resume"])
+
+        # The "from" date of the resumed run is the interrupted run's, not five days before the time it restarted
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assertEqual(summaries[0]["from_date"], interrupted[0]["from_date"])
+        self.assertEqual(summaries[0]["to_date"], interrupted[0]["to_date"])
+        self.assertEqual(summaries[0]["counts"]["created"] + summaries[0]["counts"]["unchanged"], 20)
+        self.assert_commissions_booked(30)
+        self.assertEqual(os.listdir(os.path.join(os.environ["FBN_COMMISSIONS_CACHE_DIR"], "checkpoints")), [])
+
+    def test_journals_of_a_window_never_resumed_are_removed(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 10, ["UK", "US"], transactions_start_date
+        )
+        with mock.patch.object(FakeTransactionPortfoliosApi, "upsert_transactions",
+                               side_effect=ApiException(http_resp=FakeHttpResponse(400, "Bad Request"))):
+            self.assertEqual(self.run_script("-dt", "2100-02-01T00:00:00+00:00")[0]["status"], "failed")
+        checkpoint_dir = os.path.join(os.environ["FBN_COMMISSIONS_CACHE_DIR"], "checkpoints")
+        self.assertEqual(len(os.listdir(checkpoint_dir)), 1)
+
+        summaries = self.run_script()
+
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assertEqual(os.listdir(checkpoint_dir), [])
+
+    def test_async_pipeline_keeps_as_many_upserts_in_flight_as_asked_for(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 40, ["UK", "US"], transactions_start_date
+        )
+        upsert_transactions = FakeTransactionPortfoliosApi.upsert_transactions
+        in_flight = []
+        lock = threading.Lock()
+
+        def slow_upsert_transactions(api, *args, **kwargs):
+            with lock:
+                in_flight.append(in_flight[-1] + 1 if in_flight else 1)
+            time.sleep(0.05)
+            try:
+                return upsert_transactions(api, *args, **kwargs)
+            finally:
+                with lock:
+                    in_flight.append(in_flight[-1] - 1)
+
+        with mock.patch.object(FakeTransactionPortfoliosApi, "upsert_transactions", slow_upsert_transactions):
+            summaries = self.run_script("--async-pipeline", "-b", "1", "-f", "12")
+
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assertGreater(max(in_flight), 8)
+
+    def test_resume_is_rejected_with_the_async_pipeline(self):
+        with self.assertRaises(SystemExit), mock.patch("sys.stderr"):
+            self.run_script("--resume", "--async-pipeline")
+
+    def test_commissions_of_cancelled_transactions_are_cancelled(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 30, ["UK", "US"], transactions_start_date
+        )
+        self.run_script()
+        input_transactions = self.fake.transactions[(portfolio_scope, portfolio_code)]
+        input_ids = sorted(
+            transaction_id for transaction_id, transaction in input_transactions.items()
+            if transaction[0] != "Commission"
+        )
+        # One input transaction is cancelled and another amended to a type the script does not book commissions for
+        del input_transactions[input_ids[0]]
+        input_transactions[input_ids[1]] = ("Dividend",) + input_transactions[input_ids[1]][1:]
+
+        summaries = self.run_script("--cancel-orphaned-commissions", "--dry-run")
+
+        self.assertEqual(summaries[0]["status"], "dry-run")
+        self.assertEqual(summaries[0]["orphaned_commissions"], {
+            f"{input_ids[0]}_commission": input_ids[0], f"{input_ids[1]}_commission": input_ids[1],
+        })
+        self.assertEqual(len(self.fake.commission_transactions(portfolio_scope, portfolio_code)), 30)
+        self.assertEqual(self.fake.call_counts["cancel_transactions"], 0)
+
+        summaries = self.run_script("--cancel-orphaned-commissions")
+
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assertEqual(summaries[0]["cancelled"], 2)
+        self.assertEqual(self.fake.call_counts["cancel_transactions"], 1)
+        commissions = self.fake.commission_transactions(portfolio_scope, portfolio_code)
+        self.assertEqual(len(commissions), 28)
+        self.assertNotIn(f"{input_ids[0]}_commission", commissions)
+
+    def test_commissions_of_inputs_amended_to_before_the_window_are_not_cancelled(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 30, ["UK", "US"], transactions_start_date
+        )
+        self.run_script()
+        input_transactions = self.fake.transactions[(portfolio_scope, portfolio_code)]
+        input_ids = sorted(
+            transaction_id for transaction_id, transaction in input_transactions.items()
+            if transaction[0] != "Commission"
+        )
+        # One input transaction is cancelled and another amended to a date before the window of the cancelling run
+        del input_transactions[input_ids[0]]
+        amended = input_transactions[input_ids[1]]
+        input_transactions[input_ids[1]] = amended[:2] + (datetime(2019, 6, 1, tzinfo=timezone.utc),) + amended[3:]
+
+        with patch_lusid(self.fake):
+            summaries = main.main([
+                "main.py", "-s", portfolio_scope, "-c", portfolio_code, "-dt", "2020-01-10T00:00:00+00:00", "-d", "30",
+                "--cancel-orphaned-commissions"
+            ])
+
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assertEqual(summaries[0]["cancelled"], 1)
+        commissions = self.fake.commission_transactions(portfolio_scope, portfolio_code)
+        self.assertNotIn(f"{input_ids[0]}_commission", commissions)
+        self.assertIn(f"{input_ids[1]}_commission", commissions)
+
+    def test_mapping_misses_are_counted_per_combination(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 12, ["UK", "XX"], transactions_start_date
+        )
+
+        summaries = self.run_script()
+
+        self.assertEqual(summaries[0]["counts"]["created"], 12)
+        self.assertEqual(summaries[0]["counts"]["mapping_misses"], {f"XX/{portfolio_broker}/{portfolio_entity}": 6})
+        self.assertEqual(len(self.fake.commission_transactions(portfolio_scope, portfolio_code)), 12)
+
+    def test_watermark_is_held_until_missing_rates_are_added(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 12, ["UK", "XX"], transactions_start_date
+        )
+        properties = self.fake.portfolios[(portfolio_scope, portfolio_code)]["properties"]
+
+        summaries = self.run_script()
+        self.assertEqual(summaries[0]["watermark_held"], 6)
+        self.assertNotIn(const.WATERMARK_PROPERTY, properties)
+        fixed_config = dict(commissions_rate_config, XX={portfolio_broker: {portfolio_entity: 0.5}})
+        self.fake.add_drive_file("/CommissionConfig", "commission-config.json", json.dumps(fixed_config))
+        summaries = self.run_script("--config-cache-ttl", "0")
+
+        self.assertEqual(summaries[0]["counts"]["created"], 6)
+        self.assertEqual(properties[const.WATERMARK_PROPERTY], date_to_iso_str)
+        commissions = self.fake.commission_transactions(portfolio_scope, portfolio_code)
+        input_transactions = self.fake.transactions[(portfolio_scope, portfolio_code)]
+        for commission in commissions.values():
+            input_transaction = input_transactions[commission[7]]
+            if self.fake.instrument_countries[input_transaction[1]] == "XX":
+                self.assertAlmostEqual(commission[5], input_transaction[5] * 0.5)
+
+    def test_rules_match_on_transaction_type_instrument_and_notional_tiers(self):
+        rules_config = dict(commissions_rate_config, rules=[
+            {"country": "UK", "broker": portfolio_broker, "transaction_type": ["Sell", "FxSell"],
+             "tiers": [{"from": 0, "rate": 0.3}, {"from": 9, "rate": 0.2}]},
+            {"instrument": "LUID_00000001", "broker": portfolio_broker, "entity": portfolio_entity, "rate": 0.5},
+        ])
+        self.fake.add_drive_file("/CommissionConfig", "commission-config.json", json.dumps(rules_config))
+        # Even transactions are Sells of UK instruments and odd ones Buys of US instruments
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 12, ["UK", "US"], transactions_start_date, instruments=4
+        )
+
+        for args in [(), ("--full-rebuild", "--columnar")]:
+            summaries = self.run_script(*args)
+            self.assertEqual(summaries[0]["status"], "succeeded")
+
+            commissions = self.fake.commission_transactions(portfolio_scope, portfolio_code)
+            input_transactions = self.fake.transactions[(portfolio_scope, portfolio_code)]
+            for i in range(12):
+                input_transaction = input_transactions[f"txn-{i:08d}"]
+                if i % 4 == 1:
+                    rate = 0.5
+                elif i % 2 == 0:
+                    rate = 0.3 if input_transaction[5] < 9 else 0.2
+                else:
+                    rate = commissions_rate_config["US"][portfolio_broker][portfolio_entity]
+                self.assertAlmostEqual(commissions[f"txn-{i:08d}_commission"][5], input_transaction[5] * rate)
+
+    def test_rules_matching_on_more_dimensions_win(self):
+        config_path = os.path.join(tempfile.mkdtemp(), "commission-config.json")
+        with open(config_path, "w") as config_file:
+            json.dump({"UK": {"UBS": {"entity1": 0.1}}, "rules": [
+                {"transaction_type": "Buy", "rate": 0.9},
+                {"country": "UK", "instrument": "LUID_00000001", "rate": 0.7},
+                {"instrument": "LUID_00000001", "broker": "UBS", "entity": "entity1", "rate": 0.5},
+            ]}, config_file)
+        rate_table = get_commission_rate_table(config_path)
+
+        # A rule on the transaction type alone does not override the exact rate of the mapping
+        self.assertEqual(rate_table.find_rate("UK", "UBS", "entity1", "Buy"), 0.1)
+        self.assertEqual(rate_table.find_rate("US", "UBS", "entity1", "Buy"), 0.9)
+        # As many dimensions as the mapping, one of them the instrument
+        self.assertEqual(rate_table.find_rate("UK", "UBS", "entity1", "Buy", "LUID_00000001"), 0.5)
+        self.assertEqual(rate_table.find_rate("UK", "JPM", "entity1", "Buy", "LUID_00000001"), 0.7)
+
+    def test_service_books_transactions_as_they_arrive_until_stopped(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 10, ["UK", "US"], transactions_start_date
+        )
+        services = []
+        health_servers = []
+
+        class RecordingService(main.CommissionService):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                services.append(self)
+
+        def wait_for(condition):
+            deadline = time.monotonic() + 10
+            while not condition():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+        def start_health_server(*args, **kwargs):
+            health_servers.append(main_start_health_server(*args, **kwargs))
+            return health_servers[-1]
+
+        main_start_health_server = main.start_health_server
+        with patch_lusid(self.fake), mock.patch.object(main, "CommissionService", RecordingService), \
+                mock.patch.object(main, "start_health_server", start_health_server):
+            service_thread = threading.Thread(target=main.main, args=([
+                "main.py", "-s", portfolio_scope, "-c", portfolio_code, "--serve", "--poll-interval", "0.05",
+                "--health-port", "0"
+            ],))
+            service_thread.start()
+            try:
+                commissions = lambda: self.fake.commission_transactions(portfolio_scope, portfolio_code)
+                wait_for(lambda: len(commissions()) == 10)
+
+                # Booked after the watermark was moved past it, as a trade dated the start of the day would be
+                booked_late = datetime.now(timezone.utc) - timedelta(hours=1)
+                self.fake.transactions[(portfolio_scope, portfolio_code)]["txn-late"] = (
+                    "Buy", "LUID_00000000", booked_late, booked_late + timedelta(days=2), 10.0, 15.0, "GBP", None
+                )
+                self.fake.record_command(portfolio_scope, portfolio_code, "UpsertTransactions")
+                wait_for(lambda: "txn-late_commission" in commissions())
+
+                port = health_servers[0].server_address[1]
+                with urllib.request.urlopen(f"http://localhost:{port}/healthz") as response:
+                    self.assertEqual(json.load(response)["status"], "ok")
+                with urllib.request.urlopen(f"http://localhost:{port}/metrics") as response:
+                    self.assertIn("commissions_run_events_total{event=\"service_polls\"}", response.read().decode())
+            finally:
+                wait_for(lambda: services)
+                services[0].stop()
+                service_thread.join()
+
+        self.assert_commissions_booked(11)
+
+    def test_commissions_are_computed_from_a_snapshot_and_upserted_later(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 12, ["UK", "US"], transactions_start_date
+        )
+        snapshot_dir = tempfile.mkdtemp()
+        commissions_path = os.path.join(snapshot_dir, "commissions.ndjson")
+        config_path = os.path.join(snapshot_dir, "commission-config.json")
+        with open(config_path, "w") as config_file:
+            json.dump({
+                "UK": {portfolio_broker: {portfolio_entity: 0.5}}, "US": {portfolio_broker: {portfolio_entity: 0.25}}
+            }, config_file)
+
+        summaries = self.run_script("--export-snapshot", snapshot_dir)
+        snapshot_path = summaries[0]["snapshot_path"]
+        self.assertEqual(summaries[0]["transactions"], 12)
+        self.assertEqual(self.fake.commission_transactions(portfolio_scope, portfolio_code), {})
+        self.assertNotIn(
+            const.WATERMARK_PROPERTY, self.fake.portfolios[(portfolio_scope, portfolio_code)]["properties"]
+        )
+
+        self.fake.call_counts.clear()
+        with patch_lusid(self.fake):
+            summaries = main.main(["main.py", "--from-snapshot", snapshot_path, "--config-file", config_path,
+                                   "--commissions-out", commissions_path, "--columnar"])
+            self.assertEqual(summaries[0]["counts"]["created"], 12)
+            self.assertEqual(sum(self.fake.call_counts.values()), 0)
+
+            summaries = main.main(["main.py", "--upsert-commissions", commissions_path, "-b", "5"])
+        self.assertEqual(summaries[0]["upsert"]["batches"], 3)
+
+        commissions = self.fake.commission_transactions(portfolio_scope, portfolio_code)
+        input_transactions = self.fake.transactions[(portfolio_scope, portfolio_code)]
+        self.assertEqual(len(commissions), 12)
+        for commission in commissions.values():
+            input_transaction = input_transactions[commission[7]]
+            rate = 0.5 if self.fake.instrument_countries[input_transaction[1]] == "UK" else 0.25
+            self.assertAlmostEqual(commission[5], input_transaction[5] * rate)
+
+    def test_drive_config_is_cached_for_its_ttl_and_can_be_used_offline(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 5, ["UK", "US"], transactions_start_date
+        )
+
+        self.run_script()
+        self.run_script()
+        self.assertEqual([self.fake.call_counts["drive_search"], self.fake.call_counts["drive_download_file"]], [1, 1])
+        # Past the TTL Drive is asked for the version, and the file only downloaded again once it has changed
+        self.run_script("--config-cache-ttl", "0")
+        self.assertEqual([self.fake.call_counts["drive_search"], self.fake.call_counts["drive_download_file"]], [2, 1])
+        self.fake.add_drive_file("/CommissionConfig", "commission-config.json", json.dumps(commissions_rate_config))
+        self.run_script("--config-cache-ttl", "0")
+        self.assertEqual([self.fake.call_counts["drive_search"], self.fake.call_counts["drive_download_file"]], [3, 2])
+        # The copy of the version replaced is removed rather than left to fill the cache directory
+        cache_dir = os.environ["FBN_COMMISSIONS_CACHE_DIR"]
+        self.assertEqual(len([name for name in os.listdir(cache_dir) if name.startswith("file-")]), 1)
+
+        self.fake.drive_files.clear()
+        summaries = self.run_script("--offline", "--full-rebuild")
+
+        self.assertEqual(summaries[0]["status"], "succeeded")
+        self.assertEqual(self.fake.call_counts["drive_search"], 3)
+        os.environ["FBN_COMMISSIONS_CACHE_DIR"] = tempfile.mkdtemp()
+        with self.assertRaises(FileNotFoundError):
+            self.run_script("--offline")
+
+    def test_drive_config_refreshes_wait_for_the_cache_lock(self):
+        cache_dir = os.environ["FBN_COMMISSIONS_CACHE_DIR"]
+        paths = []
+
+        with patch_lusid(self.fake):
+            refresh = threading.Thread(
+                target=lambda: paths.append(get_cached_file_from_drive("CommissionConfig", "commission-config.json"))
+            )
+            with cache_lock(cache_dir):
+                refresh.start()
+                refresh.join(0.2)
+                self.assertTrue(refresh.is_alive())
+                self.assertEqual(self.fake.call_counts["drive_search"], 0)
+            refresh.join()
+
+        with open(paths[0]) as config_file:
+            self.assertEqual(json.load(config_file), commissions_rate_config)
+
+    def test_run_metrics_are_written_as_json_prometheus_and_openmetrics(self):
+        self.fake.add_synthetic_transactions(
+            portfolio_scope, portfolio_code, 5, ["UK", "US"], transactions_start_date
+        )
+        output_dir = tempfile.mkdtemp()
+        report_path = os.path.join(output_dir, "metrics.json")
+        textfile_path = os.path.join(output_dir, "commissions.prom")
+
+        self.run_script("--metrics-report", report_path, "--prometheus-textfile", textfile_path)
+        with open(report_path) as report_file:
+            report = json.load(report_file)
+        with open(textfile_path) as textfile:
+            prometheus = textfile.read().splitlines()
+        self.run_script("--prometheus-textfile", textfile_path, "--openmetrics")
+        with open(textfile_path) as textfile:
+            openmetrics = textfile.read().splitlines()
+
+        self.assertEqual(report["counters"]["transactions_upserted"], 5)
+        self.assertEqual(report["api_calls"]["FakeTransactionPortfoliosApi.upsert_transactions"]["request_items"], 5)
+        self.assertIn("# TYPE commissions_run_events_total counter", prometheus)
+        self.assertIn('commissions_run_events_total{event="transactions_upserted"} 5', prometheus)
+        self.assertNotEqual(prometheus[-1], "# EOF")
+        self.assertIn("# TYPE commissions_run_events counter", openmetrics)
+        self.assertIn('commissions_api_calls_total{method="FakePortfoliosApi.get_portfolio",outcome="success"} 1',
+                      openmetrics)
+        self.assertEqual(openmetrics[-1], "# EOF")
+        # Written atomically, without a temporary file left behind
+        self.assertEqual(sorted(os.listdir(output_dir)), ["commissions.prom", "metrics.json"])
+
+    def test_environment_is_checked_once_per_api_factory(self):
+        api_factory = self.fake.build_factory()
+        other_api_factory = self.fake.build_factory()
+
+        main.setup_environment(api_factory)
+        main.setup_environment(api_factory)
+        self.assertEqual(self.fake.call_counts["get_multiple_property_definitions"], 1)
+        self.assertEqual(self.fake.call_counts["create_property_definition"], 6)
+        self.assertEqual(self.fake.call_counts["create_configuration_transaction_type"], 1)
+        # A new factory checks again, only to find everything exists
+        main.setup_environment(other_api_factory)
+
+        self.assertEqual(self.fake.call_counts["get_multiple_property_definitions"], 2)
+        self.assertEqual(self.fake.call_counts["create_property_definition"], 6)
+        self.assertEqual(self.fake.call_counts["create_configuration_transaction_type"], 1)
+        # Nor is a factory taken as checked for having been given the id of one since garbage collected
+        del api_factory, other_api_factory
+        main.setup_environment(self.fake.build_factory())
+        self.assertEqual(self.fake.call_counts["get_multiple_property_definitions"], 3)
+
+    def test_commission_config_is_reloaded_once_changed_on_disk(self):
+        config_path = os.path.join(tempfile.mkdtemp(), "commission-config.json")
+        with open(config_path, "w") as config_file:
+            json.dump(commissions_rate_config, config_file)
+        rate_table = get_commission_rate_table(config_path)
+        rate = rate_table.find_schedule("UK", portfolio_broker, portfolio_entity)
+
+        self.assertIs(get_commission_rate_table(config_path), rate_table)
+        with open(config_path, "w") as config_file:
+            json.dump({"UK": {portfolio_broker: {portfolio_entity: rate * 2}}}, config_file)
+        os.utime(config_path, ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+
+        self.assertEqual(get_commission_rate_table(config_path).find_schedule("UK", portfolio_broker, portfolio_entity),
+                         rate * 2)
+        self.assertIsNone(rate_table.find_schedule("US", portfolio_broker, portfolio_entity))
+
+    def test_a_reload_part_way_through_a_lookup_does_not_mix_two_versions_of_the_config(self):
+        config_path = os.path.join(tempfile.mkdtemp(), "commission-config.json")
+        with open(config_path, "w") as config_file:
+            json.dump({"rules": [{"country": "UK", "instrument": "LUID_1", "rate": 0.002}]}, config_file)
+        rate_table = get_commission_rate_table(config_path)
+
+        class ReloadingRules(dict):
+            # Stands in for another thread reloading a changed config while the lookup probes the rules
+            def get(self, key, default=None):
+                if not reloaded:
+                    reloaded.append(True)
+                    with open(config_path, "w") as config_file:
+                        json.dump({"UK": {portfolio_broker: {portfolio_entity: 0.001}}}, config_file)
+                    rate_table.reload()
+                return super().get(key, default)
+
+        reloaded = []
+        rate_table._compiled.rules = ReloadingRules(rate_table.rules)
+
+        self.assertEqual(rate_table.find_schedule("UK", portfolio_broker, portfolio_entity, instrument="LUID_1"), 0.002)
+        self.assertEqual(rate_table.find_schedule("UK", portfolio_broker, portfolio_entity, instrument="LUID_1"), 0.001)
+
+    def test_batch_sizes_and_concurrency_must_be_positive(self):
+        for args in [("-b", "0"), ("-f", "0"), ("-w", "-1"), ("--min-batch-size", "0")]:
+            with self.subTest(args=args), self.assertRaises(SystemExit), mock.patch("sys.stderr"):
+                self.run_script(*args)
+
+    def test_a_snapshot_cannot_be_computed_and_a_commissions_file_upserted_in_one_run(self):
+        with self.assertRaises(SystemExit), mock.patch("sys.stderr"):
+            main.main(
+                ["main.py", "--from-snapshot", "snapshot.ndjson.gz", "--upsert-commissions", "commissions.ndjson"]
+            )
+
+    def test_logging_setup_does_not_add_a_handler_each_call(self):
+        handlers = len(logging.getLogger().handlers)
+
+        self.run_script("--log-level", "DEBUG", "--log-sample-every", "5")
+        self.run_script("--log-level", "INFO")
+
+        self.assertEqual(len(logging.getLogger().handlers), handlers)
+        self.assertEqual(logging.getLogger().level, logging.INFO)
+
+    def test_log_level_is_case_insensitive_and_must_be_known(self):
+        self.run_script("--log-level", "warning")
+        self.assertEqual(logging.getLogger().level, logging.WARNING)
+        self.run_script("--log-level", "info")
+
+        with self.assertRaises(SystemExit), mock.patch("sys.stderr"):
+            self.run_script("--log-level", "FOO")
+
+
+class StubPoolManager:
+    # Stands in for the urllib3 pool of a generated ApiClient, answering every request with the same gzipped body
+    # once the first `throttles` requests have been answered with a 429
+
+    def __init__(self, response_body: dict, throttles=0):
+        self.response_body = gzip.compress(json.dumps(response_body).encode())
+        self.throttles = throttles
+        self.requests = []
+
+    def request(self, method, url, *args, body=None, headers=None, **kwargs):
+        self.requests.append((method, body, headers or {}))
+        if len(self.requests) <= self.throttles:
+            return urllib3.HTTPResponse(
+                body=io.BytesIO(b"{}"), status=429, reason="Too Many Requests", preload_content=True,
+                headers={"Content-Type": "application/json", "Retry-After": "0"}
+            )
+        return urllib3.HTTPResponse(
+            body=io.BytesIO(self.response_body), status=200, preload_content=True, decode_content=True,
+            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"}
+        )
+
+
+class StubApiClientFactory:
+
+    def __init__(self, api_client):
+        self.api_client = api_client
+
+    def build(self, api_class):
+        return api_class(self.api_client)
+
+
+class ApiClientTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        run_metrics.reset()
+        self.api_client = lusid.ApiClient(lusid.Configuration(host="https://lusid.test/api"))
+        self.pool_manager = StubPoolManager({
+            "href": "https://lusid.test/api", "values": {}, "links": [],
+            "version": {"effectiveFrom": "2020-01-01T00:00:00+00:00", "asAtDate": "2020-01-01T00:00:00+00:00"}
+        })
+        self.api_client.rest_client.pool_manager = self.pool_manager
+
+    def test_client_pool_is_resized_and_asks_for_gzipped_responses(self):
+        configure_api_client(self.api_client, pool_size=40)
+
+        self.assertEqual(self.api_client.rest_client.pool_manager.connection_pool_kw["maxsize"], 40)
+        self.assertEqual(self.api_client.default_headers["Accept-Encoding"], "gzip")
+
+    def test_upserts_are_gzipped_and_their_wire_bytes_reach_the_batch_controller(self):
+        api_factory = InstrumentedApiClientFactory(StubApiClientFactory(self.api_client))
+        compress_request_bodies(get_pool_manager(api_factory))
+        commissions = [
+            CommissionRecord(f"txn-{i}", "2020-01-01T00:00:00+00:00", "2020-01-03T00:00:00+00:00", "GBP", 1.0, 1.5)
+            for i in range(10)
+        ]
+        batch_controller = AdaptiveBatchController(batch_size=5, max_in_flight=1, min_batch_size=1,
+                                                   max_batch_bytes=100)
+
+        report = upsert_transactions(api_factory, "scope", "code", commissions, batch_controller=batch_controller)
+
+        request_bodies = [body for _, body, _ in self.pool_manager.requests]
+        self.assertTrue(all(headers["Content-Encoding"] == "gzip" for _, _, headers in self.pool_manager.requests))
+        self.assertEqual(len(json.loads(gzip.decompress(request_bodies[0]))), 5)
+        self.assertEqual(report.batch_results[0].payload_bytes, len(request_bodies[0]))
+        # The first batch was over max_batch_bytes once compressed
+        self.assertEqual(batch_controller.batch_size, 2)
+        api_calls = run_metrics.api_calls["TransactionPortfoliosApi.upsert_transactions"]
+        self.assertEqual(api_calls.bytes_sent, sum(len(body) for body in request_bodies))
+        self.assertEqual(api_calls.bytes_received, len(request_bodies) * len(self.pool_manager.response_body))
+
+    def test_throttles_reach_the_batch_controller_through_the_sdk_retry_wrapper(self):
+        # The SDK's factory, without the secrets it would authenticate with, around the client with the stubbed pool
+        sdk_api_factory = object.__new__(lusid.utilities.ApiClientFactory)
+        sdk_api_factory.api_client = self.api_client
+        self.pool_manager.throttles = 2
+        # Its apis retry the 429s inside lusidretry, unseen by the caller
+        sdk_api_factory.build(lusid.api.TransactionPortfoliosApi).upsert_transactions(
+            scope="scope", code="code", transaction_request=[]
+        )
+        self.assertEqual(len(self.pool_manager.requests), 3)
+        self.pool_manager.requests.clear()
+        api_factory = InstrumentedApiClientFactory(sdk_api_factory, sdk_retries=False)
+        commissions = [
+            CommissionRecord(f"txn-{i}", "2020-01-01T00:00:00+00:00", "2020-01-03T00:00:00+00:00", "GBP", 1.0, 1.5)
+            for i in range(5)
+        ]
+        batch_controller = AdaptiveBatchController(batch_size=5, max_in_flight=4)
+
+        report = upsert_transactions(api_factory, "scope", "code", commissions, batch_controller=batch_controller)
+
+        self.assertEqual(len(self.pool_manager.requests), 3)
+        self.assertEqual((report.batch_results[0].attempts, report.batch_results[0].throttles), (3, 2))
+        self.assertEqual(batch_controller.max_in_flight, 2)
+        api_calls = run_metrics.api_calls["TransactionPortfoliosApi.upsert_transactions"]
+        self.assertEqual((api_calls.calls, api_calls.retries), (3, 2))
+
+    def test_bytes_sent_are_counted_once_encoded(self):
+        api_factory = InstrumentedApiClientFactory(StubApiClientFactory(self.api_client))
+
+        get_pool_manager(api_factory).request("POST", "https://lusid.test/api", body="£" * 10)
+
+        self.assertEqual(run_metrics.api_calls["unknown"].bytes_sent, 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lusid
+
+from helpers.commission_rates import get_commission_rate_table
+from helpers.instrumentation import run_metrics
+from transaction_helpers.columnar_processing import get_commission_batch, iter_transaction_requests_from_batch
+from transaction_helpers.transaction_processing import iter_transaction_requests_from_input_transactions
+from transaction_helpers.transaction_retrieval import fetch_transaction_record_page
+from transaction_helpers.transaction_upsertion import UpsertReport, upsert_batch
+
+_end_of_stage = object()
+
+
+def build_page_requests(page: list, country_prop, entity, broker, existing_commissions, counts, columnar,
+                        instrument_countries=None) -> list:
+    with run_metrics.stage("compute_requests", len(page)):
+        if columnar:
+            batch = get_commission_batch(
+                page, country_prop, entity, broker, get_commission_rate_table(), counts, instrument_countries
+            )
+            return list(iter_transaction_requests_from_batch(batch, existing_commissions, counts))
+
+        return list(iter_transaction_requests_from_input_transactions(
+            page, country_prop, entity, broker, existing_commissions, counts, instrument_countries
+        ))
+
+
+async def run_commission_pipeline(api_factory, scope, portfolio_code, end_date: str, start_date: str,
+                                  input_txn_filter, country_prop, entity, broker, existing_commissions=None,
+                                  counts=None, columnar=False, page_size=5000, batch_size=5000, max_in_flight=4,
+                                  max_attempts=5, max_concurrent_calls=None, queue_size=2,
+                                  instrument_countries=None, batch_controller=None) -> UpsertReport:
+    # Fetch, transform and upsert run as concurrent stages joined by bounded queues, so page N+1 is fetched while
+    # page N is transformed and earlier batches are upserted. The SDK is synchronous so its calls run on worker
+    # threads, and a semaphore caps how many of them are in flight against LUSID at once. With
+    # instrument_countries the transactions are fetched without properties and each page's instrument countries
+    # are resolved in bulk by the fetch stage. With a batch_controller the batch size and the upserts in flight
+    # follow its current settings, up to its limit of upsert workers.
+    transaction_portfolios_api = api_factory.build(lusid.api.TransactionPortfoliosApi)
+    upsert_workers = batch_controller.max_in_flight_limit if batch_controller else max_in_flight
+    # Unless capped lower, every upsert worker may have a call in flight alongside the fetch stage's page fetch or
+    # instrument lookup, so the cap follows the upserts in flight rather than holding them back. The stages run on
+    # threads of their own, the loop's default executor is sized on the CPU count and would cap them again.
+    max_concurrent_calls = max_concurrent_calls or upsert_workers + 1
+    api_calls = asyncio.Semaphore(max_concurrent_calls)
+    executor = ThreadPoolExecutor(max_workers=max_concurrent_calls + 1, thread_name_prefix=f"pipeline-{scope}")
+    loop = asyncio.get_running_loop()
+    upserts = asyncio.Condition()
+    upserts_in_flight = 0
+    page_queue = asyncio.Queue(maxsize=queue_size)
+    batch_queue = asyncio.Queue(maxsize=max(queue_size, upsert_workers))
+    report = UpsertReport(scope, portfolio_code)
+    start_time = time.perf_counter()
+
+    def run_in_thread(func, *args):
+        return loop.run_in_executor(executor, func, *args)
+
+    async def fetch():
+        page = None
+        while True:
+            async with api_calls:
+                records, page = await run_in_thread(
+                    fetch_transaction_record_page, transaction_portfolios_api, scope, portfolio_code, end_date,
+                    start_date, input_txn_filter, None if instrument_countries is not None else country_prop,
+                    None, page_size, page
+                )
+                page_countries = None
+                if instrument_countries is not None:
+                    page_countries = await run_in_thread(
+                        instrument_countries.prefetch, api_factory, [record.instrument_uid for record in records]
+                    )
+            run_metrics.increment("transactions_fetched", len(records))
+            await page_queue.put((records, page_countries))
+
+            if not page:
+                break
+        await page_queue.put(_end_of_stage)
+
+    async def transform():
+        pending = []
+        batch_number = 0
+        while True:
+            item = await page_queue.get()
+            if item is _end_of_stage:
+                break
+
+            page, page_countries = item
+            pending.extend(await run_in_thread(
+                build_page_requests, page, country_prop, entity, broker, existing_commissions, counts, columnar,
+                page_countries
+            ))
+            next_batch_size = get_batch_size()
+            while len(pending) >= next_batch_size:
+                batch_number += 1
+                await batch_queue.put((batch_number, pending[:next_batch_size]))
+                pending = pending[next_batch_size:]
+                next_batch_size = get_batch_size()
+
+        if pending:
+            batch_number += 1
+            await batch_queue.put((batch_number, pending))
+        for _ in range(upsert_workers):
+            await batch_queue.put(_end_of_stage)
+
+    def get_batch_size():
+        return batch_controller.batch_size if batch_controller else batch_size
+
+    def can_start_upsert():
+        return upserts_in_flight < (batch_controller.max_in_flight if batch_controller else max_in_flight)
+
+    async def upsert():
+        nonlocal upserts_in_flight
+        while True:
+            item = await batch_queue.get()
+            if item is _end_of_stage:
+                break
+
+            batch_number, batch = item
+            async with upserts:
+                await upserts.wait_for(can_start_upsert)
+                upserts_in_flight += 1
+            try:
+                async with api_calls:
+                    report.batch_results.append(await run_in_thread(
+                        upsert_batch, transaction_portfolios_api, scope, portfolio_code, batch_number, batch,
+                        max_attempts, batch_controller
+                    ))
+            finally:
+                async with upserts:
+                    upserts_in_flight -= 1
+                    upserts.notify_all()
+
+    tasks = [asyncio.ensure_future(fetch()), asyncio.ensure_future(transform())]
+    tasks.extend(asyncio.ensure_future(upsert()) for _ in range(upsert_workers))
+    try:
+        await asyncio.gather(*tasks)
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+
+    report.batch_results.sort(key=lambda result: result.batch_number)
+    report.duration_seconds = time.perf_counter() - start_time
+    logging.info(f"Upserted {report.upserted_count} transactions in {len(report.batch_results)} batches "
+                 f"for '{scope}/{portfolio_code}' in {report.duration_seconds:.2f}s "
+                 f"({report.transactions_per_second:.0f} txn/s), {len(report.failed_transaction_ids)} failed")
+    return report
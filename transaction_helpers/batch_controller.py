@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+
+from helpers.instrumentation import run_metrics
+
+
+class AdaptiveBatchController:
+    # Adjusts the upsert batch size and the number of batches in flight from how each batch fared, in the manner of
+    # TCP's congestion control: additive increase while batches come back well within target_batch_seconds, and a
+    # multiplicative decrease when they do not. A throttled batch halves the batches in flight, LUSID is rate
+    # limiting calls rather than struggling with their size. A slow or failed batch, or one over max_batch_bytes on
+    # the wire, halves the batch size. Only batches started after the last change, and no larger than the current
+    # size, count towards the next one. The batches already in flight or taken under the old settings would
+    # otherwise decrease them again.
+    # One controller is shared by every portfolio of a run, so what is learned about the tenant carries over.
+
+    def __init__(self, batch_size=5000, max_in_flight=4, min_batch_size=500, max_batch_size=20000,
+                 max_in_flight_limit=None, target_batch_seconds=10.0, max_batch_bytes=16 * 2 ** 20):
+        self.min_batch_size = min(min_batch_size, batch_size)
+        self.max_batch_size = max(max_batch_size, batch_size)
+        self.max_in_flight_limit = max(max_in_flight_limit or 2 * max_in_flight, max_in_flight)
+        self.target_batch_seconds = target_batch_seconds
+        self.max_batch_bytes = max_batch_bytes
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.clean_batches = 0
+        self.changed_at = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to the worker processes of date range shards, which carry on from the settings learned so far
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.changed_at = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def get_batch_size(self) -> int:
+        return self.batch_size
+
+    def batch_done(self, batch_result):
+        started_at = time.perf_counter() - batch_result.duration_seconds
+        transactions = len(batch_result.transaction_ids)
+        with self.lock:
+            if started_at < self.changed_at or transactions > self.batch_size:
+                return
+
+            if batch_result.throttles:
+                self.change(self.batch_size, self.max_in_flight // 2,
+                            f"throttled {batch_result.throttles} time(s)")
+            elif not batch_result.succeeded:
+                self.change(self.batch_size // 2, self.max_in_flight, "a batch failed")
+            elif batch_result.duration_seconds > self.target_batch_seconds:
+                self.change(self.batch_size // 2, self.max_in_flight,
+                            f"{transactions} transactions took {batch_result.duration_seconds:.1f}s")
+            elif self.max_batch_bytes and batch_result.payload_bytes > self.max_batch_bytes:
+                self.change(self.batch_size // 2, self.max_in_flight,
+                            f"{transactions} transactions were {batch_result.payload_bytes / 2 ** 20:.1f}MiB")
+            elif transactions < self.batch_size:
+                # Only full batches show whether the current size is comfortable, the last of a portfolio is short
+                return
+            elif batch_result.duration_seconds > self.target_batch_seconds / 2:
+                # Not slow enough to shrink, but the round of comfortable batches needed to grow starts over
+                self.clean_batches = 0
+            else:
+                # Both grow by a step once a whole round of batches in flight has come back comfortably, much as a
+                # congestion window grows once per round trip
+                self.clean_batches += 1
+                if self.clean_batches < self.max_in_flight:
+                    return
+                batch_size = self.batch_size + self.min_batch_size
+                if self.max_batch_bytes and batch_result.payload_bytes:
+                    # No larger than would fit in max_batch_bytes on the wire
+                    batch_size = min(batch_size, self.max_batch_bytes * transactions // batch_result.payload_bytes)
+                self.change(max(batch_size, self.batch_size), self.max_in_flight + 1,
+                            f"{self.clean_batches} batches of {transactions} transactions took up to "
+                            f"{batch_result.duration_seconds:.1f}s")
+
+    def change(self, batch_size, max_in_flight, reason):
+        batch_size = min(max(batch_size, self.min_batch_size), self.max_batch_size)
+        max_in_flight = min(max(max_in_flight, 1), self.max_in_flight_limit)
+        if (batch_size, max_in_flight) == (self.batch_size, self.max_in_flight):
+            return
+
+        increase = batch_size >= self.batch_size and max_in_flight >= self.max_in_flight
+        logging.info(f"{'Raising' if increase else 'Lowering'} upserts to batches of {batch_size} with {max_in_flight} "
+                     f"in flight, from {self.batch_size} with {self.max_in_flight}: {reason}")
+        run_metrics.increment("batch_size_increases" if increase else "batch_size_decreases")
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.clean_batches = 0
+        self.changed_at = time.perf_counter()
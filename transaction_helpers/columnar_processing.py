@@ -0,0 +1,114 @@
+import numpy as np
+
+from helpers.commission_rates import WILDCARD, TieredRate
+
+from transaction_helpers.transaction_processing import get_commission_fingerprint
+from transaction_helpers.transaction_records import CommissionRecord
+
+
+class CommissionBatch:
+    # A page of commissions held as columns. Rates, amounts and units are NumPy arrays so the commission
+    # calculation runs once over the whole page.
+
+    def __init__(self, transaction_ids: list, transaction_dates: list, settlement_dates: list, currencies: list,
+                 amounts: np.ndarray, units: np.ndarray, rates: np.ndarray):
+        self.transaction_ids = transaction_ids
+        self.transaction_dates = transaction_dates
+        self.settlement_dates = settlement_dates
+        self.currencies = currencies
+        self.rates = rates
+        self.commission_amounts = amounts * rates
+        self.commission_units = units * rates
+
+    def __len__(self):
+        return len(self.transaction_ids)
+
+
+def get_commission_batch(input_transactions: list, country_prop, entity, broker, rate_table, counts=None,
+                         instrument_countries=None):
+    with_country = []
+    rule_keys = {}
+    rule_index = []
+    # Only the dimensions the rules match on split the page into groups
+    by_type = rate_table.matches_on("transaction_type")
+    by_instrument = rate_table.matches_on("instrument")
+    for input_transaction in input_transactions:
+        if instrument_countries is not None:
+            country = instrument_countries.get(input_transaction.instrument_uid)
+        else:
+            country = input_transaction.country
+        if not country:
+            if counts is not None:
+                counts["missing_country"] += 1
+            continue
+        with_country.append(input_transaction)
+        rule_key = (country, input_transaction.transaction_type if by_type else WILDCARD,
+                    input_transaction.instrument_uid if by_instrument else WILDCARD)
+        rule_index.append(rule_keys.setdefault(rule_key, len(rule_keys)))
+
+    amounts = np.fromiter((transaction.amount for transaction in with_country), np.float64, len(with_country))
+    rule_index = np.array(rule_index, dtype=np.intp)
+
+    # Resolve the rule of each distinct country, type and instrument once and broadcast its rate back over the
+    # page. Tiered rates are looked up for all the transactions they apply to with one search of the breakpoints.
+    schedules = [
+        rate_table.find_schedule(country, broker, entity, transaction_type, instrument)
+        for country, transaction_type, instrument in rule_keys
+    ]
+    unique_rates = np.array([
+        schedule if schedule is not None and not isinstance(schedule, TieredRate) else 0 for schedule in schedules
+    ], dtype=np.float64)
+    rates = unique_rates[rule_index] if len(with_country) else np.zeros(0)
+    tiered_keys = {}
+    for key_index, schedule in enumerate(schedules):
+        if isinstance(schedule, TieredRate):
+            tiered_keys.setdefault(id(schedule), (schedule, []))[1].append(key_index)
+    for schedule, key_indexes in tiered_keys.values():
+        tiered = np.isin(rule_index, key_indexes)
+        tier_index = np.searchsorted(schedule.breakpoints, np.abs(amounts[tiered]), side="right") - 1
+        rates[tiered] = np.asarray(schedule.rates)[np.maximum(tier_index, 0)]
+
+    if counts is not None and None in schedules:
+        # Count the misses per transaction, as the row-wise path does, from how often each rule key occurs
+        key_counts = np.bincount(rule_index, minlength=len(rule_keys))
+        for (country, _, _), schedule, key_count in zip(rule_keys, schedules, key_counts.tolist()):
+            if schedule is None:
+                counts[("mapping_miss", country, broker, entity)] += key_count
+
+    return CommissionBatch(
+        transaction_ids=[transaction.transaction_id for transaction in with_country],
+        transaction_dates=[transaction.transaction_date for transaction in with_country],
+        settlement_dates=[transaction.settlement_date for transaction in with_country],
+        currencies=[transaction.currency for transaction in with_country],
+        amounts=amounts,
+        units=np.fromiter((transaction.units for transaction in with_country), np.float64, len(with_country)),
+        rates=rates,
+    )
+
+
+def iter_transaction_requests_from_batch(batch: CommissionBatch, existing_commissions=None, counts=None):
+    commission_amounts = batch.commission_amounts.tolist()
+    commission_units = batch.commission_units.tolist()
+
+    for i, transaction_id in enumerate(batch.transaction_ids):
+        if existing_commissions and existing_commissions.get(transaction_id) == get_commission_fingerprint(
+                batch.transaction_dates[i], batch.settlement_dates[i], batch.currencies[i], commission_amounts[i],
+                commission_units[i]
+        ):
+            if counts is not None:
+                counts["unchanged"] += 1
+            continue
+
+        if counts is not None:
+            counts["created"] += 1
+        yield CommissionRecord(
+            transaction_id, batch.transaction_dates[i], batch.settlement_dates[i], batch.currencies[i],
+            commission_units[i], commission_amounts[i]
+        )
+
+
+def iter_transaction_requests_from_pages(input_transaction_pages, country_prop, entity, broker, rate_table,
+                                         existing_commissions=None, counts=None, instrument_countries=None):
+    for page in input_transaction_pages:
+        batch = get_commission_batch(page, country_prop, entity, broker, rate_table, counts, instrument_countries)
+        yield from iter_transaction_requests_from_batch(batch, existing_commissions, counts)
@@ -0,0 +1,127 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+from helpers.instrumentation import run_metrics
+from transaction_helpers.transaction_upsertion import UpsertReport
+
+_worker_api_factory = None
+_shard_executor = None
+_shard_processes = None
+_shard_executor_lock = threading.Lock()
+
+
+def split_date_range(start_date: str, end_date: str, shards: int) -> list:
+    # Splits the window into contiguous sub-ranges of equal length. The date filters are inclusive at both ends so
+    # each sub-range stops a microsecond before the next one starts.
+    start = datetime.fromisoformat(start_date)
+    end = datetime.fromisoformat(end_date)
+    if shards <= 1 or end <= start:
+        return [(start_date, end_date)]
+
+    step = (end - start) / shards
+    bounds = [start + step * i for i in range(shards)]
+    date_ranges = []
+    for i, bound in enumerate(bounds):
+        shard_end = end_date if i == shards - 1 else (bounds[i + 1] - timedelta(microseconds=1)).isoformat()
+        date_ranges.append((start_date if i == 0 else bound.isoformat(), shard_end))
+    return date_ranges
+
+
+def create_shard_executor(max_workers):
+    # Spawned rather than forked, the parent runs portfolio, prefetch and upsert threads which must not be copied
+    # into the children mid-flight
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def get_shard_executor(max_processes=None) -> tuple:
+    # One pool of worker processes is shared by the shards of every portfolio, so portfolios processed at once queue
+    # their shards on it rather than each spawning processes of their own. It is created on first use and kept
+    # until shut down, its size is fixed by the first call.
+    global _shard_executor, _shard_processes
+    with _shard_executor_lock:
+        if _shard_executor is None:
+            _shard_processes = max_processes or os.cpu_count() or 1
+            _shard_executor = create_shard_executor(_shard_processes)
+        return _shard_executor, _shard_processes
+
+
+def shutdown_shard_executor(executor=None):
+    # Only shuts the shared pool down if it is still the given one, so a broken pool is not shut down twice
+    global _shard_executor
+    with _shard_executor_lock:
+        if _shard_executor is None or (executor is not None and _shard_executor is not executor):
+            return
+        executor, _shard_executor = _shard_executor, None
+    executor.shutdown()
+
+
+def process_shard(process_range, build_api_factory, parent_pid, shard_number, scope, portfolio_code, end_date: str,
+                  start_date: str, entity, broker, **processing_kwargs) -> tuple:
+    # A shard run in another process collects its metrics there, so they are sent back to be merged. Worker
+    # processes are reused between shards, they start each one from empty metrics and keep the one client they
+    # build, with its connection pool and token, for all of them.
+    global _worker_api_factory
+    in_worker_process = os.getpid() != parent_pid
+    if in_worker_process:
+        run_metrics.reset()
+        if _worker_api_factory is None:
+            _worker_api_factory = build_api_factory()
+        api_factory = _worker_api_factory
+    else:
+        api_factory = build_api_factory()
+
+    counts = Counter()
+    report = process_range(
+        scope, portfolio_code, end_date, start_date, api_factory, entity, broker, counts, **processing_kwargs
+    )
+    metrics = run_metrics.to_report() if in_worker_process else None
+    return shard_number, report, counts, metrics
+
+
+def run_sharded(process_range, build_api_factory, scope, portfolio_code, end_date: str, start_date: str, entity,
+                broker, shards, max_processes=None, **processing_kwargs) -> tuple:
+    # Commission ids are derived from the input transaction ids, so every date range can be fetched, computed and
+    # upserted independently of the others. Each range runs process_range on the shared pool of worker processes
+    # and the reports and counts are merged back in date order.
+    date_ranges = split_date_range(start_date, end_date, shards)
+    executor, shard_processes = get_shard_executor(max_processes)
+    logging.info(f"Processing '{scope}/{portfolio_code}' in {len(date_ranges)} date ranges "
+                 f"across {shard_processes} shared processes")
+
+    report = UpsertReport(scope, portfolio_code)
+    counts = Counter()
+    start_time = time.perf_counter()
+    futures = [
+        executor.submit(
+            process_shard, process_range, build_api_factory, os.getpid(), shard_number, scope, portfolio_code,
+            shard_end, shard_start, entity, broker, **processing_kwargs
+        )
+        for shard_number, (shard_start, shard_end) in enumerate(date_ranges)
+    ]
+    try:
+        shard_results = sorted(future.result() for future in futures)
+    except BrokenProcessPool:
+        # A worker process died, the next portfolio starts a new pool rather than failing on this one
+        shutdown_shard_executor(executor)
+        raise
+
+    batch_offset = 0
+    for _, shard_report, shard_counts, shard_metrics in shard_results:
+        # Batch numbers restart in every shard, they are offset so they stay unique in the merged report
+        for batch_result in shard_report.batch_results:
+            batch_result.batch_number += batch_offset
+        batch_offset += len(shard_report.batch_results)
+        report.batch_results.extend(shard_report.batch_results)
+        counts.update(shard_counts)
+        if shard_metrics:
+            run_metrics.merge_report(shard_metrics)
+
+    report.duration_seconds = time.perf_counter() - start_time
+    return report, counts
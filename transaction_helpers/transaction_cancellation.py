@@ -0,0 +1,107 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import lusid
+
+from helpers.instrumentation import run_metrics
+from helpers.utilities import call_with_retry
+from transaction_helpers.transaction_retrieval import get_transaction_record_pages
+from transaction_helpers.transaction_upsertion import BatchResult
+
+# The ids to cancel are sent in the query string, so a batch is as many as keep it inside the 8KiB request line
+# most proxies accept
+_max_cancel_query_bytes = 7000
+
+
+def find_orphaned_commissions(commission_pages, input_pages) -> dict:
+    # Returns the commissions, by id, whose linked input transaction is no longer live, mapped to that input
+    # transaction id. Only the commissions are held in memory: the ids of each page of live input transactions are
+    # taken away from the linked ids as a set difference. Commissions without a link were not booked by this script
+    # and are left alone.
+    commissions = {
+        record.linked_transaction_id: record.transaction_id
+        for page in commission_pages for record in page if record.linked_transaction_id
+    }
+    orphaned_links = set(commissions)
+    for page in input_pages:
+        orphaned_links.difference_update(record.transaction_id for record in page)
+    return {commissions[linked_id]: linked_id for linked_id in sorted(orphaned_links)}
+
+
+def drop_live_inputs(api_factory, scope, portfolio_code, orphaned: dict, input_txn_filter, ids_per_filter=100) -> dict:
+    # The input transactions were only fetched over the window, so one amended to a date outside it looks cancelled.
+    # The linked inputs of the orphaned commissions are looked up again by id whatever their date, and those still
+    # live are dropped. An id a filter cannot quote is taken as live so its commission is never cancelled in error.
+    linked_ids = sorted(set(orphaned.values()))
+    live_ids = {linked_id for linked_id in linked_ids if "'" in linked_id}
+    quotable_ids = [linked_id for linked_id in linked_ids if linked_id not in live_ids]
+    for i in range(0, len(quotable_ids), ids_per_filter):
+        id_filter = f"{input_txn_filter} and transactionId in " + ", ".join(
+            f"'{linked_id}'" for linked_id in quotable_ids[i:i + ids_per_filter]
+        )
+        for page in get_transaction_record_pages(api_factory, scope, portfolio_code, None, None, id_filter):
+            live_ids.update(record.transaction_id for record in page)
+
+    if live_ids:
+        logging.info(f"{len(live_ids)} input transactions of '{scope}/{portfolio_code}' are still live outside the "
+                     f"window, their commissions are left alone")
+    return {
+        commission_id: linked_id for commission_id, linked_id in orphaned.items() if linked_id not in live_ids
+    }
+
+
+def chunk_transaction_ids(transaction_ids, max_query_bytes=_max_cancel_query_bytes):
+    batch = []
+    query_bytes = 0
+    for transaction_id in transaction_ids:
+        # Each id is sent as &transactionIds=<id>
+        id_bytes = len(quote(transaction_id, safe="")) + 16
+        if batch and query_bytes + id_bytes > max_query_bytes:
+            yield batch
+            batch = []
+            query_bytes = 0
+        batch.append(transaction_id)
+        query_bytes += id_bytes
+    if batch:
+        yield batch
+
+
+def cancel_batch(transaction_portfolios_api, scope, portfolio_code, batch_number, transaction_ids: list,
+                 max_attempts) -> BatchResult:
+    start_time = time.perf_counter()
+    try:
+        _, attempts = call_with_retry(
+            transaction_portfolios_api.cancel_transactions, max_attempts=max_attempts,
+            scope=scope, code=portfolio_code, transaction_ids=transaction_ids
+        )
+        error = None
+    except Exception as e:
+        attempts = getattr(e, "attempts", 1)
+        error = str(e).strip()
+    duration = time.perf_counter() - start_time
+    run_metrics.record_stage("cancel_batch", duration, len(transaction_ids))
+    run_metrics.increment("transactions_cancel_failed" if error else "transactions_cancelled", len(transaction_ids))
+
+    if error:
+        logging.error(f"Cancelling batch {batch_number} of {len(transaction_ids)} transactions failed: {error}")
+    return BatchResult(batch_number, transaction_ids, attempts, duration, error)
+
+
+def cancel_transactions(api_factory, scope, portfolio_code, transaction_ids, max_in_flight=4,
+                        max_attempts=5) -> list:
+    transaction_portfolios_api = api_factory.build(lusid.api.TransactionPortfoliosApi)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = [
+            executor.submit(
+                cancel_batch, transaction_portfolios_api, scope, portfolio_code, batch_number, batch, max_attempts
+            )
+            for batch_number, batch in enumerate(chunk_transaction_ids(transaction_ids), start=1)
+        ]
+        batch_results = [future.result() for future in futures]
+
+    cancelled = sum(len(result.transaction_ids) for result in batch_results if result.succeeded)
+    logging.info(f"Cancelled {cancelled} transactions of '{scope}/{portfolio_code}' in {len(batch_results)} batches, "
+                 f"{len(transaction_ids) - cancelled} failed")
+    return batch_results
@@ -1,29 +1,96 @@
 import logging
+from collections import Counter
 
-from helpers.utilities import get_commission_rate_from_lookup
-from transaction_helpers.transaction_upsertion import create_properties_request, create_upsert_transaction_request
+from helpers.commission_rates import get_commission_rate_table
+from helpers.utilities import transaction_log_sampler
+from transaction_helpers.transaction_records import CommissionRecord
 
 
-def get_transaction_requests_from_input_transactions(input_transactions, country_prop, entity, broker):
-    transaction_requests = []
-    for input_transaction in input_transactions.values:
-        country_property = input_transaction.properties.get(country_prop)
+def get_commission_fingerprint(transaction_date: str, settlement_date: str, currency, amount, units) -> int:
+    # Amounts are rounded so that floating point noise in the rate multiplication does not count as a change
+    return hash((transaction_date, settlement_date, currency, round(amount, 6), round(units, 6)))
 
-        if not country_property:
-            logging.info(f"There is no property '{country_prop}' on the transaction with id "
-                         f"'{input_transaction.transaction_id}'. Skipping.")
+
+def get_record_fingerprint(record) -> int:
+    return get_commission_fingerprint(
+        record.transaction_date, record.settlement_date, record.currency, record.amount, record.units
+    )
+
+
+def get_commission_fingerprints(commission_records) -> dict:
+    return {
+        commission_record.linked_transaction_id: get_record_fingerprint(commission_record)
+        for commission_record in commission_records if commission_record.linked_transaction_id
+    }
+
+
+def get_transaction_requests_from_input_transactions(input_transactions, country_prop, entity, broker,
+                                                     existing_commissions=None, counts=None) -> list:
+    return list(iter_transaction_requests_from_input_transactions(
+        input_transactions, country_prop, entity, broker, existing_commissions, counts
+    ))
+
+
+def iter_transaction_requests_from_input_transactions(input_transactions, country_prop, entity, broker,
+                                                      existing_commissions=None, counts=None,
+                                                      instrument_countries=None):
+    # Takes TransactionRecords and yields the CommissionRecords to upsert. existing_commissions maps input
+    # transaction ids to the fingerprint of their booked commission, commissions which would be upserted unchanged
+    # are skipped. With instrument_countries, the mapping of instruments to countries returned by
+    # InstrumentCountryCache.prefetch, the country is looked up by the transaction's instrument rather than read from
+    # the property decorated onto the transaction.
+    if counts is None:
+        counts = Counter()
+    rate_table = get_commission_rate_table()
+    log_every = transaction_log_sampler.get_sample_every()
+    for input_transaction in input_transactions:
+        if instrument_countries is not None:
+            country = instrument_countries.get(input_transaction.instrument_uid)
+        else:
+            country = input_transaction.country
+
+        if not country:
+            counts["missing_country"] += 1
+            if log_every and counts["missing_country"] % log_every == 0:
+                logging.debug(f"There is no property '{country_prop}' on the transaction with id "
+                              f"'{input_transaction.transaction_id}'. Skipping.")
             continue
 
-        country = country_property.value.label_value
-        commission_rate = get_commission_rate_from_lookup(country, broker, entity)
-        logging.info(f"creating/updating txn: {input_transaction.transaction_id}")
-
-        # Create transaction request
-        transaction_type = "Commission"
-        instrument_identifier = "Instrument/default/Currency"
-        properties = create_properties_request(input_transaction, transaction_type)
-        # append request
-        transaction_requests = transaction_requests + create_upsert_transaction_request(
-            input_transaction, commission_rate, transaction_type, instrument_identifier, properties
+        commission_rate = rate_table.get_rate(
+            country, broker, entity, counts, input_transaction.transaction_type, input_transaction.instrument_uid,
+            input_transaction.amount
         )
-    return transaction_requests
\ No newline at end of file
+        commission = CommissionRecord(
+            input_transaction.transaction_id, input_transaction.transaction_date, input_transaction.settlement_date,
+            input_transaction.currency, input_transaction.units * commission_rate,
+            input_transaction.amount * commission_rate
+        )
+        if existing_commissions and existing_commissions.get(input_transaction.transaction_id) == \
+                get_record_fingerprint(commission):
+            counts["unchanged"] += 1
+            continue
+
+        counts["created"] += 1
+        if log_every and counts["created"] % log_every == 0:
+            logging.debug(f"creating/updating txn: {input_transaction.transaction_id} with rate {commission_rate}")
+        yield commission
+
+
+def summarise_counts(counts) -> dict:
+    summary = {key: value for key, value in counts.items() if isinstance(key, str)}
+    mapping_misses = {
+        "/".join(key[1:]): value for key, value in counts.items() if isinstance(key, tuple) and key[0] == "mapping_miss"
+    }
+    if mapping_misses:
+        summary["mapping_misses"] = mapping_misses
+    return summary
+
+
+def log_counts(scope, portfolio_code, counts):
+    summary = summarise_counts(counts)
+    logging.info(f"Portfolio '{scope}/{portfolio_code}': {summary.get('created', 0)} commissions created or updated, "
+                 f"{summary.get('unchanged', 0)} unchanged, {summary.get('missing_country', 0)} transactions "
+                 f"skipped for a missing country")
+    for key, misses in summary.get("mapping_misses", {}).items():
+        logging.warning(f"Portfolio '{scope}/{portfolio_code}': {misses} transactions have no commission rate for "
+                        f"country/broker/entity '{key}' and were booked with a rate of 0")
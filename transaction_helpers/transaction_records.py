@@ -0,0 +1,99 @@
+import json
+
+import constants as const
+
+COMMISSION_TRANSACTION_TYPE = "Commission"
+COMMISSION_INSTRUMENT_IDENTIFIER = "Instrument/default/Currency"
+COMMISSION_ID_SUFFIX = "_commission"
+
+
+class TransactionRecord:
+    # The fields of a fetched transaction the script reads, parsed straight from the response JSON rather than
+    # deserialized into SDK models. Dates are kept as the strings LUSID returned them as.
+    __slots__ = ("transaction_id", "instrument_uid", "transaction_date", "settlement_date", "currency", "units",
+                 "amount", "country", "linked_transaction_id", "transaction_type")
+
+    def __init__(self, transaction_id, instrument_uid, transaction_date: str, settlement_date: str, currency,
+                 units: float, amount: float, country=None, linked_transaction_id=None, transaction_type=None):
+        self.transaction_id = transaction_id
+        self.instrument_uid = instrument_uid
+        self.transaction_date = transaction_date
+        self.settlement_date = settlement_date
+        self.currency = currency
+        self.units = units
+        self.amount = amount
+        self.country = country
+        self.linked_transaction_id = linked_transaction_id
+        self.transaction_type = transaction_type
+
+
+class CommissionRecord:
+    # A commission waiting to be upserted, serialized directly to the JSON body of the upsert request
+    __slots__ = ("input_transaction_id", "transaction_date", "settlement_date", "currency", "units", "amount")
+
+    def __init__(self, input_transaction_id, transaction_date: str, settlement_date: str, currency, units: float,
+                 amount: float):
+        self.input_transaction_id = input_transaction_id
+        self.transaction_date = transaction_date
+        self.settlement_date = settlement_date
+        self.currency = currency
+        self.units = units
+        self.amount = amount
+
+    @property
+    def transaction_id(self):
+        return f"{self.input_transaction_id}{COMMISSION_ID_SUFFIX}"
+
+    def to_request_body(self) -> dict:
+        return {
+            "transactionId": self.transaction_id,
+            "type": COMMISSION_TRANSACTION_TYPE,
+            "instrumentIdentifiers": {COMMISSION_INSTRUMENT_IDENTIFIER: self.currency},
+            "transactionDate": self.transaction_date,
+            "settlementDate": self.settlement_date,
+            "units": self.units,
+            "totalConsideration": {"amount": self.amount, "currency": self.currency},
+            "transactionCurrency": self.currency,
+            "properties": {
+                "Transaction/generated/Commission": label_property_body(
+                    "Transaction/generated/Commission", self.input_transaction_id
+                ),
+                "Transaction/generated/Type": label_property_body(
+                    "Transaction/generated/Type", COMMISSION_TRANSACTION_TYPE
+                ),
+                const.LINKING_PROPERTY: label_property_body(const.LINKING_PROPERTY, self.input_transaction_id),
+            },
+        }
+
+
+def label_property_body(key, label_value) -> dict:
+    return {"key": key, "value": {"labelValue": label_value}}
+
+
+def get_label_value(properties: dict, key):
+    model_property = properties.get(key) if properties and key else None
+    if not model_property:
+        return None
+    return (model_property.get("value") or {}).get("labelValue")
+
+
+def parse_transaction_page(data, country_prop=None, linking_prop=None) -> tuple:
+    # Parses a raw ResourceListOfTransaction response into records and the token of the next page
+    page = json.loads(data)
+    records = []
+    for value in page.get("values") or []:
+        properties = value.get("properties")
+        records.append(TransactionRecord(
+            value["transactionId"], value.get("instrumentUid"), value["transactionDate"], value["settlementDate"],
+            value.get("transactionCurrency"), value.get("units") or 0.0,
+            (value.get("totalConsideration") or {}).get("amount") or 0.0,
+            get_label_value(properties, country_prop), get_label_value(properties, linking_prop), value.get("type")
+        ))
+    return records, page.get("nextPage")
+
+
+def to_request_bodies(transactions: list) -> list:
+    return [
+        transaction.to_request_body() if isinstance(transaction, CommissionRecord) else transaction
+        for transaction in transactions
+    ]
@@ -1,23 +1,150 @@
 import logging
+import queue
+import threading
+import time
 
 import lusid
+from lusid import models
 
+from helpers.instrumentation import run_metrics
+from helpers.utilities import call_with_retry
+from transaction_helpers.transaction_records import parse_transaction_page
 
-def get_input_transactions(
+_end_of_pages = object()
+
+
+def iter_prefetched_pages(fetch_page, name, prefetch_pages=2, start_page=None, with_next_page=False):
+    # Pages are fetched on a background thread so that the caller can process one page while the next ones are
+    # being retrieved. At most prefetch_pages pages are held in memory ahead of the caller. fetch_page takes the
+    # token of the page to fetch and returns its values and the token of the next page, which is yielded alongside
+    # the values when with_next_page is set.
+    pages = queue.Queue(maxsize=prefetch_pages)
+    stop_fetching = threading.Event()
+
+    def put_page(item):
+        while not stop_fetching.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch_pages():
+        page = start_page
+        page_number = 0
+        try:
+            while True:
+                values, page = fetch_page(page)
+                page_number += 1
+                run_metrics.increment("transactions_fetched", len(values))
+                logging.info(f"Retrieved page {page_number} with {len(values)} transactions")
+                if not put_page((values, page) if with_next_page else values):
+                    return
+
+                if not page:
+                    break
+        except Exception as e:
+            put_page(e)
+            return
+        put_page(_end_of_pages)
+
+    fetcher = threading.Thread(target=fetch_pages, name=name, daemon=True)
+    fetcher.start()
+
+    try:
+        while True:
+            item = pages.get()
+            if item is _end_of_pages:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            yield item
+    finally:
+        stop_fetching.set()
+        fetcher.join()
+
+
+def get_input_transaction_pages(
         api_factory, scope, portfolio_code, end_date_formatted: str, start_date_formatted: str, input_txn_filter,
-        property_keys: list
+        property_keys: list, page_size=5000, prefetch_pages=2
 ):
     transactions_portfolios_api = api_factory.build(lusid.api.TransactionPortfoliosApi)
 
-    # Consider paging this
-    input_transactions = transactions_portfolios_api.get_transactions(
+    def fetch_page(page):
+        kwargs = {"page": page} if page else {}
+        response, _ = call_with_retry(
+            transactions_portfolios_api.get_transactions,
+            scope=scope, code=portfolio_code, from_transaction_date=start_date_formatted,
+            to_transaction_date=end_date_formatted, filter=input_txn_filter, property_keys=property_keys,
+            limit=page_size, **kwargs
+        )
+        return response.values, response.next_page
+
+    transaction_count = 0
+    for values in iter_prefetched_pages(fetch_page, f"fetch-{scope}-{portfolio_code}", prefetch_pages):
+        transaction_count += len(values)
+        yield values
+
+    if transaction_count == 0:
+        logging.info(
+            f"There are no transactions between effective date ending {end_date_formatted} and starting '{start_date_formatted}"
+        )
+
+
+def fetch_transaction_record_page(transactions_portfolios_api, scope, portfolio_code, end_date_formatted: str,
+                                  start_date_formatted: str, input_txn_filter, country_prop=None, linking_prop=None,
+                                  page_size=5000, page=None) -> tuple:
+    # The response body is parsed directly into records, skipping the SDK's deserialization into models
+    kwargs = {"page": page} if page else {}
+    start_time = time.perf_counter()
+    response, _ = call_with_retry(
+        transactions_portfolios_api.get_transactions,
         scope=scope, code=portfolio_code, from_transaction_date=start_date_formatted,
-        to_transaction_date=end_date_formatted, filter=input_txn_filter, property_keys=property_keys
+        to_transaction_date=end_date_formatted, filter=input_txn_filter,
+        property_keys=[key for key in (country_prop, linking_prop) if key], limit=page_size,
+        _preload_content=False, **kwargs
     )
+    records, next_page = parse_transaction_page(response.data, country_prop, linking_prop)
+    run_metrics.record_stage("fetch_page", time.perf_counter() - start_time, len(records))
+    return records, next_page
 
-    if len(input_transactions.values) == 0:
+
+def get_transaction_record_pages(
+        api_factory, scope, portfolio_code, end_date_formatted: str, start_date_formatted: str, input_txn_filter,
+        country_prop=None, linking_prop=None, page_size=5000, prefetch_pages=2, start_page=None, with_next_page=False
+):
+    transactions_portfolios_api = api_factory.build(lusid.api.TransactionPortfoliosApi)
+
+    def fetch_page(page):
+        return fetch_transaction_record_page(
+            transactions_portfolios_api, scope, portfolio_code, end_date_formatted, start_date_formatted,
+            input_txn_filter, country_prop, linking_prop, page_size, page
+        )
+
+    transaction_count = 0
+    for item in iter_prefetched_pages(
+            fetch_page, f"fetch-{scope}-{portfolio_code}", prefetch_pages, start_page, with_next_page
+    ):
+        transaction_count += len(item[0] if with_next_page else item)
+        yield item
+
+    if transaction_count == 0:
         logging.info(
             f"There are no transactions between effective date ending {end_date_formatted} and starting '{start_date_formatted}"
         )
 
-    return input_transactions
+
+def get_input_transactions(
+        api_factory, scope, portfolio_code, end_date_formatted: str, start_date_formatted: str, input_txn_filter,
+        property_keys: list
+):
+    values = []
+    for page in get_input_transaction_pages(
+            api_factory, scope, portfolio_code, end_date_formatted, start_date_formatted, input_txn_filter,
+            property_keys
+    ):
+        values.extend(page)
+
+    return models.ResourceListOfTransaction(values=values)
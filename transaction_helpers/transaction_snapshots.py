@@ -0,0 +1,76 @@
+import gzip
+import json
+import os
+from itertools import islice
+
+from transaction_helpers.transaction_records import CommissionRecord, TransactionRecord
+
+# Snapshots are NDJSON, gzipped when the path ends in .gz. The first line is a header describing what the file holds
+# and the portfolio it came from, every other line is one record as a JSON array of the header's fields. They are
+# read a line at a time so a file of any size is streamed rather than loaded.
+SNAPSHOT_VERSION = 1
+TRANSACTION_FIELDS = ("transaction_id", "instrument_uid", "transaction_date", "settlement_date", "currency", "units",
+                      "amount", "country", "transaction_type")
+COMMISSION_FIELDS = ("input_transaction_id", "transaction_date", "settlement_date", "currency", "units", "amount")
+
+
+def open_snapshot(path, mode="r"):
+    if path.endswith(".gz"):
+        return gzip.open(path, f"{mode}t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def write_snapshot(path, header: dict, rows) -> int:
+    # Written alongside and moved into place once complete, a snapshot cut short is never left at the path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.tmp{'.gz' if path.endswith('.gz') else ''}"
+    count = 0
+    with open_snapshot(temp_path, "w") as snapshot_file:
+        snapshot_file.write(json.dumps(dict(header, version=SNAPSHOT_VERSION)) + "\n")
+        for row in rows:
+            snapshot_file.write(json.dumps(row, separators=(",", ":")) + "\n")
+            count += 1
+    os.replace(temp_path, path)
+    return count
+
+
+def read_snapshot_header(path, kind) -> dict:
+    with open_snapshot(path) as snapshot_file:
+        header = json.loads(snapshot_file.readline() or "{}")
+    if header.get("kind") != kind or header.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} snapshot of {kind}")
+    return header
+
+
+def iter_snapshot_pages(path, kind, record_class, page_size=5000):
+    header = read_snapshot_header(path, kind)
+    fields = header["fields"]
+    with open_snapshot(path) as snapshot_file:
+        rows = (json.loads(line) for line in islice(snapshot_file, 1, None))
+        while True:
+            page = [record_class(**dict(zip(fields, row))) for row in islice(rows, page_size)]
+            if not page:
+                return
+            yield page
+
+
+def write_transaction_snapshot(path, header: dict, transactions) -> int:
+    return write_snapshot(
+        path, dict(header, kind="transactions", fields=TRANSACTION_FIELDS),
+        ([getattr(transaction, field) for field in TRANSACTION_FIELDS] for transaction in transactions)
+    )
+
+
+def iter_transaction_snapshot_pages(path, page_size=5000):
+    return iter_snapshot_pages(path, "transactions", TransactionRecord, page_size)
+
+
+def write_commission_snapshot(path, header: dict, commissions) -> int:
+    return write_snapshot(
+        path, dict(header, kind="commissions", fields=COMMISSION_FIELDS),
+        ([getattr(commission, field) for field in COMMISSION_FIELDS] for commission in commissions)
+    )
+
+
+def iter_commission_snapshot_pages(path, page_size=5000):
+    return iter_snapshot_pages(path, "commissions", CommissionRecord, page_size)
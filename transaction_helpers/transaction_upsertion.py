@@ -1,14 +1,26 @@
-from math import ceil
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass, field
+from itertools import islice
 
 import lusid
 from lusid import models
 
+from helpers.instrumentation import run_metrics
+from helpers.utilities import call_with_retry
+from transaction_helpers.transaction_records import to_request_bodies
+
 
 def create_properties_request(input_transaction, transaction_type) -> dict:
+    return create_commission_properties(input_transaction.transaction_id, transaction_type)
+
+
+def create_commission_properties(input_transaction_id, transaction_type) -> dict:
     properties = {
         "Transaction/generated/Commission": models.PerpetualProperty(
             key="Transaction/generated/Commission",
-            value=models.PropertyValue(label_value=input_transaction.transaction_id)
+            value=models.PropertyValue(label_value=input_transaction_id)
         ),
         "Transaction/generated/Type": models.PerpetualProperty(
             key="Transaction/generated/Type",
@@ -17,7 +29,7 @@ def create_properties_request(input_transaction, transaction_type) -> dict:
         # TODO: This property to come from a global config file
         "Transaction/generated/LinkedTransactionId": models.PerpetualProperty(
             key="Transaction/generated/LinkedTransactionId",
-            value=models.PropertyValue(label_value=input_transaction.transaction_id)
+            value=models.PropertyValue(label_value=input_transaction_id)
         )
     }
 
@@ -46,15 +58,144 @@ def create_upsert_transaction_request(input_transaction, commission_rate, transa
     return [request]
 
 
-def upsert_transactions(api_factory, scope, portfolio_code, transactions: list, batch_size=5000):
+@dataclass
+class BatchResult:
+    batch_number: int
+    transaction_ids: list
+    attempts: int
+    duration_seconds: float
+    error: str = None
+    throttles: int = 0
+    payload_bytes: int = 0
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class UpsertReport:
+    scope: str
+    portfolio_code: str
+    batch_results: list = field(default_factory=list)
+    duration_seconds: float = 0.0
+
+    @property
+    def upserted_count(self) -> int:
+        return sum(len(result.transaction_ids) for result in self.batch_results if result.succeeded)
+
+    @property
+    def failed_transaction_ids(self) -> list:
+        return [
+            transaction_id for result in self.batch_results if not result.succeeded
+            for transaction_id in result.transaction_ids
+        ]
+
+    @property
+    def transactions_per_second(self) -> float:
+        return self.upserted_count / self.duration_seconds if self.duration_seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "scope": self.scope,
+            "portfolio_code": self.portfolio_code,
+            "batches": len(self.batch_results),
+            "upserted": self.upserted_count,
+            "failed": len(self.failed_transaction_ids),
+            "failed_transaction_ids": self.failed_transaction_ids,
+            "failed_batches": [
+                {"batch_number": result.batch_number, "error": result.error}
+                for result in self.batch_results if not result.succeeded
+            ],
+            "duration_seconds": round(self.duration_seconds, 3),
+            "transactions_per_second": round(self.transactions_per_second, 1),
+        }
+
+
+def chunk_transactions(transactions, batch_size):
+    # batch_size is either a number or a callable returning the size of the next batch
+    transactions = iter(transactions)
+    while True:
+        batch = list(islice(transactions, batch_size() if callable(batch_size) else batch_size))
+        if not batch:
+            return
+        yield batch
 
-    responses = []
-    batches = ceil(len(transactions)/batch_size)
-    for i in range(0, batches):
-        print(f"\nBATCH NUMBER {i+1}:\n")
-        response = api_factory.build(lusid.api.TransactionPortfoliosApi).upsert_transactions(
-            scope=scope, code=portfolio_code, transaction_request=transactions[i:i+batch_size]
+
+def upsert_batch(transaction_portfolios_api, scope, portfolio_code, batch_number, batch: list,
+                 max_attempts, batch_controller=None) -> BatchResult:
+    transaction_ids = [transaction.transaction_id for transaction in batch]
+    throttles = []
+    bytes_sent_before = run_metrics.get_thread_bytes_sent()
+    start_time = time.perf_counter()
+    try:
+        _, attempts = call_with_retry(
+            transaction_portfolios_api.upsert_transactions, max_attempts=max_attempts, on_retry=throttles.append,
+            scope=scope, code=portfolio_code, transaction_request=to_request_bodies(batch)
         )
-        responses.append(response)
+        error = None
+    except Exception as e:
+        attempts = getattr(e, "attempts", 1)
+        error = str(e).strip()
+        throttles.append(e)
+    duration = time.perf_counter() - start_time
+    run_metrics.record_stage("upsert_batch", duration, len(batch))
+    run_metrics.increment("transactions_failed" if error else "transactions_upserted", len(batch))
+
+    if error:
+        logging.error(f"Batch {batch_number} of {len(batch)} transactions failed after {duration:.2f}s: {error}")
+    else:
+        logging.info(f"Batch {batch_number} upserted {len(batch)} transactions in {duration:.2f}s "
+                     f"({len(batch) / duration if duration else 0:.0f} txn/s, {attempts} attempt(s))")
+
+    batch_result = BatchResult(
+        batch_number, transaction_ids, attempts, duration, error,
+        throttles=sum(1 for e in throttles if getattr(e, "status", None) == 429),
+        payload_bytes=run_metrics.get_thread_bytes_sent() - bytes_sent_before
+    )
+    if batch_controller:
+        batch_controller.batch_done(batch_result)
+    return batch_result
+
+
+def add_batch_results(report: UpsertReport, batch_results, on_batch_done=None):
+    for batch_result in batch_results:
+        report.batch_results.append(batch_result)
+        if on_batch_done:
+            on_batch_done(batch_result)
+
+
+def upsert_transactions(api_factory, scope, portfolio_code, transactions, batch_size=5000, max_in_flight=4,
+                        max_attempts=5, on_batch_done=None, batch_controller=None) -> UpsertReport:
+    # With a batch_controller the batch size and batches in flight are its current settings, which it adjusts as
+    # batches complete, rather than batch_size and max_in_flight
+    transaction_portfolios_api = api_factory.build(lusid.api.TransactionPortfoliosApi)
+    report = UpsertReport(scope, portfolio_code)
+    start_time = time.perf_counter()
+    if batch_controller:
+        batch_size = batch_controller.get_batch_size
+        executor_workers = batch_controller.max_in_flight_limit
+    else:
+        executor_workers = max_in_flight
+
+    # Batches are pulled from the input lazily so no more than max_in_flight batches are held at once
+    with ThreadPoolExecutor(max_workers=executor_workers) as executor:
+        in_flight = set()
+        for batch_number, batch in enumerate(chunk_transactions(transactions, batch_size), start=1):
+            while len(in_flight) >= (batch_controller.max_in_flight if batch_controller else max_in_flight):
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                add_batch_results(report, (future.result() for future in done), on_batch_done)
+
+            in_flight.add(executor.submit(
+                upsert_batch, transaction_portfolios_api, scope, portfolio_code, batch_number, batch, max_attempts,
+                batch_controller
+            ))
+
+        add_batch_results(report, (future.result() for future in as_completed(in_flight)), on_batch_done)
 
-    return responses
+    report.batch_results.sort(key=lambda result: result.batch_number)
+    report.duration_seconds = time.perf_counter() - start_time
+    logging.info(f"Upserted {report.upserted_count} transactions in {len(report.batch_results)} batches "
+                 f"for '{scope}/{portfolio_code}' in {report.duration_seconds:.2f}s "
+                 f"({report.transactions_per_second:.0f} txn/s), {len(report.failed_transaction_ids)} failed")
+    return report